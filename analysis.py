@@ -1,12 +1,13 @@
 ##
-from utils.dataset_utils import get_result_txt, preprocess_txt, preprocess2sentence, get_dataset
+from utils.dataset_utils import preprocess_txt, preprocess2sentence, get_dataset
+from utils.result_store import load_result
 from datasets import load_dataset
 dtype = "wikitext"
 filename = "watermarked.txt"
 
 list_of_files = [f'results/ours/{dtype}/new/dep/{filename}', f'results/ours/{dtype}/new/dep-wo-cc/{filename}',
                  f'results/context-ls/{dtype}/paper/{filename}']
-list_of_watermarks = [get_result_txt(i) for i in list_of_files]
+list_of_watermarks = [load_result(i) for i in list_of_files]
 list_of_sets = []
 
 corpus, test_corpus, num_sample = get_dataset(dtype)
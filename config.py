@@ -1,9 +1,15 @@
 import argparse
 import string
 
-from nltk.corpus import stopwords
+from utils.lazy import Lazy
 
-stop = set(stopwords.words('english'))
+
+def _load_stopwords():
+    from nltk.corpus import stopwords
+    return set(stopwords.words('english'))
+
+
+stop = Lazy(_load_stopwords, "nltk stopwords")
 punctuation = set(string.punctuation)
 # riskset = stop.union(punctuation)
 riskset = punctuation
@@ -20,6 +26,19 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
+def add_device_args(parser):
+    # arguments of utils.device.configure
+    parser.add_argument("--device", type=str, default="auto", choices=['auto', 'cpu', 'cuda'])
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--precision", type=str, default="fp32", choices=['fp32', 'bf16', 'int8'])
+    parser.add_argument("--backend", type=str, default="torch", choices=['torch', 'onnx'])
+    return parser
+
+
+def DeviceArgs():
+    return add_device_args(argparse.ArgumentParser(description="Device and precision of the models"))
+
+
 def WatermarkArgs():
     parser = argparse.ArgumentParser(description="For the watermarking module")
     parser.add_argument("-debug_mode", type=str2bool, default=False)
@@ -34,8 +53,22 @@ def WatermarkArgs():
     parser.add_argument("--num_epochs", type=int, default=10)
     parser.add_argument("--dtype", type=str, default='imdb')
     parser.add_argument("--spacy_model", type=str, default="en_core_web_sm")
+    parser.add_argument("--preprocess_batch_size", type=int, default=64)
+    parser.add_argument("--preprocess_n_process", type=int, default=4)
+    # embed the documents while the corpus is being parsed (see utils.dataset_utils.preprocess2sentence)
+    parser.add_argument("-preprocess_stream", type=str2bool, default=False)
     parser.add_argument("--keyword_ratio", type=float, default=0.05)
+    parser.add_argument("--keyword_scorer", type=str, default="yake", choices=['yake', 'tfidf'])
     parser.add_argument("--topk", type=int, default=4)
+    parser.add_argument("--infill_batch_size", type=int, default=32)
+    add_device_args(parser)
+    parser.add_argument("--nli_max_tokens", type=int, default=8192)
+    parser.add_argument("--nli_queue_size", type=int, default=4096)
+    parser.add_argument("--candidate_order", type=str, default="product", choices=['product', 'prob'])
+    parser.add_argument("--max_candidates", type=int, default=0)
+    parser.add_argument("-prune_candidates", type=str2bool, default=False)
+    parser.add_argument("--sentence_cache", type=str, default="")
+    parser.add_argument("--sentence_cache_size", type=int, default=1000000)
     parser.add_argument("--mask_select_method", type=str, default="",
                         choices=['keyword_disconnected', "keyword_connected", "grammar"])
     parser.add_argument("--mask_order_by", type=str, default="", choices=['dep', 'pos'])
@@ -52,11 +85,31 @@ def GenericArgs():
     parser.add_argument("-extract", type=str2bool, default=False)
     parser.add_argument("-extract_corrupted", type=str2bool, default=False)
     parser.add_argument("--corrupted_file_dir", type=str, default="")
+    parser.add_argument("--corrupted_file_dirs", type=str, nargs="*", default=[],
+                        help="corrupted files (or glob patterns) extracted in one run; see --num_workers")
     parser.add_argument("--dtype", type=str, default="imdb")
     parser.add_argument("--num_sample", type=int, default=100)
     parser.add_argument("--spacy_model", type=str, default="en_core_web_sm")
     parser.add_argument("-debug_mode", type=str2bool, default=False)
     parser.add_argument("-metric_only", type=str2bool, default=False)
+    parser.add_argument("--verify_n_process", type=int, default=1)
+    parser.add_argument("--verify_batch_size", type=int, default=64)
+    parser.add_argument("-profile_startup", type=str2bool, default=False)
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--prefix_cache", type=str, default="",
+                        help="sqlite file that persists the masked-LM results of ContextLS between runs")
+    parser.add_argument("--message_source", type=str, default="random", choices=['random', 'keyed', 'bitstream'],
+                        help="random: global RNG (seed 1230); keyed: HMAC of (key, corpus idx, sentence idx); "
+                             "bitstream: payload read from --message_bits")
+    parser.add_argument("--message_key", type=str, default="")
+    parser.add_argument("--message_bits", type=str, default="", help="file of 0/1 characters")
+    parser.add_argument("-verify_messages", type=str2bool, default=False,
+                        help="recompute the messages of a keyed / bitstream source at extraction and count the rows "
+                             "that differ from watermarked.txt (verifies every clean row once more)")
+    parser.add_argument("-resume", type=str2bool, default=False,
+                        help="continue embedding / extraction from the last checkpoint")
+    parser.add_argument("--checkpoint_every", type=int, default=10,
+                        help="checkpoint interval in documents (embed) or watermarked sentences (extract)")
 
     return parser
 
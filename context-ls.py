@@ -3,6 +3,7 @@
 
 from functools import reduce
 import math
+import multiprocessing
 import os
 import string
 import random
@@ -11,11 +12,16 @@ from datasets import load_dataset
 from tqdm import tqdm
 import torch
 
-from config import GenericArgs
+from config import DeviceArgs, GenericArgs
 from utils.misc import compute_ber, riskset, stop
-from utils.contextls_utils import synchronicity_test, substitutability_test, tokenizer, riskset, stop
+from utils.contextls_utils import synchronicity_test, substitutability_test, tokenizer, riskset, stop, \
+    close_prefix_cache, commit_prefix_cache, enable_prefix_cache, prefix_memo_stats, reconnect_prefix_cache
 from utils.logging import getLogger
-from utils.dataset_utils import preprocess_txt, preprocess2sentence, get_result_txt, get_dataset
+from utils.dataset_utils import preprocess_txt, preprocess2sentence, get_dataset
+from utils.result_store import load_result
+from models.embed import worker_threads
+from models.extract import COUNTERS, corrupted_files, corruption_type, file_logger, read_corrupted, write_ber
+from utils.device import configure, get_device
 from utils.metric import Metric
 
 random.seed(1230)
@@ -89,10 +95,113 @@ def main(cover_text, f, extracting=False):
     return substituted_idset, substituted_indices, watermarking_wordset, encoded_text['input_ids'], message
 
 
+def clean_encodings(clean_watermarked, num_rows):
+    # token ids of the uncorrupted watermarked texts; computed once for all corrupted files
+    text_column = clean_watermarked.column('text')
+    return [tokenizer(text_column[idx].strip(), add_special_tokens=False, truncation=True,
+                      max_length=tokenizer.model_max_length // 2 - 2)['input_ids']
+            for idx in range(min(num_rows, len(text_column)))]
+
+
+def extract_file(corrupted_path, clean_watermarked, clean_encoded, cover_texts, f, logger=None):
+    """
+    corrupted_path: corrupted file created by models/corruption/attack.py; the clean texts are extracted if empty
+    Output: dict of the counters over the file (see models.extract.COUNTERS)
+    """
+    corrupted_watermarked = read_corrupted(corrupted_path) if corrupted_path else []
+    counts = dict.fromkeys(COUNTERS, 0)
+    sample_level_bit = {'gt': [], 'extracted': []}
+    prev_c_idx = 0
+
+    for idx, (c_idx, sen_idx, sub_idset, sub_idx, clean_wm_sen, key, msg) in enumerate(clean_watermarked):
+        if prev_c_idx != c_idx:
+            error_cnt, cnt = compute_ber(sample_level_bit['extracted'], sample_level_bit['gt'])
+            counts['sample_err_cnt'] = counts.get('sample_err_cnt', 0) + error_cnt
+            counts['sample_cnt'] = counts.get('sample_cnt', 0) + cnt
+            sample_level_bit = {'gt': [], 'extracted': []}
+            prev_c_idx = c_idx
+
+        if (corrupted_path and len(corrupted_watermarked) <= idx) or idx >= len(clean_encoded):
+            if logger:
+                logger.info(f"Extracted all corrupted watermarks. Ending extraction... ")
+            break
+
+        original_sentences = cover_texts[c_idx]
+        sen = original_sentences[sen_idx]
+
+        wm_texts = corrupted_watermarked[idx] if corrupted_path else [clean_wm_sen.strip()]
+        for wm_text in wm_texts:
+            wm_text = wm_text.strip()
+            if corrupted_path and wm_text == "skipped":
+                continue
+
+            counts['num_sentence'] += 1
+            extracted_idset, extracted_indices, watermarking_wordset, encoded_text, extracted_msg = \
+                main(wm_text, f, extracting=True)
+            extracted_key = [tokenizer.decode(s_id) for s_id in extracted_idset]
+
+            midx_match_flag = set(extracted_indices) == set(sub_idx)
+            if midx_match_flag:
+                counts['midx_match_cnt'] += 1
+
+            mword_match_flag = set([encoded_text[i] for i in extracted_indices]) == \
+                               set([clean_encoded[idx][i] for i in sub_idx])
+            if mword_match_flag:
+                counts['mword_match_cnt'] += 1
+
+            infill_match_list = []
+            if len(sub_idset) == len(extracted_idset):
+                for a, b in zip(sub_idset, extracted_idset):
+                    infill_match_flag = a==b
+                    infill_match_list.append(infill_match_flag)
+            else:
+                infill_match_list.append(False)
+            if all(infill_match_list):
+                counts['infill_match_cnt'] += 1
+
+            sample_level_bit['extracted'].extend(extracted_msg)
+            sample_level_bit['gt'].extend(msg)
+            error_cnt, cnt = compute_ber(msg, extracted_msg)
+            counts['sentence_err_cnt'] += error_cnt
+            counts['sentence_cnt'] += cnt
+
+            if logger:
+                match_flag = error_cnt == 0
+                logger.debug(f"{c_idx} {sen_idx} {match_flag}")
+                logger.info(f"Corrupted sentence: {wm_text}")
+                logger.info(f"original sentence: {sen}")
+                logger.info(f"Extracted msg: {' '.join(extracted_key)}")
+                logger.info(f"Gt msg: {' '.join(key)} \n")
+    return counts
+
+
+# state of a worker process; set by init_extract_worker
+_worker = {}
+
+
+def init_extract_worker(clean_watermarked, clean_encoded, cover_texts, f, num_threads, log_dir=None,
+                        debug_mode=False):
+    # workers are forked, so the tokenizer and LM of contextls_utils are shared with the main process
+    torch.set_num_threads(num_threads)
+    reconnect_prefix_cache()
+    _worker.update(clean_watermarked=clean_watermarked, clean_encoded=clean_encoded, cover_texts=cover_texts, f=f,
+                   log_dir=log_dir, debug_mode=debug_mode)
+
+
+def extract_corrupted_file(corrupted_path):
+    # one log per corrupted file (see models.extract.file_logger)
+    logger = file_logger(_worker['log_dir'], corrupted_path, _worker['debug_mode']) if _worker['log_dir'] else None
+    counts = extract_file(corrupted_path, _worker['clean_watermarked'], _worker['clean_encoded'],
+                          _worker['cover_texts'], _worker['f'], logger)
+    return corrupted_path, counts
+
+
 
 if __name__ == "__main__":
     parser = GenericArgs()
-    args = parser.parse_args()
+    args, _ = parser.parse_known_args()
+    # kept apart from args, which are passed to Metric
+    device_args, _ = DeviceArgs().parse_known_args()
     DEBUG_MODE = args.debug_mode
     if args.embed and args.extract:
         mode = "BOTH"
@@ -100,10 +209,10 @@ if __name__ == "__main__":
         mode = "EMBED"
     elif args.extract:
         mode = "EXTRACT"
-        if args.extract_corrupted:
-            corrupted_dir = args.corrupted_file_dir
-            corruption_type = os.path.basename(corrupted_dir).split("-")[1]
-            mode = f"EXTRACT-{corruption_type}"
+        if args.extract_corrupted and args.corrupted_file_dir:
+            mode = f"EXTRACT-{corruption_type(args.corrupted_file_dir)}"
+        elif args.extract_corrupted:
+            mode = "EXTRACT-SWEEP"
     else:
         raise AssertionError("Mode should be specified")
 
@@ -115,9 +224,14 @@ if __name__ == "__main__":
                        dir_=dirname,
                        debug_mode=DEBUG_MODE)
     sr_score = []
-    device = torch.device("cuda")
+    configure(device_args.device, device_args.num_threads, device_args.precision, device_args.backend)
+    device = get_device()
     metric = Metric(device, **vars(args))
 
+    if args.prefix_cache:
+        # extraction reuses the masked-LM results of the embed run
+        enable_prefix_cache(args.prefix_cache)
+
     f = 1
     dtype = args.dtype
     start_sample_idx = 0
@@ -196,6 +310,7 @@ if __name__ == "__main__":
         logger.info(f"nli score: {sum(nli_score) / len(nli_score):.3f}")
         from utils.contextls_utils import _calls_to_lm
         logger.info(f"calls to LM: {_calls_to_lm}")
+        logger.info(f"prefix memo hits/misses: {prefix_memo_stats['hits']}/{prefix_memo_stats['misses']}")
 
         with open(os.path.join(dirname, "embed-metrics.txt"), "a") as wr:
             wr.write(f"num.sample={args.num_sample}\t bpw={bit_count / word_count}\t "
@@ -206,94 +321,52 @@ if __name__ == "__main__":
     ##
     if args.extract:
         corrupted_flag = args.extract_corrupted
-        corrupted_dir = args.corrupted_file_dir
-
-        corrupted_watermarked = []
-        if corrupted_flag:
-            with open(corrupted_dir, "r") as reader:
-                for line in reader:
-                    line = line.split("[sep] ")
-                    corrupted_watermarked.append(line)
-
-        clean_watermarked = get_result_txt(result_dir)
-
-        num_corrupted_sen = 0
-        sample_level_bit = {'gt':[], 'extracted':[]}
-        bit_error_agg = {}
-        midx_match_cnt = 0
-        mword_match_cnt = 0
-        infill_match_cnt = 0
-        prev_c_idx = 0
-
-        for idx, (c_idx, sen_idx, sub_idset, sub_idx, clean_wm_sen, key, msg) in enumerate(clean_watermarked):
-            if prev_c_idx != c_idx:
-                error_cnt, cnt = compute_ber(sample_level_bit['extracted'], sample_level_bit['gt'])
-                bit_error_agg['sample_err_cnt'] = bit_error_agg.get('sample_err_cnt', 0) + error_cnt
-                bit_error_agg['sample_cnt'] = bit_error_agg.get('sample_cnt', 0) + cnt
-                sample_level_bit = {'gt': [], 'extracted': []}
-                prev_c_idx = c_idx
-
-            if len(corrupted_watermarked) > 0 and len(corrupted_watermarked) <= idx:
-                logger.info(f"Extracted all corrupted watermarks. Ending extraction... ")
-                break
-
-            original_sentences = cover_texts[c_idx]
-            sen = original_sentences[sen_idx]
-
-            clean_encoded = tokenizer(clean_wm_sen.strip(), add_special_tokens=False, truncation=True,
-                                      max_length=tokenizer.model_max_length// 2 - 2)['input_ids']
-            wm_texts = corrupted_watermarked[idx] if corrupted_flag else [clean_wm_sen.strip()]
-            for wm_text in wm_texts:
-                wm_text = wm_text.strip()
-                if corrupted_flag and wm_text == "skipped":
-                    continue
-
-                num_corrupted_sen += 1
-                extracted_idset, extracted_indices, watermarking_wordset, encoded_text, extracted_msg = \
-                    main(wm_text, f, extracting=True)
-                extracted_key = [tokenizer.decode(s_id) for s_id in extracted_idset]
-
-                midx_match_flag = set(extracted_indices) == set(sub_idx)
-                if midx_match_flag:
-                    midx_match_cnt += 1
-
-                mword_match_flag = set([encoded_text[idx] for idx in extracted_indices]) == \
-                                   set([clean_encoded[idx] for idx in sub_idx])
-                if mword_match_flag:
-                    mword_match_cnt += 1
-
-                infill_match_list = []
-                if len(sub_idset) == len(extracted_idset):
-                    for a, b in zip(sub_idset, extracted_idset):
-                        infill_match_flag = a==b
-                        infill_match_list.append(infill_match_flag)
-                else:
-                    infill_match_list.append(False)
-                if all(infill_match_list):
-                    infill_match_cnt += 1
-
-                sample_level_bit['extracted'].extend(extracted_msg)
-                sample_level_bit['gt'].extend(msg)
-                error_cnt, cnt = compute_ber(msg, extracted_msg)
-                bit_error_agg['sentence_err_cnt'] = bit_error_agg.get('sentence_err_cnt', 0) + error_cnt
-                bit_error_agg['sentence_cnt'] = bit_error_agg.get('sentence_cnt', 0) + cnt
-
-                match_flag = error_cnt == 0
-                logger.debug(f"{c_idx} {sen_idx} {match_flag}")
-                logger.info(f"Corrupted sentence: {wm_text}")
-                logger.info(f"original sentence: {sen}")
-                logger.info(f"Extracted msg: {' '.join(extracted_key)}")
-                logger.info(f"Gt msg: {' '.join(key)} \n")
-
-
-        # logger.info(f"Corruption Rate: {num_corrupted_sen / len(clean_watermarked):3f}")
-        logger.info(f"Sentence BER: {bit_error_agg['sentence_err_cnt']}/{bit_error_agg['sentence_cnt']}="
-                    f"{bit_error_agg['sentence_err_cnt'] / bit_error_agg['sentence_cnt']:.3f}")
-
-        logger.info(f"mask infill match rate: {infill_match_cnt / num_corrupted_sen:.3f}")
-        logger.info(f"mask index match rate: {midx_match_cnt / num_corrupted_sen:.3f}")
-        logger.info(f"mask word match rate: {mword_match_cnt / num_corrupted_sen:.3f}")
-
+        corrupted_paths = [""]
         if corrupted_flag:
-            with open(os.path.join(dirname, "ber.txt"), "a") as wr:
-                wr.write(f"{corrupted_dir}\t {bit_error_agg['sentence_err_cnt']/bit_error_agg['sentence_cnt']}\n")
\ No newline at end of file
+            corrupted_paths = corrupted_files([args.corrupted_file_dir] if args.corrupted_file_dir
+                                              else args.corrupted_file_dirs)
+            assert corrupted_paths, "No corrupted files are given"
+
+        clean_watermarked = load_result(result_dir)
+        # the uncorrupted side is shared by all corrupted files
+        num_rows = max(len(read_corrupted(path)) for path in corrupted_paths) if corrupted_flag \
+            else len(clean_watermarked)
+        clean_encoded = clean_encodings(clean_watermarked, num_rows)
+
+        pool = None
+        if len(corrupted_paths) > 1 and args.num_workers > 1 and device.type == "cpu":
+            # the workers read the memo entries written so far
+            commit_prefix_cache()
+            num_workers = min(args.num_workers, len(corrupted_paths))
+            pool = multiprocessing.get_context("fork").Pool(
+                num_workers, initializer=init_extract_worker,
+                initargs=(clean_watermarked, clean_encoded, cover_texts, f,
+                          worker_threads(num_workers, device_args.num_threads), dirname, DEBUG_MODE))
+            logger.info(f"Extracting {len(corrupted_paths)} files with {num_workers} workers; "
+                        f"the sentences of each file are logged to EXTRACT-<attack>=<pct>-*.log in {dirname}")
+            file_counts = pool.imap(extract_corrupted_file, corrupted_paths)
+        else:
+            file_counts = ((path, extract_file(path, clean_watermarked, clean_encoded, cover_texts, f, logger))
+                           for path in corrupted_paths)
+
+        for corrupted_dir, counts in file_counts:
+            num_corrupted_sen = counts['num_sentence']
+            if corrupted_flag:
+                logger.info(f"Extracted corrupted watermarks on {corrupted_dir}")
+            # logger.info(f"Corruption Rate: {num_corrupted_sen / len(clean_watermarked):3f}")
+            logger.info(f"Sentence BER: {counts['sentence_err_cnt']}/{counts['sentence_cnt']}="
+                        f"{counts['sentence_err_cnt'] / counts['sentence_cnt']:.3f}")
+
+            logger.info(f"mask infill match rate: {counts['infill_match_cnt'] / num_corrupted_sen:.3f}")
+            logger.info(f"mask index match rate: {counts['midx_match_cnt'] / num_corrupted_sen:.3f}")
+            logger.info(f"mask word match rate: {counts['mword_match_cnt'] / num_corrupted_sen:.3f}")
+
+            if corrupted_flag:
+                write_ber(os.path.join(dirname, "ber.txt"), corrupted_dir, counts, rates=("infill", "midx", "mword"))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        logger.info(f"prefix memo hits/misses: {prefix_memo_stats['hits']}/{prefix_memo_stats['misses']}")
+
+    close_prefix_cache()
@@ -9,8 +9,10 @@ import string
 import torch
 
 from config import WatermarkArgs, GenericArgs, stop
+from models.candidate import CandidateVerifier
 from models.watermark import InfillModel
 from utils.logging import getLogger
+from utils.device import configure, get_device
 from utils.metric import Metric
 
 infill_parser = WatermarkArgs()
@@ -51,11 +53,16 @@ dtype = "custom"
 dirname = f"./results/ours/{dtype}/{generic_args.exp_name}"
 start_sample_idx = 0
 num_sample = generic_args.num_sample
+configure(infill_args.device, infill_args.num_threads, infill_args.precision, infill_args.backend)
 
 spacy_tokenizer = spacy.load(generic_args.spacy_model)
-if "trf" in generic_args.spacy_model:
+if "trf" in generic_args.spacy_model and get_device().type == "cuda":
     spacy.require_gpu()
 model = InfillModel(infill_args, dirname=dirname)
+verifier = CandidateVerifier(spacy_tokenizer, model.keyword_module, model.mask_selector, model.tokenizer,
+                             n_process=generic_args.verify_n_process, batch_size=generic_args.verify_batch_size,
+                             order=infill_args.candidate_order, max_candidates=infill_args.max_candidates,
+                             prune=infill_args.prune_candidates)
 
 bit_count = 0
 word_count = 0
@@ -67,7 +74,7 @@ sample_cnt = 0
 one_cnt = 0
 zero_cnt = 0
 
-device = torch.device("cuda")
+device = get_device()
 metric = Metric(device, **vars(generic_args))
 
 if not os.path.exists(dirname):
@@ -99,27 +106,13 @@ for c_idx, sentences in enumerate(cover_texts):
         tokenized_text = [token.text_with_ws for token in sen]
 
         if len(agg_cwi) > 0:
-            for cwi in product(*agg_cwi):
-                wm_text = tokenized_text.copy()
-                for m_idx, c_id in zip(mask_idx, cwi):
-                    wm_text[m_idx] = re.sub(r"\S+", model.tokenizer.decode(c_id), wm_text[m_idx])
-
-                wm_tokenized = spacy_tokenizer("".join(wm_text).strip())
-
-                # extract keyword of watermark
-                wm_keywords, wm_ent_keywords = model.keyword_module.extract_keyword([wm_tokenized])
-                wm_kwd = wm_keywords[0]
-                wm_ent_kwd = wm_ent_keywords[0]
-                wm_mask_idx, wm_mask = model.mask_selector.return_mask(wm_tokenized, wm_kwd, wm_ent_kwd)
-
-                kwd_match_flag = set([x.text for x in wm_kwd]) == set([x.text for x in keyword])
-                if kwd_match_flag:
+            for candidate in verifier.verify(sen, keyword, mask_idx, agg_cwi, agg_probs):
+                if candidate['kwd_match']:
                     kwd_match_cnt += 1
 
                 # checking whether the watermark can be embedded without the assumption of corruption
-                mask_match_flag = len(wm_mask) and set(wm_mask_idx) == set(mask_idx)
-                if mask_match_flag:
-                    text2print = [t.text_with_ws for t in wm_tokenized]
+                if candidate['mask_match']:
+                    text2print = candidate['tokens_with_ws'].copy()
                     for m_idx in mask_idx:
                         text2print[m_idx] = f"\033[92m{text2print[m_idx]}\033[00m"
                     valid_watermarks.append(text2print)
@@ -0,0 +1,79 @@
+import argparse
+
+import torch
+from transformers import AutoModelForMaskedLM, AutoModelForSequenceClassification, AutoTokenizer
+
+from config import str2bool
+from utils.logging import getLogger
+from utils.onnx_backend import ONNX_DIR, OnnxModel, check_parity, export, onnx_path, quantize
+
+logger = getLogger("EXPORT-ONNX", debug_mode=True)
+
+# sentences for the parity check; masks are placed on words that are typically selected as masks
+PARITY_TEXTS = [
+    "The movie was [MASK] and the acting was superb.",
+    "I would [MASK] recommend this film to anyone who likes [MASK] dramas.",
+    "The company reported a [MASK] increase in quarterly profits.",
+    "She walked into the [MASK] room and sat down quietly.",
+    "Scientists have discovered a new [MASK] of bacteria in the deep ocean.",
+    "The [MASK] team won the championship after a long season.",
+    "He was [MASK] by the news and could not speak for a while.",
+    "The book describes the [MASK] history of the city in great detail.",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the infill and NLI models to ONNX")
+    parser.add_argument("--model_name", type=str, default="bert-base-cased")
+    parser.add_argument("--model_ckpt", type=str, default="",
+                        help="finetuned infill model (directory or .pth); exported under this path")
+    parser.add_argument("--nli_model", type=str, default="roberta-large-mnli")
+    parser.add_argument("-export_infill", type=str2bool, default=True)
+    parser.add_argument("-export_nli", type=str2bool, default=True)
+    parser.add_argument("-quantize", type=str2bool, default=False)
+    parser.add_argument("-check_parity", type=str2bool, default=True)
+    parser.add_argument("--onnx_dir", type=str, default=ONNX_DIR)
+    return parser.parse_args()
+
+
+def load_infill_model(args):
+    model = AutoModelForMaskedLM.from_pretrained(args.model_name)
+    if args.model_ckpt.endswith(".pth"):
+        model.load_state_dict(torch.load(args.model_ckpt, map_location="cpu")["model"])
+    elif args.model_ckpt:
+        model = AutoModelForMaskedLM.from_pretrained(args.model_ckpt)
+    return model
+
+
+def export_model(model, tokenizer, name, kind, args, parity_texts):
+    path = export(model, tokenizer, onnx_path(name, kind, onnx_dir=args.onnx_dir), kind)
+    paths = [path]
+    logger.info(f"Exported {name} to {path}")
+    if args.quantize:
+        paths.append(quantize(path, onnx_path(name, kind, quantized=True, onnx_dir=args.onnx_dir)))
+        logger.info(f"Quantized {name} to {paths[-1]}")
+
+    if args.check_parity:
+        for p in paths:
+            result = check_parity(model, OnnxModel(p), tokenizer, parity_texts)
+            logger.info(f"Parity of {p}: {result['num_mismatch']}/{result['num_compared']} mismatched rankings, "
+                        f"max logit diff {result['max_logit_diff']:.2e}")
+            if result['num_mismatch'] > 0:
+                logger.info("The rankings differ from torch; watermarks embedded with this graph can not be "
+                            "extracted with the torch backend (and vice versa)")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.export_infill:
+        tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+        texts = [t.replace("[MASK]", tokenizer.mask_token) for t in PARITY_TEXTS]
+        export_model(load_infill_model(args).eval(), tokenizer, args.model_ckpt or args.model_name,
+                     "masked_lm", args, texts)
+
+    if args.export_nli:
+        # the nli models are used with the roberta-large tokenizer (see models/reward.py)
+        tokenizer = AutoTokenizer.from_pretrained('roberta-large')
+        model = AutoModelForSequenceClassification.from_pretrained(args.nli_model).eval()
+        pairs = [(t.replace("[MASK]", "good"), t.replace("[MASK]", "great")) for t in PARITY_TEXTS]
+        export_model(model, tokenizer, args.nli_model, "sequence_classification", args, pairs)
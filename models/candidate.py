@@ -0,0 +1,222 @@
+from collections import OrderedDict
+import heapq
+from itertools import islice, product
+import re
+
+import torch
+
+
+def enumerate_candidates(agg_cwi, agg_probs=None, order="product", max_candidates=0):
+    """
+    Lazily yields index tuples (one index into agg_cwi per mask) of the candidate combinations.
+    order: "product" follows itertools.product, "prob" yields combinations in descending joint probability
+    max_candidates: maximum number of combinations to yield (0 for no limit)
+    """
+    if order == "product":
+        candidates = product(*[range(len(cwi)) for cwi in agg_cwi])
+    elif order == "prob":
+        probs = [p.tolist() for p in agg_probs[:len(agg_cwi)]]
+        candidates = _enumerate_by_joint_prob(probs)
+    else:
+        raise NotImplementedError(f"Unknown candidate order {order}")
+
+    if max_candidates > 0:
+        candidates = islice(candidates, max_candidates)
+    return candidates
+
+
+def candidate_grid(agg_cwi, agg_probs=None, order="product", max_candidates=0):
+    """
+    Index tuples of enumerate_candidates as one tensor; [num_candidates, num_masks]
+    The product order is built with meshgrid instead of enumerating the combinations in python.
+    """
+    device = agg_cwi[0].device
+    if order == "product":
+        grids = torch.meshgrid(*[torch.arange(len(cwi), device=device) for cwi in agg_cwi], indexing="ij")
+        # "ij" indexing flattens in the order of itertools.product
+        indices = torch.stack([grid.reshape(-1) for grid in grids], dim=1)
+        return indices[:max_candidates] if max_candidates > 0 else indices
+    indices = list(enumerate_candidates(agg_cwi, agg_probs, order=order, max_candidates=max_candidates))
+    return torch.tensor(indices, dtype=torch.long, device=device).view(-1, len(agg_cwi))
+
+
+def gather_candidates(agg_cwi, indices, agg_probs=None):
+    """
+    indices: output of candidate_grid
+    Output: word ids of every combination [num_candidates, num_masks] and their joint probabilities
+            [num_candidates] (None without agg_probs)
+    """
+    word_ids = torch.stack([cwi[indices[:, pos]] for pos, cwi in enumerate(agg_cwi)], dim=1)
+    if agg_probs is None:
+        return word_ids, None
+    probs = torch.stack([p[indices[:, pos]] for pos, p in enumerate(agg_probs[:len(agg_cwi)])], dim=1)
+    return word_ids, probs.prod(dim=1)
+
+
+def _enumerate_by_joint_prob(probs):
+    # best-first search over the index lattice; probabilities of each mask are sorted in descending order
+    # so the successors of a combination never have a higher joint probability
+    def joint_prob(indices):
+        jp = 1.0
+        for p, i in zip(probs, indices):
+            jp *= p[i]
+        return jp
+
+    start = tuple(0 for _ in probs)
+    heap = [(-joint_prob(start), start)]
+    visited = {start}
+    while heap:
+        _, indices = heapq.heappop(heap)
+        yield indices
+        for pos in range(len(probs)):
+            if indices[pos] + 1 < len(probs[pos]):
+                successor = indices[:pos] + (indices[pos] + 1,) + indices[pos + 1:]
+                if successor not in visited:
+                    visited.add(successor)
+                    heapq.heappush(heap, (-joint_prob(successor), successor))
+
+
+class CandidateVerifier:
+    """
+    Checks whether the watermarked candidates of a sentence keep the same mask positions when re-parsed.
+    All candidates of a sentence are parsed in a single nlp.pipe batch and the results are memoized
+    by the candidate tokens, so the number of parses scales with the unique candidates.
+    """
+    def __init__(self, nlp, keyword_module, mask_selector, tokenizer, n_process=1, batch_size=64,
+                 memo_size=100000, order="product", max_candidates=0, prune=False):
+        self.nlp = nlp
+        self.keyword_module = keyword_module
+        self.mask_selector = mask_selector
+        self.tokenizer = tokenizer
+        self.n_process = n_process
+        self.batch_size = batch_size
+        self.memo_size = memo_size
+        self.order = order
+        self.max_candidates = max_candidates
+        self.prune = prune
+        self.memo = OrderedDict()
+        self.num_parsed = 0
+
+    def verify(self, sen, keyword, mask_idx, agg_cwi, agg_probs=None):
+        """
+        sen: Spacy.Doc of the original sentence
+        keyword: List[keywords(Spacy.Token)] of the original sentence
+        mask_idx: List[index of masks in Spacy tokens]
+        agg_cwi: List[candidate word ids per mask]
+        agg_probs: List[probabilities of the candidate words per mask]; only required when ordering by probability
+        Output: List[dict] for each candidate combination in the order given by enumerate_candidates
+        """
+        tokenized_text = [token.text_with_ws for token in sen]
+        if self.prune:
+            agg_cwi, agg_probs = self.prune_candidates(tokenized_text, mask_idx, agg_cwi, agg_probs)
+            if len(agg_cwi) == 0:
+                return []
+
+        # decode and substitute each candidate word once instead of once per combination
+        agg_tokens = [[self._substitute_token(tokenized_text[m_idx], self.tokenizer.decode(c_id)) for c_id in cwi]
+                      for m_idx, cwi in zip(mask_idx, agg_cwi)]
+
+        grid = candidate_grid(agg_cwi, agg_probs, order=self.order, max_candidates=self.max_candidates)
+        word_ids, _ = gather_candidates(agg_cwi, grid)
+        candidates = []
+        for indices, cwi in zip(grid.tolist(), word_ids.unbind()):
+            wm_text = tokenized_text.copy()
+            for pos, i in enumerate(indices):
+                wm_text[mask_idx[pos]] = agg_tokens[pos][i]
+            candidates.append((cwi.unbind(), tuple(wm_text)))
+
+        parsed_candidates = self._parse([key for _, key in candidates])
+
+        keyword_text = set([x.text for x in keyword])
+        outputs = []
+        for cwi, key in candidates:
+            parsed = parsed_candidates[key]
+            outputs.append({'cwi': cwi,
+                            'text': parsed['text'],
+                            'tokens': parsed['tokens'],
+                            'tokens_with_ws': parsed['tokens_with_ws'],
+                            'kwd_match': parsed['keyword'] == keyword_text,
+                            'mask_match': self._mask_match(parsed, mask_idx)})
+        return outputs
+
+    def prune_candidates(self, tokenized_text, mask_idx, agg_cwi, agg_probs=None):
+        """
+        Drops candidate words that already change the mask indices when substituted alone.
+        The other masks hold a fixed reference word instead of the words of the sentence, because those are
+        the original words when embedding but the watermarked words when extracting; the references only depend
+        on agg_cwi, so embedding and extraction prune alike. The reference of each mask is its first candidate,
+        or its first candidate that passes if that one fails, so that a bad reference does not reject the words
+        of the other masks. A mask where no word passes keeps all of its candidates (the full combinations decide).
+        """
+        if any(len(cwi) == 0 for cwi in agg_cwi):
+            return [], []
+        words = [[self.tokenizer.decode(c_id) for c_id in cwi] for cwi in agg_cwi]
+        reference = [0] * len(agg_cwi)
+        keep = self._prune_against(tokenized_text, mask_idx, words, reference)
+        passing_reference = [pos_keep[0] if pos_keep else 0 for pos_keep in keep]
+        if passing_reference != reference:
+            keep = self._prune_against(tokenized_text, mask_idx, words, passing_reference)
+
+        pruned_cwi, pruned_probs = [], []
+        for pos, pos_keep in enumerate(keep):
+            if len(pos_keep) == 0:
+                pos_keep = list(range(len(agg_cwi[pos])))
+            pruned_cwi.append(agg_cwi[pos][pos_keep])
+            if agg_probs is not None:
+                pruned_probs.append(agg_probs[pos][pos_keep])
+        return pruned_cwi, pruned_probs if agg_probs is not None else None
+
+    def _prune_against(self, tokenized_text, mask_idx, words, reference):
+        # Output: indices of the words of each mask that keep the mask indices when the other masks hold reference
+        reference_words = [pos_words[r_idx] for pos_words, r_idx in zip(words, reference)]
+        keys = []
+        for pos, pos_words in enumerate(words):
+            keys.append([self._substitute(tokenized_text, mask_idx[:len(words)],
+                                          reference_words[:pos] + [word] + reference_words[pos + 1:])
+                         for word in pos_words])
+        parsed = self._parse([key for pos_keys in keys for key in pos_keys])
+        return [[i for i, key in enumerate(pos_keys) if self._mask_match(parsed[key], mask_idx)]
+                for pos_keys in keys]
+
+    def _substitute(self, tokenized_text, mask_idx, words):
+        wm_text = tokenized_text.copy()
+        for m_idx, word in zip(mask_idx, words):
+            wm_text[m_idx] = self._substitute_token(wm_text[m_idx], word)
+        return tuple(wm_text)
+
+    @staticmethod
+    def _substitute_token(token_with_ws, word):
+        # keeps the trailing whitespace of the token
+        return re.sub(r"\S+", word, token_with_ws)
+
+    def _mask_match(self, parsed, mask_idx):
+        return parsed['num_mask'] > 0 and set(parsed['mask_idx']) == set(mask_idx)
+
+    def _parse(self, keys):
+        parsed = {}
+        for key in keys:
+            if key in self.memo:
+                self.memo.move_to_end(key)
+                parsed[key] = self.memo[key]
+        new_keys = list(OrderedDict.fromkeys(key for key in keys if key not in parsed))
+        if not new_keys:
+            return parsed
+
+        texts = ["".join(key).strip() for key in new_keys]
+        docs = list(self.nlp.pipe(texts, n_process=self.n_process, batch_size=self.batch_size))
+        self.num_parsed += len(docs)
+        wm_keywords, wm_ent_keywords = self.keyword_module.extract_keyword(docs)
+
+        wm_masks = self.mask_selector.return_mask_batch(docs, wm_keywords, wm_ent_keywords)
+        for key, doc, wm_kwd, (wm_mask_idx, wm_mask) in zip(new_keys, docs, wm_keywords, wm_masks):
+            parsed[key] = {'text': doc.text,
+                           'tokens': [t.text for t in doc],
+                           'tokens_with_ws': [t.text_with_ws for t in doc],
+                           'keyword': set([x.text for x in wm_kwd]),
+                           'mask_idx': wm_mask_idx,
+                           'num_mask': len(wm_mask)}
+            self.memo[key] = parsed[key]
+
+        while len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+        return parsed
@@ -27,7 +27,9 @@ if args.augment:
     corpus, _, numsample2use = get_dataset(dtype)
     cover_texts = preprocess_txt(corpus)
     cover_texts = preprocess2sentence(cover_texts, dtype + "-train", 0, numsample2use['train'],
-                                      spacy_model=wm_args.spacy_model)
+                                      spacy_model=wm_args.spacy_model,
+                                      batch_size=wm_args.preprocess_batch_size,
+                                      n_process=wm_args.preprocess_n_process)
     attacker.augment_data(cover_texts)
 
 elif method == "awt":
@@ -16,7 +16,7 @@ import tensorflow as tf
 import transformers
 from tqdm.auto import tqdm
 
-from utils.dataset_utils import get_result_txt
+from utils.result_store import load_result
 from utils.logging import getLogger
 
 
@@ -112,7 +112,7 @@ class Attacker:
     def attack_sentence(self, attack_all_samples=True, texts=None):
         s_time = time.time()
         if texts is None:
-            texts = get_result_txt(self.path2txt)
+            texts = load_result(self.path2txt)
         skipped_cnt = 0
         attacked_cnt = 0
         for idx, (c_idx, sen_idx, sub_idset, sub_idx, wm_sen, key, msg) in enumerate(tqdm(texts)):
@@ -0,0 +1,79 @@
+import os
+
+import torch
+
+
+# state of a worker process; set by init_worker
+_worker = {}
+
+
+def embed_sentences(sentences, spacy_tokenizer, model, verifier):
+    """
+    Valid watermarked candidates of the sentences of a document. The message is not chosen here,
+    so the same function serves the serial loop and the worker processes of ours.py.
+    sentences: List[str] sentences of a document
+    Output: List[dict] for each sentence
+    """
+    call_to_lm, num_parsed = model.call_to_lm, verifier.num_parsed
+    sentences = list(spacy_tokenizer.pipe(sentences))
+    # infill all sentences of the sample in batches
+    processed = model.process_sentences(sentences, embed_flag=True)
+
+    results = []
+    for sen, (keyword, ent_keyword, agg_cwi, agg_probs, tokenized_pt, (mask_idx_pt, mask_idx, mask_word)) \
+            in zip(sentences, processed):
+        result = {'text': sen.text,
+                  'original_text': "".join([token.text_with_ws for token in sen]),
+                  'mask_idx': mask_idx,
+                  'valid_watermarks': [],
+                  'valid_tokens': [],
+                  'kwd_match_cnt': 0,
+                  'mask_match_cnt': 0,
+                  'sample_cnt': 0}
+
+        if len(agg_cwi) > 0:
+            # parse and verify all candidates of the sentence at once
+            for candidate in verifier.verify(sen, keyword, mask_idx, agg_cwi, agg_probs):
+                if candidate['kwd_match']:
+                    result['kwd_match_cnt'] += 1
+
+                # checking whether the watermark can be embedded without the assumption of corruption
+                if candidate['mask_match']:
+                    result['valid_watermarks'].append(candidate['text'])
+                    result['valid_tokens'].append(candidate['tokens'])
+                    result['mask_match_cnt'] += 1
+                result['sample_cnt'] += 1
+        results.append(result)
+
+    # counters of the worker are reported back with every document
+    if results:
+        results[0]['call_to_lm'] = model.call_to_lm - call_to_lm
+        results[0]['num_parsed'] = verifier.num_parsed - num_parsed
+    return results
+
+
+def init_worker(spacy_tokenizer, model, verifier, num_threads=0):
+    """
+    Workers are forked after the models are loaded, so they share the weights of the main process
+    (copy-on-write) instead of loading their own replicas.
+    """
+    if num_threads > 0:
+        # split the cores among the workers instead of oversubscribing them
+        torch.set_num_threads(num_threads)
+    # daemonic workers can not start the parser processes of nlp.pipe
+    verifier.n_process = 1
+    if model.sentence_cache:
+        # sqlite connections must not be shared across processes; the worker commits every write
+        model.sentence_cache.reconnect()
+    _worker.update(spacy_tokenizer=spacy_tokenizer, model=model, verifier=verifier)
+
+
+def embed_document(sentences):
+    return embed_sentences(sentences, _worker['spacy_tokenizer'], _worker['model'], _worker['verifier'])
+
+
+def worker_threads(num_workers, num_threads=0):
+    # threads per worker unless the number of threads is given
+    if num_threads > 0:
+        return num_threads
+    return max(1, (os.cpu_count() or 1) // num_workers)
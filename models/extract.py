@@ -0,0 +1,252 @@
+import glob
+import math
+import os
+
+import torch
+
+from models.embed import _worker, init_worker as init_embed_worker
+from utils.checkpoint import Checkpoint
+from utils.logging import getLogger
+from utils.misc import compute_ber
+
+COUNTERS = ['num_sentence', 'sentence_err_cnt', 'sentence_cnt', 'infill_match_cnt', 'midx_match_cnt',
+            'mword_match_cnt', 'kwd_match_cnt', 'num_mask_match_cnt', 'one_cnt', 'zero_cnt']
+
+
+def corrupted_files(patterns):
+    """
+    patterns: List[path or glob pattern] of corrupted files (e.g. watermarked-*=0.025.txt)
+    Output: List[path] without duplicates in the given order
+    """
+    files = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for path in matched:
+            if path not in files:
+                files.append(path)
+    return files
+
+
+def corruption_type(path):
+    # watermarked-{attack type}={attack pct}.txt
+    return os.path.basename(path).split("-")[1]
+
+
+def read_corrupted(path):
+    corrupted_watermarked = []
+    with open(path, "r") as reader:
+        for line in reader:
+            corrupted_watermarked.append(line.split("[sep] "))
+    return corrupted_watermarked
+
+
+def _summarize(processed):
+    keyword, ent_keyword, agg_cwi, agg_probs, tokenized_pt, (mask_idx_pt, mask_idx, mask_word) = processed
+    return {'keyword': set([x.text for x in keyword]),
+            'mask_idx': set(mask_idx),
+            'mask_word': set([m.text for m in mask_word]),
+            'num_mask': len(mask_idx),
+            'agg_cwi': agg_cwi}
+
+
+def clean_states(clean_watermarked, spacy_tokenizer, model, num_rows=None, batch_size=64,
+                 verifier=None, message_source=None):
+    """
+    States (keywords, masks and infilled candidates) of the uncorrupted watermarked texts.
+    They do not depend on the corruption, so they are computed once for all corrupted files.
+    clean_watermarked: ResultStore of watermarked.txt (see utils.result_store.load_result)
+    num_rows: number of leading rows to process (all rows if None)
+    message_source: if given (with verifier), the embedded messages are recomputed from the source
+                    to verify watermarked.txt, whose messages stay the reference of the BER (see models.message)
+    Output: List[dict] for each row
+    """
+    text_column = clean_watermarked.column('text')
+    num_rows = len(text_column) if num_rows is None else min(num_rows, len(text_column))
+    texts = [text_column[idx].strip() for idx in range(num_rows)]
+    states = []
+    for start in range(0, len(texts), batch_size):
+        sens = list(spacy_tokenizer.pipe(texts[start:start + batch_size]))
+        for sen, processed in zip(sens, model.process_sentences(sens, embed_flag=True)):
+            state = _summarize(processed)
+            if message_source is not None:
+                state['message'] = _expected_message(clean_watermarked, len(states), sen, processed,
+                                                     verifier, message_source)
+            states.append(state)
+    return states
+
+
+def _expected_message(clean_watermarked, idx, sen, processed, verifier, message_source):
+    # the watermarked text has the same valid candidates as its original text, otherwise it can not be extracted
+    keyword, ent_keyword, agg_cwi, agg_probs, tokenized_pt, (mask_idx_pt, mask_idx, mask_word) = processed
+    num_valid = 0
+    if len(agg_cwi) > 0:
+        num_valid = sum(candidate['mask_match'] for candidate in
+                        verifier.verify(sen, keyword, mask_idx, agg_cwi, agg_probs))
+    if num_valid <= 1:
+        return []
+    c_idx = int(clean_watermarked.column('corpus_idx')[idx])
+    s_idx = int(clean_watermarked.column('sentence_idx')[idx])
+    return message_source.message(c_idx, s_idx, num_valid)
+
+
+def extract_sentences(wm_texts, clean, msg, spacy_tokenizer, model, verifier):
+    """
+    Extracts the message of each (corrupted) variant of a watermarked sentence
+    wm_texts: List[str] variants of the sentence
+    clean: state of the uncorrupted sentence (see clean_states)
+    msg: List[int] embedded message
+    Output: dict of the counters (see COUNTERS) over the variants
+    """
+    counts = dict.fromkeys(COUNTERS, 0)
+    sens = list(spacy_tokenizer.pipe([wm_text.strip() for wm_text in wm_texts]))
+    for sen, processed in zip(sens, model.process_sentences(sens, embed_flag=True)):
+        counts['num_sentence'] += 1
+        keyword, ent_keyword, agg_cwi, agg_probs, tokenized_pt, (mask_idx_pt, mask_idx, mask_word) = processed
+        wm_keys = model.tokenizer(" ".join([t.text for t in mask_word]), add_special_tokens=False)['input_ids']
+
+        state = _summarize(processed)
+        counts['kwd_match_cnt'] += state['keyword'] == clean['keyword']
+        counts['midx_match_cnt'] += state['mask_idx'] == clean['mask_idx']
+        counts['mword_match_cnt'] += state['mask_word'] == clean['mask_word']
+        counts['num_mask_match_cnt'] += state['num_mask'] == clean['num_mask']
+
+        infill_match_list = []
+        if len(agg_cwi) == len(clean['agg_cwi']):
+            for a, b in zip(agg_cwi, clean['agg_cwi']):
+                infill_match_list.append(len(a) == len(b) and bool((a == b).all()))
+        else:
+            infill_match_list.append(False)
+        counts['infill_match_cnt'] += all(infill_match_list)
+
+        valid_keys = []
+        if len(agg_cwi) > 0:
+            for candidate in verifier.verify(sen, keyword, mask_idx, agg_cwi, agg_probs):
+                # checking whether the watermark can be embedded
+                if candidate['mask_match']:
+                    valid_keys.append(torch.stack(candidate['cwi']).tolist())
+
+        extracted_msg = []
+        if len(valid_keys) > 1:
+            try:
+                extracted_msg_decimal = valid_keys.index(wm_keys)
+            except ValueError:
+                similarity = [len(set(wm_keys).intersection(x)) for x in valid_keys]
+                similar_key = max(zip(valid_keys, similarity), key=lambda x: x[1])[0]
+                extracted_msg_decimal = valid_keys.index(similar_key)
+
+            num_digit = math.ceil(math.log2(len(valid_keys)))
+            extracted_msg = format(extracted_msg_decimal, f"0{num_digit}b")
+            extracted_msg = list(map(int, extracted_msg))
+
+        counts['one_cnt'] += sum(msg)
+        counts['zero_cnt'] += len(msg) - sum(msg)
+
+        error_cnt, cnt = compute_ber(msg, extracted_msg)
+        counts['sentence_err_cnt'] += error_cnt
+        counts['sentence_cnt'] += cnt
+    return counts
+
+
+def extract_file(corrupted_path, clean_watermarked, clean, spacy_tokenizer, model, verifier, logger=None,
+                 checkpoint=None, state=None, checkpoint_every=10):
+    """
+    corrupted_path: corrupted file created by models/corruption/attack.py; the clean texts are extracted if empty
+    clean: output of clean_states for clean_watermarked
+    checkpoint: utils.checkpoint.Checkpoint of the file; the progress is saved every checkpoint_every rows
+    state: loaded checkpoint to continue from
+    Output: dict of the counters (see COUNTERS) over the file
+    """
+    corrupted_watermarked = read_corrupted(corrupted_path) if corrupted_path else None
+    counts = dict.fromkeys(COUNTERS, 0)
+    start_idx = 0
+    if state is not None:
+        counts.update(state['counts'])
+        start_idx = state['idx']
+        if state['done']:
+            return counts
+        if logger:
+            logger.info(f"Resuming {corrupted_path or 'clean extraction'} from row {start_idx}")
+
+    num_rows = min(len(clean_watermarked), len(clean))
+    for idx in range(start_idx, num_rows):
+        c_idx, sen_idx, sub_idset, sub_idx, clean_wm_text, key, msg = clean_watermarked[idx]
+        if corrupted_watermarked is None:
+            wm_texts = [clean_wm_text.strip()]
+        elif idx < len(corrupted_watermarked):
+            wm_texts = corrupted_watermarked[idx]
+        else:
+            if logger:
+                logger.debug("Create corrupted samples is less than watermarked. Ending extraction...")
+            break
+
+        if logger:
+            logger.info(f"{c_idx} {sen_idx}")
+        for k, v in extract_sentences(wm_texts, clean[idx], msg, spacy_tokenizer, model, verifier).items():
+            counts[k] += v
+        if logger and counts['sentence_cnt']:
+            logger.info(f"BER: {counts['sentence_err_cnt']}/{counts['sentence_cnt']}="
+                        f"{counts['sentence_err_cnt'] / counts['sentence_cnt']:.3f}")
+
+        if checkpoint is not None and (idx + 1) % checkpoint_every == 0:
+            if model.sentence_cache:
+                model.sentence_cache.commit()
+            checkpoint.save({'idx': idx + 1, 'counts': counts, 'done': False})
+
+    if checkpoint is not None:
+        checkpoint.save({'idx': num_rows, 'counts': counts, 'done': True})
+    return counts
+
+
+def file_checkpoint(dirname, corrupted_path, config=None):
+    # one checkpoint per corrupted file, so that the workers do not write the same file
+    name = os.path.splitext(os.path.basename(corrupted_path))[0] if corrupted_path else "clean"
+    return Checkpoint(os.path.join(dirname, f"checkpoint-extract-{name}.json"), config=config)
+
+
+def match_rates(counts):
+    num_sentence = max(counts['num_sentence'], 1)
+    return {'ber': counts['sentence_err_cnt'] / max(counts['sentence_cnt'], 1),
+            'infill': counts['infill_match_cnt'] / num_sentence,
+            'midx': counts['midx_match_cnt'] / num_sentence,
+            'mword': counts['mword_match_cnt'] / num_sentence,
+            'kwd': counts['kwd_match_cnt'] / num_sentence,
+            'num_mask': counts['num_mask_match_cnt'] / num_sentence}
+
+
+def write_ber(ber_path, corrupted_path, counts, rates=("infill", "midx", "mword", "kwd", "num_mask")):
+    # the first two columns are the same as before (file, BER); the given match rates are appended
+    all_rates = match_rates(counts)
+    with open(ber_path, "a") as wr:
+        wr.write(f"{corrupted_path}\t {all_rates['ber']}\t" +
+                 "\t".join(f"{k}={all_rates[k]}" for k in rates) + "\n")
+
+
+def file_logger(log_dir, corrupted_path, debug_mode=False):
+    # the workers extract files concurrently, so each file gets its own log (e.g. EXTRACT-insertion=0.025)
+    name = os.path.splitext(os.path.basename(corrupted_path))[0].split("-", 1)[-1]
+    return getLogger(f"EXTRACT-{name}", dir_=log_dir, debug_mode=debug_mode)
+
+
+def init_worker(spacy_tokenizer, model, verifier, clean_watermarked, clean, num_threads=0,
+                checkpoint_dir=None, checkpoint_config=None, resume=False, checkpoint_every=10,
+                log_dir=None, debug_mode=False):
+    """
+    Forked workers inherit the clean states computed by the main process (see models.embed.init_worker)
+    log_dir: directory of the per-file logs (see file_logger); nothing is logged if None
+    """
+    init_embed_worker(spacy_tokenizer, model, verifier, num_threads)
+    _worker.update(clean_watermarked=clean_watermarked, clean=clean, checkpoint_dir=checkpoint_dir,
+                   checkpoint_config=checkpoint_config, resume=resume, checkpoint_every=checkpoint_every,
+                   log_dir=log_dir, debug_mode=debug_mode)
+
+
+def extract_corrupted_file(corrupted_path):
+    checkpoint, state = None, None
+    if _worker['checkpoint_dir']:
+        checkpoint = file_checkpoint(_worker['checkpoint_dir'], corrupted_path, _worker['checkpoint_config'])
+        state = checkpoint.load() if _worker['resume'] else None
+    logger = file_logger(_worker['log_dir'], corrupted_path, _worker['debug_mode']) if _worker['log_dir'] else None
+    counts = extract_file(corrupted_path, _worker['clean_watermarked'], _worker['clean'],
+                          _worker['spacy_tokenizer'], _worker['model'], _worker['verifier'], logger=logger,
+                          checkpoint=checkpoint, state=state, checkpoint_every=_worker['checkpoint_every'])
+    return corrupted_path, counts
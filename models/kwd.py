@@ -33,6 +33,15 @@ class KeywordExtractor:
         for k, v in args.items():
             self.args[k] = v
 
+        # the extractor only holds its configuration, so it is shared across sentences
+        self.yake_extractor = yake.KeywordExtractor(**self.yake_kwargs, top=20)
+        self.tfidf = None
+        self.tfidf_features = None
+        self.scorer = self.args.get('scorer', 'yake')
+        # scorers map a list of sentences to List[List[token, score]] per sentence
+        self.scorers = {'yake': lambda sentences: [self._extract_yake_kwd(sen) for sen in sentences],
+                        'tfidf': self._extract_tfidf_kwd}
+
     def extract_keyword(self, sentences):
         """
         Input
@@ -40,38 +49,51 @@ class KeywordExtractor:
          - tokenizer: tokenizer used in NLI to account for truncation
         Output: List[keywords(Spacy.Token) per sentences]
         """
-        all_keywords = []
-        entity_keywords = []
-        for sen_idx, sen in enumerate(sentences):
-            kwd_per_sentence = []
-            punct_removed = [token.text for token in sen if not token.is_punct]
-            num_kwd = max(1, int(self.args['ratio'] * len(punct_removed)))
-
-            # List[(Token, IOB to determine redundant or not)]
-            entity_kwd = self._extract_entity(sen)
-            entity_keywords.append([ent[0] for ent in entity_kwd])
-            idx = 0
-            while len(entity_kwd) > idx and len(kwd_per_sentence) < num_kwd:
-                kwd_per_sentence.append(entity_kwd[idx][0])
-                if entity_kwd[idx][1] == "I":
-                    num_kwd += 1
-                idx += 1
-
-            # both has the format List[token, score]
-            yake_kwd = self._extract_yake_kwd(sen)
-            yake_kwd = [s[0] for s in yake_kwd]
-            # tfidf_kwd = tfidf_keywords[sen_idx]
-            # tfidf_kwd = []
-            # kwd = self._normalize_scores(yake_kwd)
-
-            idx = 0
-            while len(yake_kwd) > idx and len(kwd_per_sentence) < num_kwd:
-                kwd_per_sentence.append(yake_kwd[idx])
-                idx += 1
-
-            all_keywords.append(kwd_per_sentence)
-
-        return all_keywords, entity_keywords
+        return self.extract_keyword_batch([sentences])[0]
+
+    def extract_keyword_batch(self, documents):
+        """
+        Input
+         - documents: (list[list[Spacy.Span]]) sentences of each document
+        Output: List[(all_keywords, entity_keywords) per document] as in extract_keyword
+        """
+        flattened = [sen for sentences in documents for sen in sentences]
+        scored_kwd = self.scorers[self.scorer](flattened)
+
+        outputs = []
+        offset = 0
+        for sentences in documents:
+            all_keywords = []
+            entity_keywords = []
+            for sen_idx, sen in enumerate(sentences):
+                kwd_per_sentence = []
+                punct_removed = [token.text for token in sen if not token.is_punct]
+                num_kwd = max(1, int(self.args['ratio'] * len(punct_removed)))
+
+                # List[(Token, IOB to determine redundant or not)]
+                entity_kwd = self._extract_entity(sen)
+                entity_keywords.append([ent[0] for ent in entity_kwd])
+                idx = 0
+                while len(entity_kwd) > idx and len(kwd_per_sentence) < num_kwd:
+                    kwd_per_sentence.append(entity_kwd[idx][0])
+                    if entity_kwd[idx][1] == "I":
+                        num_kwd += 1
+                    idx += 1
+
+                # both has the format List[token, score]
+                scorer_kwd = [s[0] for s in scored_kwd[offset + sen_idx]]
+                # kwd = self._normalize_scores(yake_kwd)
+
+                idx = 0
+                while len(scorer_kwd) > idx and len(kwd_per_sentence) < num_kwd:
+                    kwd_per_sentence.append(scorer_kwd[idx])
+                    idx += 1
+
+                all_keywords.append(kwd_per_sentence)
+            offset += len(sentences)
+            outputs.append((all_keywords, entity_keywords))
+
+        return outputs
 
     def _normalize_scores(self, *scores):
         normalized_kwd = []
@@ -84,15 +106,15 @@ class KeywordExtractor:
     def _extract_yake_kwd(self, sentence):
         output = []
         sen_text = sentence.text
-        kw_extractor = yake.KeywordExtractor(**self.yake_kwargs, top=20)
-        keyword = kw_extractor.extract_keywords(sen_text)  # list  of (phrase: score)
-        keyword_list = [k[0] for k in keyword]
+        keyword = self.yake_extractor.extract_keywords(sen_text)  # list  of (phrase: score)
+        # keep the score of the first occurrence of each phrase
+        keyword_dict = {}
+        for k, score in keyword:
+            keyword_dict.setdefault(k, score)
 
         for token in sentence:
-            if token.text in keyword_list and token.pos_ in ["NOUN", "PROPN"]:
-                idx = keyword_list.index(token.text)
-                output.append([token, keyword[idx][1]])
-                keyword_list.remove(token.text)
+            if token.text in keyword_dict and token.pos_ in ["NOUN", "PROPN"]:
+                output.append([token, keyword_dict.pop(token.text)])
         return output
 
     def _extract_entity(self, sentence):
@@ -103,26 +125,37 @@ class KeywordExtractor:
 
         return extracted
 
-    def _extract_tfidf(self, sentences):
-        from datasets import load_dataset
-
-        output = []
-        sample = load_dataset("imdb")['train']['text'][0]
-        nlp = spacy.load("en_core_web_sm")
-        sentences = [s for s in nlp(sample).sents]
+    def fit_tfidf(self, sentences):
+        """
+        Fit the TF-IDF vectorizer on a fixed corpus of sentences (List[Spacy.Span]).
+        The same corpus must be used when embedding and extracting so that the keywords match.
+        """
         input2vectorizer = [[token.text for token in sent] for sent in sentences]
+        self.tfidf = TfidfVectorizer(analyzer=lambda x: [w for w in x if w not in stop])
+        self.tfidf.fit(input2vectorizer)
+        self.tfidf_features = {f: idx for idx, f in enumerate(self.tfidf.get_feature_names_out())}
+        return self
 
-        tfidf = TfidfVectorizer(analyzer=lambda x: [w for w in x if w not in stop])
-        tfidf_vectors = tfidf.fit_transform(input2vectorizer)
-        # indptr = tfidf_vectors.indptr
-        # indices = tfidf_vectors.indices
-        # data = tfidf_vectors.data
-
-        tfidf_vectors = tfidf_vectors.todense()
-        features = tfidf.get_feature_names_out()
-        # for row in tfidf_vectors:
+    def _extract_tfidf_kwd(self, sentences, top=20):
+        """
+        Same format as _extract_yake_kwd for a list of sentences: the top-scored nouns and proper nouns
+        of each sentence in the order they appear
+        """
+        assert self.tfidf is not None, "Call fit_tfidf before extracting keywords with tfidf"
+        # score all sentences with a single sparse matrix product
+        tfidf_vectors = self.tfidf.transform([[token.text for token in sent] for sent in sentences]).tocsr()
 
-        return
+        output = []
+        for row, sen in enumerate(tfidf_vectors):
+            scores = dict(zip(sen.indices, sen.data))
+            candidates = {}
+            for token in sentences[row]:
+                feature_idx = self.tfidf_features.get(token.text)
+                if feature_idx in scores and token.pos_ in ["NOUN", "PROPN"]:
+                    candidates.setdefault(token.text, (token, scores[feature_idx]))
+            top_kwd = set(sorted(candidates, key=lambda k: candidates[k][1], reverse=True)[:top])
+            output.append([[token, score] for text, (token, score) in candidates.items() if text in top_kwd])
+        return output
 
 
 
@@ -1,6 +1,9 @@
+from collections import defaultdict
 import random
 from string import punctuation
 
+punct_set = set(punctuation)
+
 class MaskSelector:
     def __init__(self, **kwargs):
         self.kwargs = {}
@@ -8,7 +11,7 @@ class MaskSelector:
             self.kwargs[k] = v
 
         self.num_max_mask = []
-        self.custom_keywords = kwargs.get("custom_keywords", [])
+        self.custom_keywords = set(kwargs.get("custom_keywords") or [])
         self.dep_ordering = ['expl', 'cc', 'auxpass', 'agent', 'mark', 'aux', 'prep', 'det', 'prt', 'intj', 'parataxis',
                              'predet', 'case', 'csubj', 'acl', 'advcl', 'ROOT', 'preconj', 'ccomp', 'relcl', 'advmod',
                              'dative', 'xcomp', 'pcomp', 'nsubj', 'quantmod', 'conj', 'nsubjpass', 'punct', 'poss',
@@ -36,44 +39,55 @@ class MaskSelector:
         elif self.kwargs['method'] == "grammar":
             return self.grammar_component(sen, keyword, ent_keyword, ordering_by=self.kwargs['mask_order_by'])
 
+    def return_mask_batch(self, sens, keywords, ent_keywords):
+        """
+        sens: List[Spacy.Span]
+        keywords, ent_keywords: List[List[Spacy tokens]] per sentence
+        Output: List[(mask_idx, mask_word)]
+        """
+        return [self.return_mask(sen, keyword, ent_keyword)
+                for sen, keyword, ent_keyword in zip(sens, keywords, ent_keywords)]
+
     def keyword_connected(self, sen, keyword, ent_keyword, type="adjacent"):
         mask_word = []
         mask_idx = []
+        if len(sen) == 0:
+            # e.g. a sentence emptied by a deletion attack
+            return mask_idx, mask_word
+        excluded = self._token_index_set(sen[0].doc, keyword, ent_keyword)
 
         if type == "adjacent":
             offset = sen[0].i
             for k in keyword:
                 if k.i - offset < len(sen) - 1:
                     mask_cand = sen[k.i - offset + 1]
-                    if self._check_mask_candidate(mask_cand, mask_word, keyword, ent_keyword):
+                    if self._is_valid_candidate(mask_cand, excluded):
                         mask_word.append(mask_cand)
                         mask_idx.append(mask_cand.i)
+                        excluded.add(mask_cand.i)
 
         elif type == "child":
             for k in keyword:
                 mask_candidates = list(k.children)
                 # mask_candidates = mask_candidates[:1]
                 for mask_cand in mask_candidates:
-                    if self._check_mask_candidate(mask_cand, mask_word, keyword, ent_keyword):
+                    if self._is_valid_candidate(mask_cand, excluded):
                         mask_word.append(mask_cand)
                         mask_idx.append(mask_cand.i)
+                        excluded.add(mask_cand.i)
                         break
 
         elif type == "child_dep":
             mask_candidates = []
             for k in keyword:
                 connected_components = list(k.children)
-                dep_in_sentence = [t.dep_ for t in connected_components]
-                for d in self.dep_ordering:
-                    if d in dep_in_sentence:
-                        indices = [idx for idx, dep in enumerate(dep_in_sentence) if dep == d]
-                        for idx in indices:
-                            mask_candidates.append(connected_components[idx])
+                mask_candidates.extend(self._order_by_label(connected_components, self.dep_ordering, "dep"))
                 # mask_candidates = mask_candidates
                 for mask_cand in mask_candidates:
-                    if self._check_mask_candidate(mask_cand, mask_word, keyword, ent_keyword):
+                    if self._is_valid_candidate(mask_cand, excluded):
                         mask_word.append(mask_cand)
                         mask_idx.append(mask_cand.i)
+                        excluded.add(mask_cand.i)
                         break
 
         mask_word = [x[1] for x in sorted(zip(mask_idx, mask_word), key= lambda x: x[0])]
@@ -87,23 +101,20 @@ class MaskSelector:
         max_mask_cnt = len(keyword)
         mask_word = []
         mask_idx = []
-        dep_in_sentence = [t.dep_ for t in sen] if ordering_by == "dep" else \
-                            [t.pos_ for t in sen]
-        mask_candidates = []
+        if len(sen) == 0:
+            return mask_idx, mask_word
+        excluded = self._token_index_set(sen[0].doc, keyword, ent_keyword)
 
         ordering = self.dep_ordering if ordering_by == "dep" else self.pos_ordering
-        for d in ordering:
-            if d in dep_in_sentence:
-                indices = [idx for idx, dep in enumerate(dep_in_sentence) if dep == d]
-                for idx in indices:
-                    mask_candidates.append(sen[idx])
+        mask_candidates = self._order_by_label(sen, ordering, ordering_by)
 
         if mask_candidates:
             mask_candidates = mask_candidates
             for m_cand in mask_candidates:
-                if self._check_mask_candidate(m_cand, mask_word, keyword, ent_keyword):
+                if self._is_valid_candidate(m_cand, excluded):
                     mask_word.append(m_cand)
                     mask_idx.append(m_cand.i)
+                    excluded.add(m_cand.i)
                     if len(mask_word) == max_mask_cnt:
                         break
 
@@ -114,45 +125,53 @@ class MaskSelector:
 
         return mask_idx, mask_word
 
+    def _order_by_label(self, tokens, ordering, ordering_by="dep"):
+        # build label -> positions in a single pass and read them out in the given ordering
+        label2positions = defaultdict(list)
+        for idx, t in enumerate(tokens):
+            label2positions[t.dep_ if ordering_by == "dep" else t.pos_].append(idx)
+        return [tokens[idx] for d in ordering for idx in label2positions.get(d, [])]
+
+    def _token_index_set(self, doc, *token_lists):
+        # spacy tokens are equal only if they share the doc and the position
+        return set(t.i for tokens in token_lists for t in tokens if t.doc is doc)
+
+    def _is_valid_candidate(self, mask_cand, excluded):
+        """
+        excluded: set of token indices of keywords, entity keywords and the already chosen masks
+        """
+        return mask_cand.i not in excluded and not mask_cand.is_punct and not mask_cand.pos_ == "PART" \
+            and punct_set.isdisjoint(mask_cand.text) and mask_cand.text not in self.custom_keywords
+
     def _check_mask_candidate(self, mask_cand, mask_word, keyword=[], ent_keyword=[],
                                     keyword_ablate=False):
-        def _contains_punct(mask_cand):
-            return any(p in mask_cand.text for p in punctuation)
-
         if keyword_ablate:
-            if mask_cand not in ent_keyword and not mask_cand.is_punct and not mask_cand.pos_ == "PART" \
-                    and not _contains_punct(mask_cand):
+            if mask_cand.i not in self._token_index_set(mask_cand.doc, ent_keyword) and not mask_cand.is_punct \
+                    and not mask_cand.pos_ == "PART" and punct_set.isdisjoint(mask_cand.text):
                 return True
             else:
                 return False
 
-        if mask_cand not in keyword and mask_cand not in mask_word \
-                and mask_cand not in ent_keyword and not mask_cand.is_punct and not mask_cand.pos_ == "PART"\
-                and not _contains_punct(mask_cand) and mask_cand.text not in self.custom_keywords:
-            return True
-        else:
-            return False
+        return self._is_valid_candidate(mask_cand, self._token_index_set(mask_cand.doc, keyword, ent_keyword,
+                                                                         mask_word))
 
     def keyword_disconnected(self, sen, keyword, ent_keyword):
         max_mask_cnt = len(keyword)
         self.num_max_mask.append(max_mask_cnt)
         mask_word = []
         mask_idx = []
-        dep_in_sentence = [t.dep_ for t in sen]
-        mask_candidates = []
-
-        for d in self.dep_ordering:
-            if d in dep_in_sentence:
-                indices = [idx for idx, dep in enumerate(dep_in_sentence) if dep == d]
-                for idx in indices:
-                    mask_candidates.append(sen[idx])
+        if len(sen) == 0:
+            return mask_idx, mask_word
+        excluded = self._token_index_set(sen[0].doc, keyword, ent_keyword)
+        mask_candidates = self._order_by_label(sen, self.dep_ordering, "dep")
 
         if mask_candidates:
             mask_candidates = mask_candidates[:max_mask_cnt]
             for m_cand in mask_candidates:
-                if self._check_mask_candidate(m_cand, mask_word, keyword, ent_keyword):
+                if self._is_valid_candidate(m_cand, excluded):
                     mask_word.append(m_cand)
                     mask_idx.append(m_cand.i)
+                    excluded.add(m_cand.i)
                     if len(mask_word) >= max_mask_cnt:
                         break
 
@@ -0,0 +1,123 @@
+import hashlib
+import hmac
+import math
+import random
+
+from utils.checkpoint import rng_state, set_rng_state
+
+MESSAGE_SOURCES = ['random', 'keyed', 'bitstream']
+
+
+def to_binary(decimal, num_candidates):
+    # message bits of the index of the chosen watermark, as written to watermarked.txt
+    num_digit = math.ceil(math.log2(num_candidates))
+    return list(map(int, format(decimal, f"0{num_digit}b")))
+
+
+class MessageSource:
+    """
+    Chooses which of the valid watermarked candidates of a sentence is embedded.
+    The index of the candidate is the message of the sentence.
+    """
+    # whether the messages can be recomputed at extraction without reading watermarked.txt
+    reproducible = True
+
+    def choose(self, c_idx, s_idx, num_candidates):
+        """
+        c_idx, s_idx: corpus and sentence index of the sentence
+        num_candidates: number of valid watermarked candidates (> 1)
+        Output: int index of the candidate to embed
+        """
+        raise NotImplementedError
+
+    def message(self, c_idx, s_idx, num_candidates):
+        return to_binary(self.choose(c_idx, s_idx, num_candidates), num_candidates)
+
+    def num_bits(self, num_candidates):
+        # bits of payload carried by a sentence with num_candidates valid watermarks (for the bpw)
+        return math.log2(num_candidates)
+
+    def state(self):
+        return None
+
+    def set_state(self, state):
+        pass
+
+
+class RandomSource(MessageSource):
+    """
+    Draws from the global random module (seeded once by the script). Kept as the default so that
+    existing experiments are reproduced; the messages depend on the order in which sentences are embedded.
+    """
+    reproducible = False
+
+    def choose(self, c_idx, s_idx, num_candidates):
+        return random.choice(range(num_candidates))
+
+    def state(self):
+        return rng_state()
+
+    def set_state(self, state):
+        set_rng_state(state)
+
+
+class KeyedSource(MessageSource):
+    """
+    Derives the message of each sentence from HMAC-SHA256(key, "c_idx:s_idx"), so it does not depend on
+    the order of embedding (parallel, sharded or resumed runs) and can be recomputed from the key alone.
+    """
+    def __init__(self, key):
+        if not key:
+            raise ValueError("A key is required for the keyed message source")
+        self.key = key.encode("utf-8") if isinstance(key, str) else key
+
+    def choose(self, c_idx, s_idx, num_candidates):
+        digest = hmac.new(self.key, f"{c_idx}:{s_idx}".encode("utf-8"), hashlib.sha256).digest()
+        # the bias of a 256-bit value modulo a small number of candidates is negligible
+        return int.from_bytes(digest, "big") % num_candidates
+
+
+class BitstreamSource(MessageSource):
+    """
+    Embeds a given payload. Every sentence takes the next floor(log2(num_candidates)) bits of the stream,
+    so the chosen index is always a valid candidate; the stream is repeated once it is consumed.
+    bits: List[int] of 0/1
+    """
+    def __init__(self, bits):
+        if len(bits) == 0:
+            raise ValueError("The bitstream of the message source is empty")
+        self.bits = list(bits)
+        self.position = 0
+
+    @classmethod
+    def from_file(cls, path):
+        # characters other than 0 and 1 (whitespace, newlines) are ignored
+        with open(path, "r") as f:
+            return cls([int(c) for c in f.read() if c in "01"])
+
+    def choose(self, c_idx, s_idx, num_candidates):
+        decimal = 0
+        for _ in range(self.num_bits(num_candidates)):
+            decimal = decimal * 2 + self.bits[self.position % len(self.bits)]
+            self.position += 1
+        return decimal
+
+    def num_bits(self, num_candidates):
+        # only the bits taken from the stream are embedded
+        return int(math.log2(num_candidates))
+
+    def state(self):
+        return self.position
+
+    def set_state(self, state):
+        self.position = state
+
+
+def get_message_source(name, key="", bits_path=""):
+    if name == "random":
+        return RandomSource()
+    elif name == "keyed":
+        return KeyedSource(key)
+    elif name == "bitstream":
+        return BitstreamSource.from_file(bits_path)
+    raise NotImplementedError(f"Unknown message source {name}")
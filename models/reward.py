@@ -4,24 +4,27 @@ import spacy
 import torch
 from transformers import AutoModelForSequenceClassification, AutoTokenizer, AutoModelForMaskedLM
 
+from utils.device import inference_mode
+from utils.model_registry import get_model, get_tokenizer
+
 
 class NLIReward:
     def __init__(self, device):
-        self.nli_model = AutoModelForSequenceClassification.from_pretrained("roberta-large-mnli").to(device)
-        self.nli_tokenizer = AutoTokenizer.from_pretrained('roberta-large')
+        self.nli_model = get_model("roberta-large-mnli", device=device)
+        self.nli_tokenizer = get_tokenizer('roberta-large')
         self.nli_threshold = 0.95
         self.device = device
 
     def compute_reward(self, candidate_texts, original_text, probs):
         # run NLI with the original input
-        if probs is not None:
+        if probs is not None and not torch.is_tensor(probs):
             probs = torch.stack(probs, dim=0)
         nli_input = self._concatenate_for_nli(candidate_texts, original_text)
         nli_input = {k: v.to(self.device) for k, v in nli_input.items()}
         with torch.no_grad():
             nli_output = self.nli_model(**nli_input)
 
-        entail_score = nli_output.logits.softmax(dim=-1)[:, 2]
+        entail_score = nli_output.logits.float().softmax(dim=-1)[:, 2]
         if probs is not None:
             normalized_prob = probs / probs.sum()
             reward = ((entail_score - self.nli_threshold) * normalized_prob).sum()
@@ -38,6 +41,67 @@ class NLIReward:
         return nli_input_encoded
 
 
+class NLIScoringQueue:
+    """
+    Accumulates (original, candidate) pairs of many sentences and scores them with the NLI model together.
+    Pairs are sorted by length and split into micro-batches of at most max_tokens (padded) tokens
+    so that little compute is spent on padding, and the entailment scores are scattered back to their owners.
+    """
+    def __init__(self, nli_reward, max_tokens=8192, max_batch_size=256):
+        self.nli_model = nli_reward.nli_model
+        self.nli_tokenizer = nli_reward.nli_tokenizer
+        self.device = nli_reward.device
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.owners = []
+        self.input_ids = []
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def add(self, owner, candidate_texts, original_text):
+        """
+        owner: hashable key under which the scores of candidate_texts are returned by flush
+        """
+        encoded = self.nli_tokenizer([original_text] * len(candidate_texts), candidate_texts,
+                                     add_special_tokens=True)
+        self.owners.extend([owner] * len(candidate_texts))
+        self.input_ids.extend(encoded['input_ids'])
+
+    def flush(self):
+        """
+        Output: Dict[owner, entailment scores (torch.Tensor) in the order the candidates were added]
+        """
+        lengths = torch.tensor([len(ids) for ids in self.input_ids], dtype=torch.long)
+        order = torch.argsort(lengths).tolist()
+        scores = torch.zeros(len(self.input_ids))
+
+        batch = []
+        for idx in order:
+            # pairs are in ascending length, so the last pair determines the padded length of the batch
+            if batch and ((len(batch) + 1) * lengths[idx] > self.max_tokens or len(batch) == self.max_batch_size):
+                scores[batch] = self._score(batch)
+                batch = []
+            batch.append(idx)
+        if batch:
+            scores[batch] = self._score(batch)
+
+        results = {}
+        for owner, score in zip(self.owners, scores):
+            results.setdefault(owner, []).append(score)
+        results = {owner: torch.stack(owner_scores) for owner, owner_scores in results.items()}
+        self.owners = []
+        self.input_ids = []
+        return results
+
+    def _score(self, batch):
+        features = [{'input_ids': self.input_ids[idx]} for idx in batch]
+        nli_input = self.nli_tokenizer.pad(features, padding='longest', return_tensors='pt')
+        nli_input = {k: v.to(self.device) for k, v in nli_input.items()}
+        with inference_mode():
+            nli_output = self.nli_model(**nli_input)
+        return nli_output.logits.float().softmax(dim=-1)[:, 2].cpu()
+
 
 class KeywordMatchReward:
     def __init__(self):
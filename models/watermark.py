@@ -1,29 +1,65 @@
 from datetime import datetime
+import math
 import os
 import sys
 sys.path.append(os.getcwd())
 os.environ['CUDA_VISIBLE_DEVICES'] = "0"
 
-import string
-from itertools import product
-from functools import reduce
 import re
 
 from datasets import load_dataset
-from nltk.stem import WordNetLemmatizer
-from nltk.stem.porter import PorterStemmer
 import torch
-from transformers import AutoTokenizer, AutoModelForMaskedLM
+from transformers import AutoModelForMaskedLM
 import spacy
 
 from config import WatermarkArgs, riskset
+from utils.device import configure, get_backend, inference_mode
 from utils.dataset_utils import preprocess2sentence, preprocess_txt, get_dataset
 from utils.logging import getLogger
-from models.reward import NLIReward
+from utils.model_registry import get_model, get_tokenizer
+from utils.sentence_cache import SentenceCache
+from utils.vocab_utils import VocabTable, return_case, CASE_EMPTY
+from models.candidate import candidate_grid, gather_candidates
+from models.reward import NLIReward, NLIScoringQueue
 from models.kwd import KeywordExtractor
 from models.mask import MaskSelector
 
 
+def load_cover_texts(args, dtype="imdb", stream=False):
+    """
+    Output: (train, test) cover texts as lists of sentences per document;
+            the train split is only loaded for training (-do_watermark F)
+    stream: the test split is a generator of the documents (see preprocess2sentence)
+    """
+    cover_texts = test_cover_texts = None
+    if dtype is None or dtype == "custom":
+        return cover_texts, test_cover_texts
+    start_sample_idx = 0
+    corpus, test_corpus, num_sample = get_dataset(dtype)
+
+    if args.debug_mode:
+        num_sample['train'] = 10
+        num_sample['test'] = 10
+
+    cover_texts = None
+    if not args.do_watermark:
+        cover_texts = preprocess_txt(corpus)
+        cover_texts = preprocess2sentence(cover_texts, dtype+"-train", start_sample_idx,
+                                          num_sample['train'],
+                                          spacy_model=args.spacy_model,
+                                          batch_size=args.preprocess_batch_size,
+                                          n_process=args.preprocess_n_process)
+
+    test_cover_texts = preprocess_txt(test_corpus)
+    test_cover_texts = preprocess2sentence(test_cover_texts, dtype+"-test", start_sample_idx,
+                                           num_sample['test'],
+                                           spacy_model=args.spacy_model,
+                                           batch_size=args.preprocess_batch_size,
+                                           n_process=args.preprocess_n_process,
+                                           stream=stream)
+    return cover_texts, test_cover_texts
+
+
 class InfillModel:
     def __init__(self, args, dirname=None):
         if dirname:
@@ -31,7 +67,8 @@ class InfillModel:
                                     dir_=dirname)
         else:
             self.logger = getLogger("INFILL-WATERMARK")
-        self.device = torch.device('cuda')
+        self.device = configure(getattr(args, "device", "auto"), getattr(args, "num_threads", 0),
+                                getattr(args, "precision", "fp32"), getattr(args, "backend", "torch"))
         self.args = args
         if args.dtype:
             self.train_d, self.test_d = self._init_dataset(args.dtype)
@@ -44,18 +81,23 @@ class InfillModel:
                                  'log_iter_interval': 1000
                                  }
 
-        self.tokenizer = AutoTokenizer.from_pretrained(args.model_name)
-        self.lm_head = AutoModelForMaskedLM.from_pretrained(args.model_name).to(self.device)
+        self.tokenizer = get_tokenizer(args.model_name)
         self.call_to_lm = 0
-        if args.model_ckpt:
-            if args.model_ckpt.endswith(".pth"):
+        pth_ckpt = args.model_ckpt and args.model_ckpt.endswith(".pth")
+        if args.train_infill or (pth_ckpt and get_backend() == "torch"):
+            # the weights are modified, so the model is not shared through the registry
+            self.lm_head = AutoModelForMaskedLM.from_pretrained(args.model_name).to(self.device)
+            if pth_ckpt:
                 state_dict = torch.load(args.model_ckpt, map_location=self.device)["model"]
                 self.lm_head.load_state_dict(state_dict)
-            else:
+            elif args.model_ckpt:
                 self.lm_head = self.lm_head.from_pretrained(args.model_ckpt).to(self.device)
+        else:
+            # with the onnx backend, .pth checkpoints are exported with their weights (export_onnx.py --model_ckpt)
+            self.lm_head = get_model(args.model_ckpt or args.model_name, kind='masked_lm', device=self.device)
 
         self.nli_reward = None if args.do_watermark else NLIReward(self.device)
-        self.keyword_module = KeywordExtractor(ratio=self.args.keyword_ratio)
+        self.keyword_module = KeywordExtractor(ratio=self.args.keyword_ratio, scorer=self.args.keyword_scorer)
         self.logger.info(f"Using component: [{args.mask_select_method}]")
         if "keyword" in args.mask_select_method:
             self.logger.info(f"and mask selection by [{args.keyword_mask}]")
@@ -67,9 +109,23 @@ class InfillModel:
                                           mask_order_by=args.mask_order_by,
                                           keyword_mask=args.keyword_mask,
                                           exclude_cc=args.exclude_cc,
-                                          custom_keywords=args.custom_keywords
+                                          custom_keywords=getattr(args, "custom_keywords", None)
                                           )
         self.nlp = spacy.load(args.spacy_model)
+        self.vocab_table = VocabTable(self.tokenizer, self.nlp, device=self.device)
+        self.eligible_vocab = ~self.vocab_table.is_subword & self.vocab_table.is_single \
+                              & ~self.vocab_table.in_set(riskset) & ~self.vocab_table.has_punct
+
+        self.sentence_cache = None
+        if args.sentence_cache:
+            cache_config = {k: getattr(args, k, None) for k in ['model_name', 'model_ckpt', 'spacy_model',
+                                                                 'keyword_ratio', 'keyword_scorer', 'topk', 'mask_select_method',
+                                                                 'mask_order_by', 'keyword_mask', 'exclude_cc',
+                                                                 'custom_keywords']}
+            # states infilled with the padding of fill_mask_batch
+            cache_config['padding'] = 'multiple_of_16'
+            self.sentence_cache = SentenceCache(args.sentence_cache, cache_config,
+                                                max_entries=args.sentence_cache_size)
 
         self.metric = {'entail_score': [], 'num_subs': [], 'train_entail_score': []}
         self.best_metric = {'entail_score': 0}
@@ -80,25 +136,19 @@ class InfillModel:
         text: Spacy.Span object (sentence of Spacy.Doc)
         mask_idx_token: List[index of masks in Spacy tokens] (c.f. mask_idx_pt: mask index in Pytorch Tensors)
         """
-        tokenized_text = [token.text_with_ws for token in text]
-        tokenized_text_masked = tokenized_text.copy()
-
-        # mask all selected tokens
-        for m_idx in mask_idx_token:
-            tokenized_text_masked[m_idx] = re.sub(r"\S+", self.tokenizer.special_tokens_map['mask_token'],
-                                             tokenized_text_masked[m_idx])
+        tokenized_text, masked_text = self._mask_text(text, mask_idx_token)
 
-        inputs = self.tokenizer(["".join(tokenized_text_masked).strip()], return_tensors="pt",
+        inputs = self.tokenizer([masked_text], return_tensors="pt",
                                 add_special_tokens=True, padding="longest")
         inputs = {k:v.to(self.device) for k,v in inputs.items()}
         self.logger.debug("Masked Sentence:")
-        self.logger.debug("".join(tokenized_text_masked).strip())
+        self.logger.debug(masked_text)
 
         if train_flag:
             logits = self.lm_head(**inputs).logits
         else:
-            with torch.no_grad():
-                logits = self.lm_head(**inputs).logits
+            with inference_mode():
+                logits = self.lm_head(**inputs).logits.float()
         self.call_to_lm += 1
         mask_idx_pt = torch.nonzero(inputs['input_ids'] == self.tokenizer.mask_token_id, as_tuple=True)
 
@@ -106,6 +156,80 @@ class InfillModel:
             return [], None, [],[]
 
         mask_logits = logits[mask_idx_pt]
+        agg_cwi, agg_probs = self._aggregate_candidates(mask_logits, tokenized_text, mask_idx_token,
+                                                        embed_flag=embed_flag)
+
+        return agg_cwi, agg_probs, mask_idx_pt, inputs
+
+    def fill_mask_batch(self, sentences, mask_indices, train_flag=False, embed_flag=False, batch_size=None,
+                        pad_multiple=16):
+        """
+        Batched version of fill_mask. Masked sentences are padded into a single forward pass per batch
+        and the outputs are split back to the per-sentence format of fill_mask.
+        Every sentence is padded to the next multiple of pad_multiple tokens and only batched with sentences of
+        the same padded length, so its forward pass does not depend on the other sentences of the call; embedding
+        (one document per call) and extraction (many rows per call) infill the same masked sentence alike.
+        sentences: List[Spacy.Span]
+        mask_indices: List[List[index of masks in Spacy tokens]] for each sentence
+        Output: List[(agg_cwi, agg_probs, mask_idx_pt, inputs)]
+        """
+        if len(sentences) == 0:
+            return []
+        batch_size = batch_size or self.args.infill_batch_size
+        masked = [self._mask_text(sen, mask_idx_token) for sen, mask_idx_token in zip(sentences, mask_indices)]
+        outputs = [None] * len(sentences)
+
+        num_tokens = [len(ids) for ids in self.tokenizer([m[1] for m in masked], add_special_tokens=True)['input_ids']]
+        padded_len = [math.ceil(n / pad_multiple) * pad_multiple for n in num_tokens]
+        # group sentences of the same padded length
+        order = sorted(range(len(sentences)), key=lambda i: (padded_len[i], i))
+        batches = []
+        for i in order:
+            if batches and padded_len[batches[-1][0]] == padded_len[i] and len(batches[-1]) < batch_size:
+                batches[-1].append(i)
+            else:
+                batches.append([i])
+        for batch_idx in batches:
+            inputs = self.tokenizer([masked[i][1] for i in batch_idx], return_tensors="pt",
+                                    add_special_tokens=True, padding="max_length",
+                                    max_length=padded_len[batch_idx[0]])
+            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+
+            if train_flag:
+                logits = self.lm_head(**inputs).logits
+            else:
+                with inference_mode():
+                    logits = self.lm_head(**inputs).logits.float()
+            self.call_to_lm += 1
+
+            for row, s_idx in enumerate(batch_idx):
+                # strip the padding so that the returned inputs are identical to those of fill_mask
+                valid = inputs['attention_mask'][row].bool()
+                row_inputs = {k: v[row:row + 1][:, valid] for k, v in inputs.items()}
+                mask_idx_pt = torch.nonzero(row_inputs['input_ids'] == self.tokenizer.mask_token_id, as_tuple=True)
+                if mask_idx_pt[0].numel() == 0:
+                    outputs[s_idx] = ([], None, [], [])
+                    continue
+
+                mask_logits = logits[row][valid][mask_idx_pt[1]]
+                tokenized_text = masked[s_idx][0]
+                agg_cwi, agg_probs = self._aggregate_candidates(mask_logits, tokenized_text, mask_indices[s_idx],
+                                                                embed_flag=embed_flag)
+                outputs[s_idx] = (agg_cwi, agg_probs, mask_idx_pt, row_inputs)
+
+        return outputs
+
+    def _mask_text(self, text, mask_idx_token):
+        tokenized_text = [token.text_with_ws for token in text]
+        tokenized_text_masked = tokenized_text.copy()
+
+        # mask all selected tokens
+        for m_idx in mask_idx_token:
+            tokenized_text_masked[m_idx] = re.sub(r"\S+", self.tokenizer.special_tokens_map['mask_token'],
+                                             tokenized_text_masked[m_idx])
+        return tokenized_text, "".join(tokenized_text_masked).strip()
+
+    def _aggregate_candidates(self, mask_logits, tokenized_text, mask_idx_token, embed_flag=False):
         probs = mask_logits.softmax(dim=-1)
         sorted_probs, prob_indices = torch.sort(probs, dim=-1, descending=True)
 
@@ -132,7 +256,7 @@ class InfillModel:
             self.logger.debug(self.tokenizer.decode(candidate_word_ids) + "\n")
         avg_num_cand /= len(mask_idx_token)
 
-        return agg_cwi, agg_probs, mask_idx_pt, inputs
+        return agg_cwi, agg_probs
         
         
     def generate_candidate_sentence(self, agg_cwi, agg_probs, mask_idx_pt, tokenized_pt):
@@ -140,17 +264,14 @@ class InfillModel:
         candidate_text_jp = []
 
         if len(agg_cwi) > 0 :
-            candidate_text_ids = []
-            # permute through candidate words and probabilities
-            for cwi, joint_prob in zip(product(*agg_cwi), product(*agg_probs)):
-                compared_inputs = tokenized_pt['input_ids'].clone()
-                for m_idx, c_id in zip(mask_idx_pt[1], cwi): #mask_idx_pt is a tuple of pt index; take the second axis's index
-                    compared_inputs[:, m_idx] = c_id
-                joint_prob = reduce((lambda x,y: x*y), joint_prob)
-                candidate_text_jp.append(joint_prob)
-                candidate_text_ids.append(compared_inputs)
-
-            candidate_text_ids = torch.cat(candidate_text_ids, dim=0)
+            # combinations of candidate words as indices into agg_cwi; [num_candidates, num_masks]
+            indices = candidate_grid(agg_cwi, agg_probs, order=self.args.candidate_order,
+                                     max_candidates=self.args.max_candidates)
+            candidate_word_ids, candidate_text_jp = gather_candidates(agg_cwi, indices, agg_probs)
+
+            # substitute all combinations at once; mask_idx_pt is a tuple of pt index; take the second axis's index
+            candidate_text_ids = tokenized_pt['input_ids'].repeat(len(indices), 1)
+            candidate_text_ids[:, mask_idx_pt[1][:len(agg_cwi)]] = candidate_word_ids
             candidate_texts = self.tokenizer.batch_decode(candidate_text_ids, skip_special_tokens=True)
 
         return candidate_texts, candidate_text_jp
@@ -196,6 +317,87 @@ class InfillModel:
 
         return agg_cwi, agg_probs, tokenized_pt, (mask_idx_pt, mask_idx, mask_word)
 
+    def run_iter_batch(self, sens, keywords, ent_keywords, train_flag=False, embed_flag=True):
+        """
+        Same as run_iter for a list of sentences, with all infills run by fill_mask_batch
+        """
+        masks = self.mask_selector.return_mask_batch(sens, keywords, ent_keywords)
+        to_fill = [idx for idx, (mask_idx, _) in enumerate(masks) if mask_idx]
+        filled = self.fill_mask_batch([sens[idx] for idx in to_fill], [masks[idx][0] for idx in to_fill],
+                                      train_flag=train_flag, embed_flag=embed_flag)
+        filled = dict(zip(to_fill, filled))
+
+        results = []
+        for idx, (mask_idx, mask_word) in enumerate(masks):
+            agg_cwi, agg_probs, tokenized_pt, mask_idx_pt = [], [], {}, []
+            if idx in filled:
+                agg_cwi, agg_probs, mask_idx_pt, tokenized_pt = filled[idx]
+                # Limit the maximum number of candidates to =< top-k ^ 7
+                agg_cwi = agg_cwi[:7]
+            results.append((agg_cwi, agg_probs, tokenized_pt, (mask_idx_pt, mask_idx, mask_word)))
+
+        return results
+
+    def process_sentences(self, sens, embed_flag=True):
+        """
+        Keyword extraction, mask selection and infilling of sentences, consulting the sentence cache if enabled.
+        sens: List[Spacy.Doc]
+        Output: List[(keyword, ent_keyword, agg_cwi, agg_probs, tokenized_pt, (mask_idx_pt, mask_idx, mask_word))]
+        """
+        tag = f"embed_flag={embed_flag}"
+        outputs = [None] * len(sens)
+        missing = []
+        for idx, sen in enumerate(sens):
+            cached = self.sentence_cache.get(sen.text, tag) if self.sentence_cache else None
+            if cached is None:
+                missing.append(idx)
+            else:
+                outputs[idx] = self._restore_cached(sen, cached)
+
+        if missing:
+            missing_sens = [sens[idx] for idx in missing]
+            all_keywords, entity_keywords = self.keyword_module.extract_keyword(missing_sens)
+            infilled = self.run_iter_batch(missing_sens, all_keywords, entity_keywords,
+                                           train_flag=False, embed_flag=embed_flag)
+            for idx, sen, keyword, ent_keyword, result in zip(missing, missing_sens, all_keywords, entity_keywords,
+                                                              infilled):
+                outputs[idx] = (keyword, ent_keyword) + result
+                if self.sentence_cache:
+                    self.sentence_cache.put(sen.text, self._to_cached(sen, keyword, ent_keyword, result), tag)
+
+        return outputs
+
+    def _to_cached(self, sen, keyword, ent_keyword, result):
+        agg_cwi, agg_probs, tokenized_pt, (mask_idx_pt, mask_idx, mask_word) = result
+        offset = sen[0].i
+        return {'keyword': [k.i - offset for k in keyword],
+                'ent_keyword': [k.i - offset for k in ent_keyword],
+                'mask_idx': mask_idx,
+                'agg_cwi': [cwi.tolist() for cwi in agg_cwi],
+                'agg_probs': [probs.tolist() for probs in agg_probs] if agg_probs is not None else None}
+
+    def _restore_cached(self, sen, cached):
+        keyword = [sen[k] for k in cached['keyword']]
+        ent_keyword = [sen[k] for k in cached['ent_keyword']]
+        mask_idx = cached['mask_idx']
+        mask_word = [sen[m] for m in mask_idx]
+        agg_cwi = [torch.tensor(cwi, dtype=torch.long, device=self.device) for cwi in cached['agg_cwi']]
+        agg_probs = [torch.tensor(probs, device=self.device) for probs in cached['agg_probs']] \
+            if cached['agg_probs'] is not None else None
+
+        # the tokenized inputs are rebuilt without running the LM
+        tokenized_pt, mask_idx_pt = {}, []
+        if mask_idx:
+            _, masked_text = self._mask_text(sen, mask_idx)
+            tokenized_pt = self.tokenizer([masked_text], return_tensors="pt",
+                                          add_special_tokens=True, padding="longest")
+            tokenized_pt = {k: v.to(self.device) for k, v in tokenized_pt.items()}
+            mask_idx_pt = torch.nonzero(tokenized_pt['input_ids'] == self.tokenizer.mask_token_id, as_tuple=True)
+            if mask_idx_pt[0].numel() == 0:
+                tokenized_pt, mask_idx_pt = [], []
+
+        return keyword, ent_keyword, agg_cwi, agg_probs, tokenized_pt, (mask_idx_pt, mask_idx, mask_word)
+
     def train(self, nli_loss=False, robustness_loss=False):
         iteration = 1
         total_iteration = self.train_kwargs['epoch'] * sum([len(sentences) for sentences in self.train_d])
@@ -231,6 +433,8 @@ class InfillModel:
 
 
     def evaluate(self, eval_ep=""):
+        # candidates of many sentences are scored together by the nli model
+        nli_queue = NLIScoringQueue(self.nli_reward, max_tokens=self.args.nli_max_tokens)
         for c_idx, sentences in enumerate(self.test_d):
             # extract keyword here
             all_keywords, entity_keywords = self.keyword_module.extract_keyword(sentences)
@@ -245,10 +449,14 @@ class InfillModel:
                                                                                                      train_flag=False)
                 candidate_texts, candidate_text_jp = self.generate_candidate_sentence(agg_cwi, agg_probs, mask_idx_pt,
                                                                                       tokenized_pt)
-                entail_score, candidate_texts = self.compute_nli(candidate_texts, candidate_text_jp, sen.text,
-                                                                 train_flag=False)
+                if candidate_texts:
+                    self.logger.debug(candidate_texts)
+                    nli_queue.add((c_idx, s_idx), candidate_texts, sen.text)
 
-                self.metric['entail_score'].extend(entail_score.tolist())
+            if len(nli_queue) >= self.args.nli_queue_size:
+                self._record_entail_score(nli_queue.flush())
+        if len(nli_queue) > 0:
+            self._record_entail_score(nli_queue.flush())
 
 
         if eval_ep:
@@ -262,84 +470,40 @@ class InfillModel:
                 self.lm_head.save_pretrained(ckpt_dir)
             model.init_metric()
 
+    def _record_entail_score(self, entail_scores):
+        for owner in sorted(entail_scores):
+            entail_score = entail_scores[owner]
+            self.logger.debug(f"Entailment score {entail_score.mean().item():.3f}")
+            self.metric['entail_score'].extend(entail_score.tolist())
+            self.metric['num_subs'].append(len(entail_score))
+
     def init_metric(self):
         self.metric = {'entail_score': [], 'num_subs': [], 'train_entail_score': []}
 
     def _init_dataset(self, dtype="imdb"):
-        cover_texts = test_cover_texts = None
-        if dtype is None or dtype == "custom":
-            return cover_texts, test_cover_texts
-        start_sample_idx = 0
-        corpus, test_corpus, num_sample = get_dataset(dtype)
-
-        if self.args.debug_mode:
-            num_sample['train'] = 10
-            num_sample['test'] = 10
-
-        cover_texts = None
-        if not self.args.do_watermark:
-            cover_texts = preprocess_txt(corpus)
-            cover_texts = preprocess2sentence(cover_texts, dtype+"-train", start_sample_idx,
-                                              num_sample['train'],
-                                              spacy_model=self.args.spacy_model)
-
-        test_cover_texts = preprocess_txt(test_corpus)
-        test_cover_texts = preprocess2sentence(test_cover_texts, dtype+"-test", start_sample_idx,
-                                               num_sample['test'],
-                                               spacy_model=self.args.spacy_model)
-        return cover_texts, test_cover_texts
+        return load_cover_texts(self.args, dtype, stream=getattr(self.args, "preprocess_stream", False))
 
     def return_dataset(self):
         return self.train_d, self.test_d
 
     def _filter_words(self, candidate_word_ids, original_word, embed_flag=False):
-        mask_candidates = [{'token_str': self.tokenizer.decode(x),
-                            'token': x}
-                           for x in candidate_word_ids]
-
-        # filter out subword tokens
-        mask_candidates = list(filter(lambda x: not x['token_str'].startswith("##"), mask_candidates))
-        # filter out words that are tokenized into multiple tokens by spacy tokenizer
-        mask_candidates = list(filter(lambda x: len(self.nlp(x['token_str'])) == 1, mask_candidates))
-
-        # filter out riskset
-        mask_candidates = list(filter(lambda x: x['token_str'] not in riskset, mask_candidates))
-        # filter out words with any punctuations
-        mask_candidates = list(filter(lambda x: not any(s for s in x['token_str'] if s in string.punctuation),
-                                      mask_candidates))
+        vocab = self.vocab_table
+        # filter out subword tokens, words that are tokenized into multiple tokens by spacy tokenizer,
+        # riskset and words with any punctuations
+        keep = self.eligible_vocab[candidate_word_ids]
 
         # only include those whose first letter is the same case as that of the original word
-        def return_case(word):
-            word = word.strip()
-            if len(word) == 0:
-                return False
-            return "U" if word[0].isupper() else "l"
-
         original_case = return_case(original_word)
-        if original_case is False:
-            return torch.tensor()
-        else:
-            mask_candidates = list(filter(lambda x: return_case(x['token_str']) == original_case, mask_candidates))
+        if original_case == CASE_EMPTY:
+            return torch.tensor([], dtype=torch.long)
+        keep &= vocab.case[candidate_word_ids] == original_case
 
         # filtering based on the original word is only possible when training
         if not embed_flag:
             # filter out morphological derivations
-            mask_candidates = list(filter(lambda x: not (x['token_str'].lower() == original_word.lower() and
-                                                         x['token_str'] != original_word), mask_candidates))
-            porter_stemmer = PorterStemmer()
-            text_lm = porter_stemmer.stem(original_word)
-            mask_candidates = \
-                list(filter(lambda x: porter_stemmer.stem(x['token_str']) != text_lm
-                                      or x['token_str'] == original_word, mask_candidates))
-
-            lemmatizer = WordNetLemmatizer()
-            for pos in ["v", "n", "a", "r", "s"]:
-                text_lm = lemmatizer.lemmatize(original_word, pos)
-                mask_candidates = \
-                    list(filter(lambda x: lemmatizer.lemmatize(x['token_str'], pos) != text_lm
-                                          or x['token_str'] == original_word, mask_candidates))
-
-        return torch.tensor([x['token'] for x in mask_candidates])
+            keep &= vocab.derivation_mask(candidate_word_ids, original_word)
+
+        return candidate_word_ids[keep]
 
 
 if __name__ == "__main__":
@@ -1,22 +1,13 @@
 import os.path
-from itertools import product
-from datasets import load_dataset
 import math
+import itertools
+import multiprocessing
 import random
-import re
-import spacy
 import string
 import sys
 
-import torch
-from tqdm.auto import tqdm
-
 from config import WatermarkArgs, GenericArgs, stop
-from models.watermark import InfillModel
-from utils.dataset_utils import get_result_txt
-from utils.logging import getLogger
-from utils.metric import Metric
-from utils.misc import compute_ber
+from utils.lazy import profile, log_startup_profile
 
 random.seed(1230)
 
@@ -24,27 +15,66 @@ infill_parser = WatermarkArgs()
 generic_parser = GenericArgs()
 infill_args, _ = infill_parser.parse_known_args()
 generic_args, _ = generic_parser.parse_known_args()
+
+# heavy modules are imported after parsing the arguments so that --help does not wait for them
+with profile("import torch, spacy"):
+    import spacy
+    import torch
+    from tqdm.auto import tqdm
+with profile("import models"):
+    from models.candidate import CandidateVerifier
+    from models.embed import embed_document, embed_sentences, init_worker, worker_threads
+    from models.message import get_message_source
+    from models.extract import clean_states, corrupted_files, corruption_type, extract_corrupted_file, \
+        extract_file, file_checkpoint, read_corrupted, write_ber, init_worker as init_extract_worker
+    from models.watermark import InfillModel, load_cover_texts
+    from utils.checkpoint import Checkpoint, sync, truncate
+    from utils.dataset_utils import keep_documents, take_sentences
+    from utils.logging import getLogger
+    from utils.device import configure, get_device
+    from utils.metric import Metric
+    from utils.model_registry import log_memory_report
+    from utils.result_store import build_result_store, load_result
+
 DEBUG_MODE = generic_args.debug_mode
 dtype = generic_args.dtype
 
 dirname = f"./results/ours/{dtype}/{generic_args.exp_name}"
 start_sample_idx = 0
 num_sample = generic_args.num_sample
-
-spacy_tokenizer = spacy.load(generic_args.spacy_model)
-if "trf" in generic_args.spacy_model:
-    spacy.require_gpu()
-model = InfillModel(infill_args, dirname=dirname)
-
-_, cover_texts = model.return_dataset()
-
-num_sentence = 0
-for c_idx, sentences in enumerate(cover_texts):
-    num_sentence += len(sentences)
-    if num_sentence >= num_sample:
-        break
-
-cover_texts = cover_texts[:c_idx]
+configure(infill_args.device, infill_args.num_threads, infill_args.precision, infill_args.backend)
+
+metric_only = generic_args.embed and generic_args.metric_only
+if metric_only:
+    # the metrics only compare the cover texts with watermarked.txt, so the watermarking models are not built
+    with profile("load dataset"):
+        _, cover_texts = load_cover_texts(infill_args, infill_args.dtype)
+else:
+    with profile(f"load {generic_args.spacy_model}"):
+        spacy_tokenizer = spacy.load(generic_args.spacy_model)
+    if "trf" in generic_args.spacy_model and get_device().type == "cuda":
+        spacy.require_gpu()
+    with profile("InfillModel"):
+        model = InfillModel(infill_args, dirname=dirname)
+    verifier = CandidateVerifier(spacy_tokenizer, model.keyword_module, model.mask_selector, model.tokenizer,
+                                 n_process=generic_args.verify_n_process, batch_size=generic_args.verify_batch_size,
+                                 order=infill_args.candidate_order, max_candidates=infill_args.max_candidates,
+                                 prune=infill_args.prune_candidates)
+
+    _, cover_texts = model.return_dataset()
+if generic_args.profile_startup:
+    log_startup_profile(getLogger("STARTUP", debug_mode=True))
+
+# with -preprocess_stream the documents are embedded while the corpus is parsed; the tf-idf scorer
+# is fitted on all cover texts before embedding, so the stream is materialized in that case
+stream = generic_args.embed and not metric_only and infill_args.preprocess_stream \
+    and infill_args.keyword_scorer != "tfidf"
+cover_texts = take_sentences(cover_texts, num_sample)
+if not stream:
+    cover_texts = list(cover_texts)
+if not metric_only and infill_args.keyword_scorer == "tfidf":
+    # fit on the same cover texts for embedding and extraction so that the keywords match
+    model.keyword_module.fit_tfidf([sen for sentences in cover_texts for sen in sentences])
 
 bit_count = 0
 word_count = 0
@@ -56,23 +86,30 @@ sample_cnt = 0
 one_cnt = 0
 zero_cnt = 0
 
-device = torch.device("cuda")
+device = get_device()
 metric = Metric(device, **vars(generic_args))
 
 if not os.path.exists(dirname):
     os.makedirs(dirname, exist_ok=True)
+# checkpoints of a run are only resumed with the same arguments
+checkpoint_config = {'infill_args': vars(infill_args), 'dtype': dtype, 'num_sample': num_sample,
+                     'spacy_model': generic_args.spacy_model, 'message_source': generic_args.message_source,
+                     'message_bits': generic_args.message_bits}
+message_source = get_message_source(generic_args.message_source, generic_args.message_key,
+                                    generic_args.message_bits)
 
 if generic_args.embed:
     logger = getLogger("EMBED",
                        dir_=dirname,
                        debug_mode=DEBUG_MODE)
+    log_memory_report(logger)
 
 
     result_dir = os.path.join(dirname, "watermarked.txt")
     if not os.path.exists(result_dir):
         os.makedirs(os.path.dirname(result_dir), exist_ok=True)
 
-    if generic_args.metric_only:
+    if metric_only:
         for model_name in ["roberta", "all-MiniLM-L6-v2"]:
             ss_score, ss_dist = metric.compute_ss(result_dir, model_name, cover_texts)
             logger.info(f"ss score: {sum(ss_score) / len(ss_score):.3f}")
@@ -85,73 +122,100 @@ if generic_args.embed:
         logger.info(f"nli score: {sum(nli_score) / len(nli_score):.3f}")
         exit()
 
-    progress_bar = tqdm(range(len(cover_texts)))
-    wr = open(result_dir, "w")
-    for c_idx, sentences in enumerate(cover_texts):
-        for s_idx, sen in enumerate(sentences):
-            sen = spacy_tokenizer(sen.text.strip())
-            all_keywords, entity_keywords = model.keyword_module.extract_keyword([sen])
+    checkpoint = Checkpoint(os.path.join(dirname, "checkpoint-embed.json"), config=checkpoint_config)
+    state = checkpoint.load() if generic_args.resume else None
+    start_c_idx = 0
+    if state is not None and os.path.isfile(result_dir):
+        # continue after the last checkpointed document with the counters and RNG state of that point
+        start_c_idx = state['c_idx'] + 1
+        bit_count, word_count, upper_bound = state['bit_count'], state['word_count'], state['upper_bound']
+        kwd_match_cnt, mask_match_cnt, sample_cnt = state['kwd_match_cnt'], state['mask_match_cnt'], state['sample_cnt']
+        one_cnt, zero_cnt = state['one_cnt'], state['zero_cnt']
+        model.call_to_lm, verifier.num_parsed = state['call_to_lm'], state['num_parsed']
+        message_source.set_state(state['message_state'])
+        truncate(result_dir, state['offset'])
+        logger.info(f"Resuming from document {start_c_idx}" + ("" if stream else f" of {len(cover_texts)}"))
+        wr = open(result_dir, "a")
+    else:
+        checkpoint.remove()
+        wr = open(result_dir, "w")
+
+    if stream:
+        # the number of documents is not known until the stream ends
+        streamed_texts = []
+        cover_texts = keep_documents(cover_texts, streamed_texts)
+        progress_bar = tqdm(initial=start_c_idx)
+    else:
+        progress_bar = tqdm(total=len(cover_texts), initial=start_c_idx)
+    document_texts = ([sen.text.strip() for sen in sentences]
+                      for sentences in itertools.islice(cover_texts, start_c_idx, None))
+    pool = None
+    if generic_args.num_workers > 1 and get_device().type != "cpu":
+        logger.info("--num_workers is only supported on cpu; embedding serially")
+    elif generic_args.num_workers > 1:
+        # workers only compute the valid watermarks; messages are chosen here in document order,
+        # so the output is identical to the serial run
+        if model.sentence_cache:
+            model.sentence_cache.commit()
+        num_threads = worker_threads(generic_args.num_workers, infill_args.num_threads)
+        pool = multiprocessing.get_context("fork").Pool(generic_args.num_workers, initializer=init_worker,
+                                                        initargs=(spacy_tokenizer, model, verifier, num_threads))
+        documents = pool.imap(embed_document, document_texts)
+    else:
+        documents = (embed_sentences(texts, spacy_tokenizer, model, verifier) for texts in document_texts)
+
+    def save_checkpoint(c_idx):
+        if model.sentence_cache:
+            model.sentence_cache.commit()
+        checkpoint.save({'c_idx': c_idx, 'offset': sync(wr), 'message_state': message_source.state(),
+                         'bit_count': bit_count, 'word_count': word_count, 'upper_bound': upper_bound,
+                         'kwd_match_cnt': kwd_match_cnt, 'mask_match_cnt': mask_match_cnt,
+                         'sample_cnt': sample_cnt, 'one_cnt': one_cnt, 'zero_cnt': zero_cnt,
+                         'call_to_lm': model.call_to_lm + worker_call_to_lm,
+                         'num_parsed': verifier.num_parsed + worker_num_parsed})
+
+    worker_call_to_lm = 0
+    worker_num_parsed = 0
+    c_idx = start_c_idx - 1
+    for c_idx, sentence_results in enumerate(documents, start=start_c_idx):
+        for s_idx, result in enumerate(sentence_results):
             logger.info(f"{c_idx} {s_idx}")
-            keyword = all_keywords[0]
-            ent_keyword = entity_keywords[0]
-            agg_cwi, agg_probs, tokenized_pt, (mask_idx_pt, mask_idx, mask_word) = model.run_iter(sen, keyword, ent_keyword,
-                                                                                                  train_flag=False, embed_flag=True)
             # check if keyword & mask_indices matches
-            valid_watermarks = []
-            candidate_kwd_cnt = 0
-            tokenized_text = [token.text_with_ws for token in sen]
-
-            if len(agg_cwi) > 0:
-                for cwi in product(*agg_cwi):
-                    wm_text = tokenized_text.copy()
-                    for m_idx, c_id in zip(mask_idx, cwi):
-                        wm_text[m_idx] = re.sub(r"\S+", model.tokenizer.decode(c_id), wm_text[m_idx])
-
-                    wm_tokenized = spacy_tokenizer("".join(wm_text).strip())
-
-                    # extract keyword of watermark
-                    wm_keywords, wm_ent_keywords = model.keyword_module.extract_keyword([wm_tokenized])
-                    wm_kwd = wm_keywords[0]
-                    wm_ent_kwd = wm_ent_keywords[0]
-                    wm_mask_idx, wm_mask = model.mask_selector.return_mask(wm_tokenized, wm_kwd, wm_ent_kwd)
-
-                    kwd_match_flag = set([x.text for x in wm_kwd]) == set([x.text for x in keyword])
-                    if kwd_match_flag:
-                        kwd_match_cnt += 1
-
-                    # checking whether the watermark can be embedded without the assumption of corruption
-                    mask_match_flag = len(wm_mask) and set(wm_mask_idx) == set(mask_idx)
-                    if mask_match_flag:
-                        valid_watermarks.append(wm_tokenized.text)
-                        mask_match_cnt += 1
-
-                    sample_cnt += 1
-                    candidate_kwd_cnt += 1
-    
-            punct_removed = sen.text.translate(str.maketrans(dict.fromkeys(string.punctuation)))
+            valid_watermarks = result['valid_watermarks']
+            valid_tokens = result['valid_tokens']
+            mask_idx = result['mask_idx']
+            candidate_kwd_cnt = result['sample_cnt']
+            kwd_match_cnt += result['kwd_match_cnt']
+            mask_match_cnt += result['mask_match_cnt']
+            sample_cnt += result['sample_cnt']
+            if pool is not None:
+                worker_call_to_lm += result.get('call_to_lm', 0)
+                worker_num_parsed += result.get('num_parsed', 0)
+
+            punct_removed = result['text'].translate(str.maketrans(dict.fromkeys(string.punctuation)))
             word_count += len([i for i in punct_removed.split(" ") if i not in stop])
             if len(valid_watermarks) > 1:
-                bit_count += math.log2(len(valid_watermarks))
-                random_msg_decimal = random.choice(range(len(valid_watermarks)))
+                bit_count += message_source.num_bits(len(valid_watermarks))
+                msg_decimal = message_source.choose(c_idx, s_idx, len(valid_watermarks))
                 num_digit = math.ceil(math.log2(len(valid_watermarks)))
-                random_msg_binary = format(random_msg_decimal, f"0{num_digit}b")
+                msg_binary = format(msg_decimal, f"0{num_digit}b")
 
-                wm_text = valid_watermarks[random_msg_decimal]
+                wm_text = valid_watermarks[msg_decimal]
                 watermarked_text = "".join(wm_text) if len(mask_idx) > 0 else ""
-                message_str = list(random_msg_binary)
+                message_str = list(msg_binary)
                 one_cnt += len([i for i in message_str if i =="1"])
                 zero_cnt += len([i for i in message_str if i =="0"])
 
                 keys = []
-                wm_tokenized = spacy_tokenizer(wm_text)
+                wm_tokenized = valid_tokens[msg_decimal]
                 for m_idx in mask_idx:
-                    keys.append(wm_tokenized[m_idx].text)
+                    keys.append(wm_tokenized[m_idx])
                 keys_str = ", ".join(keys)
                 message_str = ' '.join(message_str) if len(message_str) else ""
                 wr.write(f"{c_idx}\t{s_idx}\t \t \t"
                          f"{''.join(wm_text)}\t{keys_str}\t{message_str}\n")
             else:
-                original_text = ''.join(tokenized_text)
+                original_text = result['original_text']
                 wr.write(f"{c_idx}\t{s_idx}\t \t \t"
                          f"{original_text}\t \t \n")
 
@@ -161,7 +225,21 @@ if generic_args.embed:
         if word_count:
             logger.info(f"Bpw : {bit_count / word_count:.3f}")
 
+        if (c_idx + 1) % generic_args.checkpoint_every == 0:
+            save_checkpoint(c_idx)
+    if c_idx >= start_c_idx and (c_idx + 1) % generic_args.checkpoint_every != 0:
+        # the last document
+        save_checkpoint(c_idx)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+        model.call_to_lm += worker_call_to_lm
+        verifier.num_parsed += worker_num_parsed
     wr.close()
+    if stream:
+        cover_texts = streamed_texts
+    build_result_store(result_dir)
     logger.info(infill_args)
     logger.info(f"UB Bpw : {upper_bound / word_count:.3f}")
     logger.info(f"Bpw : {bit_count / word_count:.3f}")
@@ -170,6 +248,11 @@ if generic_args.embed:
     logger.info(f"kwd match rate: {kwd_match_cnt / sample_cnt :.3f}")
     logger.info(f"zero/one ratio: {zero_cnt / one_cnt :.3f}")
     logger.info(f"calls to LM: {model.call_to_lm}")
+    logger.info(f"candidates parsed: {verifier.num_parsed}")
+    if model.sentence_cache:
+        logger.info(f"sentence cache hits/misses: {model.sentence_cache.hits}/{model.sentence_cache.misses}")
+        # the cache stays open for the extraction of the same run (-embed T -extract T)
+        model.sentence_cache.commit()
 
     ss_scores = []
     for model_name in ["roberta", "all-MiniLM-L6-v2"]:
@@ -192,167 +275,90 @@ if generic_args.embed:
 
 if generic_args.extract:
     corrupted_flag = generic_args.extract_corrupted
+    corrupted_paths = [""]
     logger_name = "EXTRACT"
     if corrupted_flag:
-        corrupted_dir = generic_args.corrupted_file_dir
-        corruption_type = os.path.basename(corrupted_dir).split("-")[1]
-        logger_name = f"EXTRACT-{corruption_type}"
+        # --corrupted_file_dir is kept for single files; --corrupted_file_dirs accepts many files and globs
+        corrupted_paths = corrupted_files([generic_args.corrupted_file_dir] if generic_args.corrupted_file_dir
+                                          else generic_args.corrupted_file_dirs)
+        assert corrupted_paths, "No corrupted files are given"
+        logger_name = f"EXTRACT-{corruption_type(corrupted_paths[0])}" if len(corrupted_paths) == 1 \
+            else "EXTRACT-SWEEP"
     logger = getLogger(logger_name,
                        dir_=dirname, debug_mode=DEBUG_MODE)
-    start_sample_idx = 0
 
-    result_dir = os.path.join(dirname, "watermarked.txt")
-    if corrupted_flag:
-        logger.info(f"Extracting corrupted watermarks on {corrupted_dir}...")
-        corrupted_watermarked = []
-        with open(corrupted_dir, "r") as reader:
-            for line in reader:
-                line = line.split("[sep] ")
-                corrupted_watermarked.append(line)
-
-    clean_watermarked = get_result_txt(result_dir)
-    num_corrupted_sen = 0
-
-    prev_c_idx = 0
-    agg_msg = []
-    bit_error_agg = {"sentence_err_cnt": 0, "sentence_cnt": 0}
-    infill_match_cnt = 0
-    infill_match_cnt2 = 0
-
-    num_mask_match_cnt = 0
-    zero_cnt = 0
-    one_cnt = 0
-    kwd_match_cnt = 0
-    midx_match_cnt = 0
-    mword_match_cnt = 0
-
-    # agg_sentences = ""
-    # agg_msg = []
-
-    for idx, (c_idx, sen_idx, sub_idset, sub_idx, clean_wm_text, key, msg) in enumerate(clean_watermarked):
-        try:
-            wm_texts = corrupted_watermarked[idx] if corrupted_flag else [clean_wm_text.strip()]
-        except IndexError:
-            logger.debug("Create corrupted samples is less than watermarked. Ending extraction...")
-            break
-        for wm_text in wm_texts:
-            num_corrupted_sen += 1
-            sen = spacy_tokenizer(wm_text.strip())
-            all_keywords, entity_keywords = model.keyword_module.extract_keyword([sen])
-            # for sanity check, we use the uncorrupted watermarked texts
-            sen_ = spacy_tokenizer(clean_wm_text.strip())
-            all_keywords_, entity_keywords_ = model.keyword_module.extract_keyword([sen_])
-
-            logger.info(f"{c_idx} {sen_idx}")
-            # extracting states for corrupted
-            keyword = all_keywords[0]
-            ent_keyword = entity_keywords[0]
-            agg_cwi, agg_probs, tokenized_pt, (mask_idx_pt, mask_idx, mask_word) = model.run_iter(sen, keyword, ent_keyword,
-                                                                                                  train_flag=False, embed_flag=True)
-            wm_keys = model.tokenizer(" ".join([t.text for t in mask_word]), add_special_tokens=False)['input_ids']
-
-            # extracting states for uncorrupted
-            keyword_ = all_keywords_[0]
-            ent_keyword_ = entity_keywords_[0]
-            agg_cwi_, agg_probs_, tokenized_pt_, (mask_idx_pt_, mask_idx_, mask_word_) = model.run_iter(sen_, keyword_, ent_keyword_,
-                                                                                                        train_flag=False, embed_flag=True)
-            kwd_match_flag = set([x.text for x in keyword]) == set([x.text for x in keyword_])
-            if kwd_match_flag:
-                kwd_match_cnt += 1
-
-            midx_match_flag = set(mask_idx) == set(mask_idx_)
-            if midx_match_flag:
-                midx_match_cnt += 1
-
-            mword_match_flag = set([m.text for m in mask_word]) == set([m.text for m in mask_word_])
-            if mword_match_flag:
-                mword_match_cnt += 1
-
-            num_mask_match_flag = len(mask_idx) == len(mask_idx_)
-            if num_mask_match_flag:
-                num_mask_match_cnt += 1
-
-            infill_match_list = []
-            if len(agg_cwi) == len(agg_cwi_):
-                for a, b in zip(agg_cwi, agg_cwi_):
-                    if len(a) == len(b):
-                        infill_match_flag = (a == b).all()
-                    else:
-                        infill_match_flag = False
-                    infill_match_list.append(infill_match_flag)
-            else:
-                infill_match_list.append(False)
-            if all(infill_match_list):
-                infill_match_cnt += 1
-
-            valid_watermarks = []
-            valid_keys = []
-            tokenized_text = [token.text_with_ws for token in sen]
-
-            if len(agg_cwi) > 0:
-                for cwi in product(*agg_cwi):
-                    wm_text = tokenized_text.copy()
-                    for m_idx, c_id in zip(mask_idx, cwi):
-                        wm_text[m_idx] = re.sub(r"\S+", model.tokenizer.decode(c_id), wm_text[m_idx])
-
-                    wm_tokenized = spacy_tokenizer("".join(wm_text).strip())
-                    # extract keyword of watermark
-                    wm_keywords, wm_ent_keywords = model.keyword_module.extract_keyword([wm_tokenized])
-                    wm_kwd = wm_keywords[0]
-                    wm_ent_kwd = wm_ent_keywords[0]
-                    wm_mask_idx, wm_mask = model.mask_selector.return_mask(wm_tokenized, wm_kwd, wm_ent_kwd)
-
-                    # checking whether the watermark can be embedded
-                    mask_match_flag = len(wm_mask) > 0 and set(wm_mask_idx) == set(mask_idx)
-                    if mask_match_flag:
-                        valid_watermarks.append(wm_tokenized.text)
-                        valid_keys.append(torch.stack(cwi).tolist())
-
-            extracted_msg = []
-            if len(valid_keys) > 1:
-                try:
-                    extracted_msg_decimal = valid_keys.index(wm_keys)
-                except:
-                    similarity = [len(set(wm_keys).intersection(x)) for x in valid_keys]
-                    similar_key = max(zip(valid_keys, similarity), key=lambda x: x[1])[0]
-                    extracted_msg_decimal = valid_keys.index(similar_key)
-
-                num_digit = math.ceil(math.log2(len(valid_keys)))
-                extracted_msg = format(extracted_msg_decimal, f"0{num_digit}b")
-                extracted_msg = list(map(int, extracted_msg))
-
-            one_cnt += sum(msg)
-            zero_cnt += len(msg) - sum(msg)
-
-            error_cnt, cnt = compute_ber(msg, extracted_msg)
-            bit_error_agg['sentence_err_cnt'] = bit_error_agg.get('sentence_err_cnt', 0) + error_cnt
-            bit_error_agg['sentence_cnt'] = bit_error_agg.get('sentence_cnt', 0) + cnt
-
-            # logger.info(f"Corrupted sentence: {corrupted_sen}")
-            # logger.info(f"original sentence: {sen}")
-            # logger.info(f"Extracted msg: {' '.join(extracted_key)}")
-            # logger.info(f"Gt msg: {' '.join(key)} \n")
-            # agg_sentences = ""
-            # agg_msg = []
-        if bit_error_agg['sentence_cnt']:
-            logger.info(f"BER: {bit_error_agg['sentence_err_cnt']}/{bit_error_agg['sentence_cnt']}="
-                        f"{bit_error_agg['sentence_err_cnt'] / bit_error_agg['sentence_cnt']:.3f}")
+    checkpoints = {path: file_checkpoint(dirname, path, checkpoint_config) for path in corrupted_paths}
+    states = {path: checkpoints[path].load() if generic_args.resume else None for path in corrupted_paths}
+    reported = [path for path in corrupted_paths if states[path] and states[path].get('reported')]
+    if reported:
+        logger.info(f"Skipping {len(reported)} files that were extracted before: {reported}")
+    corrupted_paths = [path for path in corrupted_paths if path not in reported]
 
-    if corrupted_flag:
-        # logger.info(f"Corruption Rate: {num_corrupted_sen / len(corrupted_watermarked):3f}")
-        with open(os.path.join(dirname, "ber.txt"), "a") as wr:
-            wr.write(f"{corrupted_dir}\t {bit_error_agg['sentence_err_cnt'] / bit_error_agg['sentence_cnt']}\n")
-
-    logger.info(f"Sentence BER: {bit_error_agg['sentence_err_cnt']}/{bit_error_agg['sentence_cnt']}="
-                f"{bit_error_agg['sentence_err_cnt'] / bit_error_agg['sentence_cnt']:.3f}")
-    logger.info(f"Infill match rate {infill_match_cnt/num_corrupted_sen:.3f}")
-    # logger.info(f"Zero to One Ratio {zero_cnt / one_cnt:3f}")
-    logger.info(f"mask index match rate: {midx_match_cnt / num_corrupted_sen:.3f}")
-    logger.info(f"mask word match rate: {mword_match_cnt / num_corrupted_sen:.3f}")
-    logger.info(f"kwd match rate: {kwd_match_cnt / num_corrupted_sen:.3f}")
-    logger.info(f"num. mask match rate: {num_mask_match_cnt / num_corrupted_sen:.3f}")
-
-    # logger.info(f"Sample BER: {bit_error_agg['sample_err_cnt'] / bit_error_agg['sample_cnt']:.3f}")
-
-            
-            
+    result_dir = os.path.join(dirname, "watermarked.txt")
+    clean_watermarked = load_result(result_dir)
+    # the uncorrupted side is shared by all corrupted files
+    num_rows = max([len(read_corrupted(path)) for path in corrupted_paths], default=0) if corrupted_flag \
+        else None
+    logger.info(f"Computing the states of {num_rows or len(clean_watermarked)} uncorrupted watermarked texts...")
+    # with -verify_messages, the payload of a reproducible message source is recomputed to verify watermarked.txt;
+    # the BER is measured against the messages of the file (a recomputed bitstream shifts after the first mismatch)
+    payload_source = None
+    if generic_args.verify_messages and message_source.reproducible:
+        payload_source = get_message_source(generic_args.message_source, generic_args.message_key,
+                                            generic_args.message_bits)
+    elif generic_args.verify_messages:
+        logger.info(f"-verify_messages is ignored: the {generic_args.message_source} source can not be recomputed")
+    clean = clean_states(clean_watermarked, spacy_tokenizer, model, num_rows,
+                         verifier=verifier, message_source=payload_source)
+    if payload_source is not None:
+        num_mismatch = sum(state['message'] != clean_watermarked.column('message')[idx]
+                           for idx, state in enumerate(clean))
+        logger.info(f"{num_mismatch}/{len(clean)} recomputed messages differ from watermarked.txt")
+
+    pool = None
+    if len(corrupted_paths) > 1 and generic_args.num_workers > 1 and get_device().type == "cpu":
+        if model.sentence_cache:
+            model.sentence_cache.commit()
+        num_workers = min(generic_args.num_workers, len(corrupted_paths))
+        num_threads = worker_threads(num_workers, infill_args.num_threads)
+        pool = multiprocessing.get_context("fork").Pool(num_workers, initializer=init_extract_worker,
+                                                        initargs=(spacy_tokenizer, model, verifier,
+                                                                  clean_watermarked, clean, num_threads,
+                                                                  dirname, checkpoint_config, generic_args.resume,
+                                                                  generic_args.checkpoint_every, dirname, DEBUG_MODE))
+        logger.info(f"Extracting {len(corrupted_paths)} files with {num_workers} workers; "
+                    f"the sentences of each file are logged to EXTRACT-<attack>=<pct>-*.log in {dirname}")
+        file_counts = pool.imap(extract_corrupted_file, corrupted_paths)
+    else:
+        if len(corrupted_paths) > 1 and generic_args.num_workers > 1:
+            logger.info("--num_workers is only supported on cpu; extracting serially")
+        file_counts = ((path, extract_file(path, clean_watermarked, clean, spacy_tokenizer, model, verifier,
+                                           logger=logger, checkpoint=checkpoints[path], state=states[path],
+                                           checkpoint_every=generic_args.checkpoint_every))
+                       for path in corrupted_paths)
+
+    for corrupted_dir, counts in file_counts:
+        if corrupted_flag:
+            logger.info(f"Extracted corrupted watermarks on {corrupted_dir}")
+            write_ber(os.path.join(dirname, "ber.txt"), corrupted_dir, counts)
+        num_corrupted_sen = counts['num_sentence']
+        logger.info(f"Sentence BER: {counts['sentence_err_cnt']}/{counts['sentence_cnt']}="
+                    f"{counts['sentence_err_cnt'] / counts['sentence_cnt']:.3f}")
+        logger.info(f"Infill match rate {counts['infill_match_cnt'] / num_corrupted_sen:.3f}")
+        # logger.info(f"Zero to One Ratio {counts['zero_cnt'] / counts['one_cnt']:3f}")
+        logger.info(f"mask index match rate: {counts['midx_match_cnt'] / num_corrupted_sen:.3f}")
+        logger.info(f"mask word match rate: {counts['mword_match_cnt'] / num_corrupted_sen:.3f}")
+        logger.info(f"kwd match rate: {counts['kwd_match_cnt'] / num_corrupted_sen:.3f}")
+        logger.info(f"num. mask match rate: {counts['num_mask_match_cnt'] / num_corrupted_sen:.3f}")
+        # a resumed run does not write the line of this file to ber.txt again
+        checkpoints[corrupted_dir].save({'idx': len(clean), 'counts': counts, 'done': True, 'reported': True})
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if model.sentence_cache:
+        logger.info(f"sentence cache hits/misses: {model.sentence_cache.hits}/{model.sentence_cache.misses}")
+
+# closed once, after all modes of the run
+if model.sentence_cache:
+    model.sentence_cache.close()
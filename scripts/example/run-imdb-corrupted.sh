@@ -42,6 +42,8 @@ if [ $CORRUPT = "T" ] ; then
   ATTACKM="insertion substitution deletion"
   PCT_RANGE="0.025"
   NUM_SENTENCE=1000
+  # files written by this run; a glob would also pick up the files of earlier sweeps
+  CORRUPTED_FILES=""
 
   SEED=$(seq 0 0)
   for seed in $SEED
@@ -61,17 +63,20 @@ if [ $CORRUPT = "T" ] ; then
                                                  --path2embed "results/ours/${DTYPE}/${NAME}/watermarked.txt"\
                                                  --attack_type $attm --num_sentence $NUM_SENTENCE --ss_thres $SS_THRES \
                                                  --num_corr_per_sentence $ncps
-
-        python ./ours.py -do_watermark T -extract T -extract_corrupted T --dtype $DTYPE \
-                         --corrupted_file_dir "./results/ours/${DTYPE}/${NAME}/watermarked-${attm}=${apct}.txt"\
-                         --exp_name $NAME --spacy_model $SPACYM --model_ckpt $CKPT \
-                        --keyword_ratio $KR \
-                        --topk $TOPK \
-                        --mask_select_method $MASK_S \
-                        --mask_order_by $MASK_ORDER_BY \
-                        --keyword_mask $K_MASK -exclude_cc $EXCLUDE_CC
-
+        CORRUPTED_FILES="$CORRUPTED_FILES ./results/ours/${DTYPE}/${NAME}/watermarked-${attm}=${apct}.txt"
       done
     done
   done
+
+  # all corrupted files are extracted in one run; the uncorrupted side is computed once
+  NWORKERS=4
+  python ./ours.py -do_watermark T -extract T -extract_corrupted T --dtype $DTYPE \
+                   --corrupted_file_dirs $CORRUPTED_FILES \
+                   --num_workers $NWORKERS \
+                   --exp_name $NAME --spacy_model $SPACYM --model_ckpt $CKPT \
+                   --keyword_ratio $KR \
+                   --topk $TOPK \
+                   --mask_select_method $MASK_S \
+                   --mask_order_by $MASK_ORDER_BY \
+                   --keyword_mask $K_MASK -exclude_cc $EXCLUDE_CC
 fi
\ No newline at end of file
@@ -3,6 +3,8 @@ export CUDA_VISIBLE_DEVICES=1
 NAME="exp"
 SPACYM="en_core_web_sm"
 DTYPE="imdb"
+# masked-LM results of the embed run are reused by the extraction runs
+PREFIX_CACHE="./data/cache/contextls-prefix.sqlite"
 
 mkdir -p "results/context-ls/${DTYPE}/${NAME}"
 cp "$0" "results/context-ls/${DTYPE}/${NAME}"
@@ -14,6 +16,7 @@ python context-ls.py \
       --exp_name $NAME\
       --spacy_model $SPACYM\
       --dtype $DTYPE\
+      --prefix_cache $PREFIX_CACHE\
       -metric_only $METRIC_ONLY
 
 
@@ -21,6 +24,8 @@ SS_THRES=0.98
 ATTACKM="insertion substitution"
 PCT_RANGE="0.025"
 NUM_SENTENCE=1000
+# files written by this run; a glob would also pick up the files of earlier sweeps
+CORRUPTED_FILES=""
 
 for apct in $PCT_RANGE
 do
@@ -38,8 +43,12 @@ for attm in $ATTACKM
                                              --path2embed "results/context-ls/${DTYPE}/${NAME}/watermarked.txt"\
                                              --attack_type $attm --num_sentence $NUM_SENTENCE --ss_thres $SS_THRES \
                                              --num_corr_per_sentence $ncps
-
-    python context-ls.py -extract T -extract_corrupted T --exp_name $NAME --dtype $DTYPE --num_sample 5000 \
-                        --corrupted_file_dir "./results/context-ls/${DTYPE}/${NAME}/watermarked-${attm}=${ATTACK_PCT}.txt"
+    CORRUPTED_FILES="$CORRUPTED_FILES ./results/context-ls/${DTYPE}/${NAME}/watermarked-${attm}=${apct}.txt"
   done
-done
\ No newline at end of file
+done
+
+# all corrupted files are extracted in one run
+NWORKERS=4
+python context-ls.py -extract T -extract_corrupted T --exp_name $NAME --dtype $DTYPE --num_sample 5000 \
+                    --corrupted_file_dirs $CORRUPTED_FILES \
+                    --num_workers $NWORKERS --prefix_cache $PREFIX_CACHE
\ No newline at end of file
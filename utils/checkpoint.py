@@ -0,0 +1,63 @@
+import json
+import os
+import random
+
+
+def rng_state():
+    version, internal, gauss = random.getstate()
+    return [version, list(internal), gauss]
+
+
+def set_rng_state(state):
+    version, internal, gauss = state
+    random.setstate((version, tuple(internal), gauss))
+
+
+class Checkpoint:
+    """
+    Progress of a long run (last completed position, running counters, RNG state, ...) saved as json.
+    The file is replaced atomically, so a preempted run leaves either the previous or the new checkpoint.
+    config: arguments of the run; a checkpoint written with a different config is not resumed
+    """
+    def __init__(self, path, config=None):
+        self.path = path
+        self.config = json.loads(json.dumps(config, sort_keys=True, default=str)) if config is not None else None
+
+    def load(self):
+        """
+        Output: saved state (dict) or None if there is no checkpoint
+        """
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, "r") as f:
+            checkpoint = json.load(f)
+        if self.config is not None and checkpoint.get('config') != self.config:
+            raise ValueError(f"{self.path} was written with different arguments; "
+                             f"remove it or run without -resume")
+        return checkpoint['state']
+
+    def save(self, state):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'config': self.config, 'state': state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def sync(wr):
+    # the offset saved in a checkpoint must point to data that is on disk
+    wr.flush()
+    os.fsync(wr.fileno())
+    return wr.tell()
+
+
+def truncate(path, offset):
+    # drops the lines written after the checkpoint
+    with open(path, "r+") as f:
+        f.truncate(offset)
@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import copy
 from datetime import datetime
 import logging
@@ -6,67 +7,98 @@ import string
 import re
 
 
-from nltk.stem import WordNetLemmatizer
-from nltk.stem.porter import PorterStemmer
-from nltk.corpus import stopwords
-
+import torch
 from transformers import AutoTokenizer, pipeline
 
-tokenizer = AutoTokenizer.from_pretrained("bert-base-cased")
+from config import stop
+from utils.lazy import Lazy
+from utils.device import inference_mode
+from utils.model_registry import get_model, get_tokenizer
+from utils.sentence_cache import SentenceCache
+from utils.vocab_utils import VocabTable
+
+tokenizer = Lazy(lambda: get_tokenizer("bert-base-cased"), "bert-base-cased tokenizer")
 
 from transformers import pipeline, AutoModelForMaskedLM
 
 _calls_to_lm = 0
 # model = AutoModelForMaskedLM.from_pretrained("ckpt/mask=random-forward-p=15/last/")
 # pipe_fill_mask = pipeline('fill-mask', model=model, tokenizer='bert-base-cased', device=0, top_k=32)
-pipe_fill_mask = pipeline('fill-mask', model='bert-base-cased', device=0, top_k=32)
-pipe_classification = pipeline(model="roberta-large-mnli", device=0, top_k=None)
+# models are shared with the other modules (e.g. Metric) through the registry
+# the masked LM is run on token ids directly instead of through the fill-mask pipeline
+fill_mask_model = Lazy(lambda: get_model('bert-base-cased', kind='masked_lm'), "bert-base-cased")
+fill_mask_topk = 32
+# decoded string of every token id, as returned by the fill-mask pipeline
+token_strs = Lazy(lambda: tokenizer.batch_decode([[x] for x in range(len(tokenizer))]), "bert-base-cased token strings")
+nli_model = Lazy(lambda: get_model("roberta-large-mnli", kind='sequence_classification'), "roberta-large-mnli")
+nli_tokenizer = Lazy(lambda: get_tokenizer("roberta-large-mnli"), "roberta-large-mnli tokenizer")
+# entailment probabilities of the replaced LS inputs; overlapping contexts of the synchronicity test repeat them
+_entail_cache = OrderedDict()
+entail_cache_size = 100000
+entail_batch_size = 64
+# filtered candidates (with entailment scores) keyed by the token-id prefix; neighbouring indices, the
+# substitutability test and extraction query overlapping prefixes
+_prefix_memo = OrderedDict()
+prefix_memo_size = 200000
+prefix_memo_stats = {'hits': 0, 'misses': 0}
+# optional SentenceCache that persists the memo between embed and extract runs (see enable_prefix_cache)
+_prefix_cache = None
 sr_threshold = 0.95
-stop = set(stopwords.words('english'))
 punctuation = set(string.punctuation)
-riskset = stop.union(punctuation)
+riskset = Lazy(lambda: stop.union(punctuation), "riskset")
+# properties of every token id of the fill-mask tokenizer (shared with InfillModel through the disk cache)
+vocab_table = Lazy(lambda: VocabTable(tokenizer), "bert-base-cased vocab table")
+# tokens that can be a substitute at all: no subwords, riskset words or punctuation
+eligible_vocab = Lazy(lambda: ~vocab_table.is_subword & ~vocab_table.has_punct & ~vocab_table.in_set(riskset),
+                      "eligible vocab")
 topk = 2
 
 
 def synchronicity_test(index, local_context):
-    mask_candidates = generate_substitute_candidates(local_context, topk=topk)
-
-    if local_context[-2] not in [word['token'] for word in mask_candidates]:
-        return False, None
-
-    if len(mask_candidates) < 2:  # skip this word; do not exist appropriate candidates
-        return False, None
-
-    FC_sets = []
-    for k in range(len(mask_candidates)):
-        mask_candidates_k = generate_substitute_candidates(tokenizer(mask_candidates[k]['sequence'],
-                                                                   add_special_tokens=False)['input_ids'][index + 2:],
-                                                         topk=topk)
-        FC_sets.append([word['token_str'] for word in mask_candidates_k])
-
-    # top1_processed = tokenizer(mask_candidates[0]['sequence'], add_special_tokens=False)['input_ids'][index + 2:]
-    # top2_processed = tokenizer(mask_candidates[1]['sequence'], add_special_tokens=False)['input_ids'][index + 2:]
-
-    # mask_candidates1 = generate_substitute_candidates(top1_processed)
-    # mask_candidates2 = generate_substitute_candidates(top2_processed)
-
-    # FC1 = [word['token_str'] for word in mask_candidates1]
-    # FC2 = [word['token_str'] for word in mask_candidates2]
-
-    FC = [word['token_str'] for word in mask_candidates]
-    sync_flag = True
-    for k in range(len(FC_sets)):
-        if set(FC) != set(FC_sets[k]):
-            sync_flag = False
-            break
-
-    return sync_flag, [word['token'] for word in mask_candidates]
+    return synchronicity_test_batch(index, [local_context])[0]
+
+
+def synchronicity_test_batch(index, local_contexts):
+    """
+    Synchronicity test of several contexts (e.g. the substitutability probes of a position).
+    The candidates of all contexts, and then the follow-up candidates of all their top-k words,
+    are each generated with a single batched fill-mask call.
+    Output: List[(is_synch, candidate token ids)] for each context
+    """
+    all_mask_candidates = generate_substitute_candidates_batch(local_contexts, topk=topk)
+
+    results = [(False, None)] * len(local_contexts)
+    followups = []
+    for c_idx, (local_context, mask_candidates) in enumerate(zip(local_contexts, all_mask_candidates)):
+        if local_context[-2] not in [word['token'] for word in mask_candidates]:
+            continue
+        if len(mask_candidates) < 2:  # skip this word; do not exist appropriate candidates
+            continue
+        for k in range(len(mask_candidates)):
+            # the context with the k-th candidate substituted
+            followups.append((c_idx, mask_candidates[k]['context_ids']))
+
+    FC_sets = {}
+    followup_candidates = generate_substitute_candidates_batch([text for _, text in followups], topk=topk)
+    for (c_idx, _), mask_candidates_k in zip(followups, followup_candidates):
+        FC_sets.setdefault(c_idx, []).append([word['token_str'] for word in mask_candidates_k])
+
+    for c_idx, fc_sets in FC_sets.items():
+        mask_candidates = all_mask_candidates[c_idx]
+        FC = [word['token_str'] for word in mask_candidates]
+        sync_flag = True
+        for k in range(len(fc_sets)):
+            if set(FC) != set(fc_sets[k]):
+                sync_flag = False
+                break
+        results[c_idx] = (sync_flag, [word['token'] for word in mask_candidates])
+    return results
 
 
 def substitutability_test(new_context, index, words):
-    for w in words:
-        new_context[-1] = w
-        is_synch, _ = synchronicity_test(index - 1, new_context)
+    # probes of all substitute words are tested together
+    contexts = [new_context[:-1] + [w] for w in words]
+    for is_synch, _ in synchronicity_test_batch(index - 1, contexts):
         if is_synch:
             return False
     return True
@@ -79,53 +111,199 @@ def concatenate_for_ls(text):
     return tokenizer.decode(tokens_for_ls)
 
 
+def concatenate_for_ls_ids(text):
+    # [CLS] context [SEP] masked context [SEP]; the mask is at position 2 * len(text)
+    masked_text = list(text)
+    masked_text[-2] = tokenizer.mask_token_id
+    return [tokenizer.cls_token_id] + list(text) + [tokenizer.sep_token_id] + masked_text + [tokenizer.sep_token_id]
+
+
+def fill_mask_ids(texts_processed, top_k=fill_mask_topk):
+    """
+    Top-k predictions for the masked word of the LS inputs of several contexts in one padded forward pass
+    texts_processed: List[List[token id]]
+    Output: List[List[dict]] with the token id, its string, its probability and the context with the token
+            substituted (context_ids) in descending probability
+    """
+    inputs = [concatenate_for_ls_ids(text_processed) for text_processed in texts_processed]
+    max_len = max(len(ids) for ids in inputs)
+    input_ids = torch.full((len(inputs), max_len), tokenizer.pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(inputs), max_len), dtype=torch.long)
+    for i, ids in enumerate(inputs):
+        input_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[i, :len(ids)] = 1
+    mask_pos = torch.tensor([2 * len(text_processed) for text_processed in texts_processed], dtype=torch.long)
+
+    device = getattr(fill_mask_model, 'device', torch.device("cpu"))
+    with inference_mode():
+        logits = fill_mask_model(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device),
+                                 token_type_ids=torch.zeros_like(input_ids).to(device)).logits
+        probs = logits[torch.arange(len(inputs), device=logits.device), mask_pos.to(logits.device)].float().softmax(-1)
+        top_probs, top_ids = probs.topk(top_k, dim=-1)
+
+    outputs = []
+    for text_processed, p_row, id_row in zip(texts_processed, top_probs.tolist(), top_ids.tolist()):
+        candidates = []
+        for p, c_id in zip(p_row, id_row):
+            context_ids = list(text_processed)
+            context_ids[-2] = c_id
+            candidates.append({'token': c_id, 'token_str': token_strs[c_id], 'score': p, 'context_ids': context_ids})
+        outputs.append(candidates)
+    return outputs
+
+
 def generate_substitute_candidates(text_processed, topk=2):
+    return generate_substitute_candidates_batch([text_processed], topk=topk)[0]
+
+
+def generate_substitute_candidates_batch(texts_processed, topk=2):
+    """
+    Substitute candidates of several contexts with one masked-LM forward pass (see fill_mask_ids);
+    contexts that were seen before are served from the prefix memo
+    texts_processed: List[List[token id]]
+    Output: List[candidates] for each context in the same order
+    """
+    outputs = [None] * len(texts_processed)
+    missing = {}
+    for idx, text_processed in enumerate(texts_processed):
+        key = (tuple(text_processed), topk)
+        cached = _get_prefix(key)
+        if cached is None:
+            missing.setdefault(key, []).append(idx)
+        else:
+            outputs[idx] = cached
+
+    if missing:
+        computed = _generate_substitute_candidates([list(key[0]) for key in missing], topk)
+        for (key, indices), mask_candidates in zip(missing.items(), computed):
+            _put_prefix(key, mask_candidates)
+            for idx in indices:
+                outputs[idx] = mask_candidates
+    return outputs
+
+
+def _get_prefix(key):
+    if key in _prefix_memo:
+        _prefix_memo.move_to_end(key)
+        prefix_memo_stats['hits'] += 1
+        return _prefix_memo[key]
+    cached = _prefix_cache.get(" ".join(map(str, key[0])), f"topk={key[1]}") if _prefix_cache else None
+    if cached is None:
+        prefix_memo_stats['misses'] += 1
+        return None
+    prefix_memo_stats['hits'] += 1
+    _put_prefix(key, cached, persist=False)
+    return cached
+
+
+def _put_prefix(key, mask_candidates, persist=True):
+    _prefix_memo[key] = mask_candidates
+    while len(_prefix_memo) > prefix_memo_size:
+        _prefix_memo.popitem(last=False)
+    if persist and _prefix_cache:
+        _prefix_cache.put(" ".join(map(str, key[0])), mask_candidates, f"topk={key[1]}")
+
+
+def enable_prefix_cache(path, max_entries=1000000):
+    """
+    Persists the prefix memo in a SQLite file, so that extraction reuses the results of the embed run
+    """
+    global _prefix_cache
+    config = {'fill_mask': 'bert-base-cased', 'nli': 'roberta-large-mnli', 'top_k': fill_mask_topk,
+              'sr_threshold': sr_threshold, 'engine': 'token_ids'}
+    _prefix_cache = SentenceCache(path, config, max_entries=max_entries)
+    return _prefix_cache
+
+
+def commit_prefix_cache():
+    if _prefix_cache:
+        _prefix_cache.commit()
+
+
+def reconnect_prefix_cache():
+    # sqlite connections must not be shared with forked workers; the workers commit every write
+    # and the main process evicts when the cache is closed (see utils.sentence_cache)
+    if _prefix_cache:
+        _prefix_cache.reconnect()
+
+
+def close_prefix_cache():
+    global _prefix_cache
+    if _prefix_cache:
+        _prefix_cache.close()
+        _prefix_cache = None
+
+
+def _generate_substitute_candidates(texts_processed, topk):
     global _calls_to_lm
-    text_for_ls = concatenate_for_ls(text_processed)
-    mask_candidates = pipe_fill_mask(text_for_ls)
+    all_mask_candidates = fill_mask_ids(texts_processed)
     _calls_to_lm += 1
 
-    # filter out words with only difference in cases (lowercase, uppercase)
-    text = tokenizer.decode(text_processed[-2])
-    mask_candidates = list(filter(lambda x: not (x['token_str'].lower() == text.lower() and
-                                            x['token_str'] != text) , mask_candidates))
-
-    # filter out subword tokens
-    mask_candidates = list(filter(lambda x: not x['token_str'].startswith("##"), mask_candidates))
-
-    # filter out morphological derivations
-    porter_stemmer = PorterStemmer()
-    text_lm = porter_stemmer.stem(text)
-    mask_candidates = \
-        list(filter(lambda x: porter_stemmer.stem(x['token_str']) != text_lm
-                              or x['token_str']==text, mask_candidates))
-
-    lemmatizer = WordNetLemmatizer()
-    for pos in ["v", "n", "a", "r", "s"]:
-        text_lm = lemmatizer.lemmatize(text, pos)
-        mask_candidates = \
-            list(filter(lambda x: lemmatizer.lemmatize(x['token_str'], pos) != text_lm
-                                  or x['token_str']==text, mask_candidates))
-    # filter out riskset
-    mask_candidates = list(filter(lambda x: x['token_str'] not in riskset, mask_candidates))
-    # filter out words with any punctuations
-    mask_candidates = list(filter(lambda x: not any(s for s in x['token_str'] if s in string.punctuation),
-                                  mask_candidates))
-
-
-    # get entailment scores
-    for item in mask_candidates:
-        replaced = text_for_ls.replace('[MASK]', item['token_str'])
-        entail_result = pipe_classification(replaced)
-        item['entail_score'] = [i for i in entail_result[0] if i['label']=='ENTAILMENT'][0]['score']
-
-    # sort in descending order
-    mask_candidates = sorted(mask_candidates, key=lambda x: x['entail_score'], reverse=True)
-
-    # filter out with sr_threshold
-    mask_candidates = list(filter(lambda x: x['entail_score'] > sr_threshold, mask_candidates))
-
-    return mask_candidates[:topk]
+    all_mask_candidates = [_filter_candidates(text_processed, mask_candidates)
+                           for text_processed, mask_candidates in zip(texts_processed, all_mask_candidates)]
+
+    # get entailment scores of the candidates of all contexts at once;
+    # the nli model has its own tokenizer, so only the contexts with candidates are decoded
+    replaced = []
+    for text_processed, mask_candidates in zip(texts_processed, all_mask_candidates):
+        if mask_candidates:
+            text_for_ls = concatenate_for_ls(text_processed)
+            replaced.extend(text_for_ls.replace('[MASK]', item['token_str']) for item in mask_candidates)
+    scores = iter(entailment_scores(replaced).tolist())
+    for mask_candidates in all_mask_candidates:
+        for item in mask_candidates:
+            item['entail_score'] = next(scores)
+
+    outputs = []
+    for mask_candidates in all_mask_candidates:
+        # sort in descending order
+        mask_candidates = sorted(mask_candidates, key=lambda x: x['entail_score'], reverse=True)
+
+        # filter out with sr_threshold
+        mask_candidates = list(filter(lambda x: x['entail_score'] > sr_threshold, mask_candidates))
+        outputs.append(mask_candidates[:topk])
+    return outputs
+
+
+def entailment_scores(texts):
+    """
+    Probabilities of ENTAILMENT of the LS inputs ("context [SEP] replaced context") in padded batches.
+    Texts that were scored before are served from the cache.
+    Output: torch.Tensor [len(texts)]
+    """
+    missing = list(OrderedDict.fromkeys(text for text in texts if text not in _entail_cache))
+    if missing:
+        config = getattr(nli_model, 'config', None)
+        entail_idx = config.label2id.get('ENTAILMENT', 2) if config is not None else 2
+        device = getattr(nli_model, 'device', torch.device("cpu"))
+        for start in range(0, len(missing), entail_batch_size):
+            batch = missing[start:start + entail_batch_size]
+            inputs = nli_tokenizer(batch, return_tensors="pt", padding="longest")
+            inputs = {k: v.to(device) for k, v in inputs.items()}
+            with inference_mode():
+                probs = nli_model(**inputs).logits.float().softmax(dim=-1)[:, entail_idx]
+            for text, prob in zip(batch, probs.tolist()):
+                _entail_cache[text] = prob
+
+    scores = []
+    for text in texts:
+        _entail_cache.move_to_end(text)
+        scores.append(_entail_cache[text])
+    while len(_entail_cache) > entail_cache_size:
+        _entail_cache.popitem(last=False)
+    return torch.tensor(scores)
+
+
+def _filter_candidates(text_processed, mask_candidates):
+    """
+    Drops candidates that only differ in case, subword tokens, morphological derivations (same stem or lemma),
+    words in the riskset and words with punctuation. All properties are looked up in the vocabulary table.
+    """
+    if len(mask_candidates) == 0:
+        return mask_candidates
+    candidate_ids = torch.tensor([x['token'] for x in mask_candidates], dtype=torch.long)
+    keep = eligible_vocab[candidate_ids] & vocab_table.derivation_mask_of_id(candidate_ids, text_processed[-2])
+    return [x for x, k in zip(mask_candidates, keep.tolist()) if k]
 
 
 def compute_bpw_(result_path, type="log_sum"):
@@ -0,0 +1,169 @@
+from collections import Counter
+import json
+import math
+import os
+import shutil
+
+from spacy.tokens import DocBin
+
+
+def document_sentences(doc):
+    return [sent for sent in doc.sents if len(sent.text.strip()) > 0]
+
+
+class LengthHistogram:
+    """
+    Streaming sketch of sentence lengths. Lengths are integers with a small range,
+    so a histogram gives the same quantiles as np.quantile (linear interpolation) over the full list
+    with memory proportional to the number of distinct lengths.
+    """
+    def __init__(self, counts=None):
+        self.counts = Counter()
+        if counts:
+            self.update_counts(counts)
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def update(self, lengths):
+        self.counts.update(lengths)
+
+    def update_counts(self, counts):
+        for length, cnt in counts.items():
+            self.counts[int(length)] += cnt
+
+    def _order_statistic(self, k):
+        # k-th smallest value (0-indexed)
+        seen = 0
+        for length in sorted(self.counts):
+            seen += self.counts[length]
+            if k < seen:
+                return length
+        raise IndexError(k)
+
+    def quantile(self, q):
+        n = len(self)
+        if n == 0:
+            raise ValueError("quantile of an empty histogram")
+        pos = (n - 1) * q
+        lo = math.floor(pos)
+        lo_value = self._order_statistic(lo)
+        if lo == pos:
+            return float(lo_value)
+        hi_value = self._order_statistic(lo + 1)
+        return lo_value + (pos - lo) * (hi_value - lo_value)
+
+
+class CorpusStore:
+    """
+    Parsed corpus stored as shards of spacy DocBin with an index of the document offsets of every shard.
+    Loading documents [start:start+n] only reads the shards that overlap the range.
+    The index also keeps a histogram of the sentence lengths of every shard so that length statistics
+    of the corpus can be computed without deserializing any document.
+    Every shard is committed to the index as soon as it is written, so an interrupted parse
+    resumes from the last complete shard.
+    """
+    def __init__(self, path, shard_size=1000):
+        self.path = path
+        self.index_path = os.path.join(path, "index.json")
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        else:
+            self.index = {'shard_size': shard_size, 'shards': [], 'complete': False}
+
+    @property
+    def complete(self):
+        return self.index['complete']
+
+    def __len__(self):
+        return sum(shard['num_docs'] for shard in self.index['shards'])
+
+    def reset(self, shard_size=None):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        self.index = {'shard_size': shard_size or self.index['shard_size'], 'shards': [], 'complete': False}
+
+    def write(self, docs):
+        """
+        Write an iterable of spacy Docs in shards; only one shard is held in memory at a time
+        """
+        for _ in self.iter_write(docs):
+            pass
+
+    def iter_write(self, docs):
+        """
+        Same as write, but yields every Doc as soon as it is buffered.
+        The store is marked complete only if the generator is exhausted.
+        """
+        buffer = []
+        for doc in docs:
+            buffer.append(doc)
+            yield doc
+            if len(buffer) == self.index['shard_size']:
+                self.append_shard(buffer)
+                buffer = []
+        if buffer:
+            self.append_shard(buffer)
+        self.mark_complete()
+
+    def append_shard(self, docs):
+        os.makedirs(self.path, exist_ok=True)
+        shard_idx = len(self.index['shards'])
+        filename = f"shard-{shard_idx:05d}.spacy"
+        doc_bin = DocBin(store_user_data=False, docs=docs)
+        doc_bin.to_disk(os.path.join(self.path, filename))
+
+        lengths = Counter(len(sent) for doc in docs for sent in document_sentences(doc))
+        self.index['shards'].append({'file': filename, 'start': len(self), 'num_docs': len(docs),
+                                     'length_hist': lengths})
+        self._save_index()
+
+    def thresholds(self, cutoff_q):
+        """
+        Output: (lower, upper) sentence length thresholds stored for the cutoff quantiles, or None
+        """
+        thresholds = self.index.get('thresholds', {}).get(self._quantile_key(cutoff_q))
+        return tuple(thresholds) if thresholds is not None else None
+
+    def set_thresholds(self, cutoff_q, thresholds):
+        # stored with the corpus so that every run that reads it filters the same sentences
+        self.index.setdefault('thresholds', {})[self._quantile_key(cutoff_q)] = list(thresholds)
+        self._save_index()
+
+    @staticmethod
+    def _quantile_key(cutoff_q):
+        return ",".join(map(str, cutoff_q))
+
+    def mark_complete(self):
+        self.index['complete'] = True
+        self._save_index()
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def length_histogram(self):
+        hist = LengthHistogram()
+        for shard in self.index['shards']:
+            hist.update_counts(shard['length_hist'])
+        return hist
+
+    def load(self, vocab, start=0, num=None):
+        """
+        Returns the documents [start:start+num] (all remaining documents if num is None)
+        """
+        return list(self.iter_docs(vocab, start, num))
+
+    def iter_docs(self, vocab, start=0, num=None):
+        end = len(self) if num is None else min(start + num, len(self))
+        for shard in self.index['shards']:
+            shard_start, shard_end = shard['start'], shard['start'] + shard['num_docs']
+            if shard_end <= start or shard_start >= end:
+                continue
+            doc_bin = DocBin().from_disk(os.path.join(self.path, shard['file']))
+            for doc_idx, doc in enumerate(doc_bin.get_docs(vocab), start=shard_start):
+                if start <= doc_idx < end:
+                    yield doc
@@ -8,6 +8,7 @@ import re
 from datasets import load_dataset
 import spacy
 from tqdm import tqdm
+from utils.corpus_store import CorpusStore, document_sentences
 from utils.logging import getLogger
 
 RAW_DATA_DIR = "./data/raw_data"
@@ -162,39 +163,53 @@ def change_str_to_int(listed_str):
     return int_str
 
 
+def parse_result_line(line, sep='\t'):
+    line = line.split(sep)
+    if len(line) == 7:
+        # corpus idx
+        line[0] = int(line[0])
+        # sentence idx
+        line[1] = int(line[1])
+        # substituted idset
+        line[2] = [change_str_to_int(listed_str.split(" ")) for
+                   listed_str in line[2].split(",")[:-1]]
+        # substituted index
+        line[3] = change_str_to_int(line[3].split(" "))
+        # watermarked text
+        line[4] = line[4].strip() if len(line[4]) > 0 else ""
+        # substituted text
+        line[5] = [x.strip() for x in line[5].split(',')]
+        # embedded message
+        if line[6].strip():
+            line[6] = [int(x) for x in line[6].strip().split(" ")]
+        else:
+            line[6] = []
+    else:
+        line = ["eos"] * 7
+    return line
+
+
 def get_result_txt(result_txt, sep='\t'):
     results = []
     with open(f"{result_txt}", "r") as reader:
         for line in reader:
-            line = line.split(sep)
-            if len(line) == 7:
-                # corpus idx
-                line[0] = int(line[0])
-                # sentence idx
-                line[1] = int(line[1])
-                # substituted idset
-                line[2] = [change_str_to_int(listed_str.split(" ")) for
-                           listed_str in line[2].split(",")[:-1]]
-                # substituted index
-                line[3] = change_str_to_int(line[3].split(" "))
-                # watermarked text
-                line[4] = line[4].strip() if len(line[4]) > 0 else ""
-                # substituted text
-                line[5] = [x.strip() for x in line[5].split(',')]
-                # embedded message
-                if line[6].strip():
-                    line[6] = [int(x) for x in line[6].strip().split(" ")]
-                else:
-                    line[6] = []
-            else:
-                line = ["eos"] * 7
-            results.append(line)
+            results.append(parse_result_line(line, sep))
     return results
 
 
 def preprocess2sentence(corpus, corpus_name, start_sample_idx, num_sample=3000,
                         population_size=3000, cutoff_q=(0.05, 0.95),
-                        spacy_model="en_core_web_sm", use_cache=True):
+                        spacy_model="en_core_web_sm", use_cache=True,
+                        batch_size=64, n_process=4, stream=False, warmup=100):
+    """
+    Splits documents into sentences with spacy and filters out sentences whose length is outside the
+    cutoff_q quantiles of the sentence lengths of the population.
+    Output: List[List[Spacy.Span]] of the documents [start_sample_idx:start_sample_idx+num_sample]
+    stream: return a generator that yields the sentences of each document as soon as it is parsed.
+            If the corpus is not cached yet, the quantiles are estimated once from the first warmup documents.
+    The length thresholds are stored with the parsed corpus the first time they are computed, so streamed,
+    non-streamed and resumed runs on the same corpus keep the same sentences.
+    """
     population_size = max(population_size, start_sample_idx + num_sample)
     id = f"{corpus_name}-{spacy_model}"
     if corpus_name in ['dracula']:
@@ -202,62 +217,145 @@ def preprocess2sentence(corpus, corpus_name, start_sample_idx, num_sample=3000,
     if not os.path.isdir(CACHE_DIR):
       os.makedirs(CACHE_DIR, exist_ok=True)
     file_dir = os.path.join(CACHE_DIR, id+".pkl")
+    store = CorpusStore(os.path.join(CACHE_DIR, id))
+
+    if use_cache and store.complete:
+      logger.info(f"Using cache {store.path}")
 
-    if use_cache and os.path.isfile(file_dir):
-      logger.info(f"Using cache {file_dir}")
+    elif use_cache and os.path.isfile(file_dir):
+      # convert the pickled cache of older versions to the shard store
+      logger.info(f"Converting cache {file_dir} to {store.path}")
       with open(file_dir, "rb") as f:
         docs = pickle.load(f)
+      store.reset()
+      store.write(docs)
+      del docs
 
     else:
-      logger.info(f"Processing corpus with {spacy_model}...")
-      nlp = spacy.load(spacy_model)
-      corpus = corpus[:population_size]
-      docs = []
-      num_workers = 4
-      if "trf" in spacy_model:
-        for c in corpus:
-          docs.append(nlp(c))
+      if use_cache and len(store) > 0:
+        logger.info(f"Resuming {store.path} from document {len(store)}")
       else:
-        for doc in nlp.pipe(corpus, n_process=num_workers):
-          docs.append(doc)
+        store.reset()
+      docs = _parse_corpus(corpus[len(store):population_size], spacy_model, batch_size, n_process)
+      if stream:
+        return _stream_parsed(store, docs, spacy.blank(spacy_model.split("_")[0]).vocab,
+                              start_sample_idx, num_sample, cutoff_q, warmup)
 
       logger.info(f"Caching preprocessed sentences")
-      with open(file_dir, "wb") as f:
-        pickle.dump(docs, f)
-
-    lengths = []
-    sentence_tokenized = []
-    sentence_list = []
+      store.write(docs)
+
+    thresholds = store.thresholds(cutoff_q)
+    if thresholds is None:
+      thresholds = _length_thresholds(store.length_histogram(), cutoff_q)
+      store.set_thresholds(cutoff_q, thresholds)
+    docs = store.iter_docs(spacy.blank(spacy_model.split("_")[0]).vocab, start_sample_idx, num_sample)
+    filtered = _filter_sentences(docs, thresholds)
+    if stream:
+      return filtered
+
+    filtered = list(filtered)
+    # post_processed_length = []
+    # for sentences in filtered:
+    #     post_processed_length.extend([len(sen) for sen in sentences])
+    #
+    # print([np.quantile(post_processed_length, q) for q in [0.1, 0.25, 0.5, 0.75, 0.9]])
+    # print(min(post_processed_length))
+    # print(max(post_processed_length))
+    return filtered
 
-    for doc in docs:
-        lengths.extend([len(sent) for sent in doc.sents if len(sent.text.strip()) > 0])
-        sentence_tokenized.append([sent for sent in doc.sents if len(sent.text.strip()) > 0])
-        sentence_list.extend([(sent, len(sent)) for sent in doc.sents if len(sent.text.strip()) > 0])
 
-    sentence_list.sort(key=lambda x: x[1])  # for debugging
-    l_threshold = np.quantile(lengths, cutoff_q[0])
+def take_sentences(documents, num_sample):
+    """
+    Truncates the cover texts before the document at which num_sample sentences are reached
+    (the last document is dropped if they are never reached), without materializing a stream.
+    The remaining documents are still consumed after the last one is yielded, so that a streamed parse
+    completes its corpus store.
+    documents: iterable of List[Spacy.Span] (e.g. the output of preprocess2sentence)
+    Output: generator of the kept documents
+    """
+    num_sentence = 0
+    previous = None
+    documents = iter(documents)
+    for sentences in documents:
+        if previous is not None:
+            yield previous
+        num_sentence += len(sentences)
+        if num_sentence >= num_sample:
+            break
+        previous = sentences
+    for _ in documents:
+        pass
+
+
+def keep_documents(documents, kept):
+    # passes a stream through while keeping its documents for the metrics of the run
+    for sentences in documents:
+        kept.append(sentences)
+        yield sentences
+
+
+def _parse_corpus(corpus, spacy_model, batch_size, n_process):
+    logger.info(f"Processing corpus with {spacy_model}...")
+    nlp = spacy.load(spacy_model)
+    if "trf" in spacy_model:
+      # transformer pipelines run on a single gpu process; batching still amortizes the forward passes
+      n_process = 1
+    return nlp.pipe(corpus, batch_size=batch_size, n_process=n_process)
+
+
+def _length_thresholds(hist, cutoff_q):
+    l_threshold = hist.quantile(cutoff_q[0])
     # manually set upper threshold to 200 just to be safe when using Pretrained Tokenizers with maximum length=512.
-    u_threshold = min(np.quantile(lengths, cutoff_q[1]), 200)
+    u_threshold = min(hist.quantile(cutoff_q[1]), 200)
+    return l_threshold, u_threshold
+
 
-    filtered = []
+def _filter_sentences(docs, thresholds):
+    # thresholds: (lower, upper) or a callable returning the current thresholds of a streaming sketch
     num_skipped = 0
     num_processed = 0
-
-    for sample in sentence_tokenized[start_sample_idx: start_sample_idx+num_sample]:
+    for doc in docs:
+        l_threshold, u_threshold = thresholds() if callable(thresholds) else thresholds
+        sample = document_sentences(doc)
         sentences = [sen for sen in sample if l_threshold <= len(sen) <= u_threshold]
         num_skipped += len(sample) - len(sentences)
         num_processed += len(sentences)
-        filtered.append(sentences)
-
-    # post_processed_length = []
-    # for sentences in filtered:
-    #     post_processed_length.extend([len(sen) for sen in sentences])
-    #
-    # print([np.quantile(post_processed_length, q) for q in [0.1, 0.25, 0.5, 0.75, 0.9]])
-    # print(min(post_processed_length))
-    # print(max(post_processed_length))
+        yield sentences
     logger.info(f"{num_processed} sentences processed, {num_skipped} sentences skipped")
-    return filtered
+
+
+def _stream_parsed(store, docs, vocab, start_sample_idx, num_sample, cutoff_q, warmup):
+    # lengths of the documents that are already in the store (resumed parse) seed the sketch
+    hist = store.length_histogram()
+    end_sample_idx = start_sample_idx + num_sample
+    thresholds = store.thresholds(cutoff_q)
+
+    def fix_thresholds():
+        nonlocal thresholds
+        thresholds = _length_thresholds(hist, cutoff_q)
+        store.set_thresholds(cutoff_q, thresholds)
+
+    def ready_docs():
+        # documents are held back until the thresholds are fixed
+        pending = list(store.iter_docs(vocab, start_sample_idx, num_sample))
+        num_seen = len(store)
+        for doc_idx, doc in enumerate(store.iter_write(docs), start=len(store)):
+            num_seen += 1
+            if start_sample_idx <= doc_idx < end_sample_idx:
+                pending.append(doc)
+            if thresholds is None:
+                hist.update(len(sen) for sen in document_sentences(doc))
+                if num_seen < warmup:
+                    continue
+                fix_thresholds()
+            yield from pending
+            pending = []
+        if thresholds is None:
+            fix_thresholds()
+        yield from pending
+
+    return _filter_sentences(ready_docs(), lambda: thresholds)
+
 
 def get_dataset(dtype):
     if dtype == "imdb":
@@ -0,0 +1,84 @@
+import torch
+
+from utils.logging import getLogger
+
+logger = getLogger("DEVICE", debug_mode=True)
+PRECISIONS = ['fp32', 'bf16', 'int8']
+BACKENDS = ['torch', 'onnx']
+_settings = {'device': None, 'precision': 'fp32', 'backend': 'torch', 'num_threads': 0}
+
+
+def select_device(device="auto"):
+    if device == "auto":
+        return torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    return torch.device(device)
+
+
+def configure(device="auto", num_threads=0, precision="fp32", backend="torch"):
+    """
+    Sets the device and precision used by the whole pipeline (models, metrics, pipelines)
+    device: "auto" (cuda if available, otherwise cpu), "cpu" or "cuda"
+    num_threads: number of intra-op threads of torch on cpu (0 keeps the default of torch)
+    precision: "fp32", "bf16" or "int8" (dynamic quantization of linear layers; cpu only)
+    backend: "torch" or "onnx" (exported graphs run by ONNX Runtime on cpu; see export_onnx.py)
+    """
+    if backend not in BACKENDS:
+        raise NotImplementedError(f"Unknown backend {backend}")
+    if precision not in PRECISIONS:
+        raise NotImplementedError(f"Unknown precision {precision}")
+    if backend == "onnx":
+        device = "cpu"
+    if backend == "onnx" and precision == "bf16":
+        logger.info("bf16 is not supported by the onnx backend; using fp32")
+        precision = "fp32"
+    device = select_device(device)
+    if precision == "int8" and device.type != "cpu":
+        logger.info("int8 dynamic quantization is only supported on cpu; using fp32")
+        precision = "fp32"
+    if precision == "bf16" and device.type == "cuda" and not torch.cuda.is_bf16_supported():
+        logger.info("bf16 is not supported on this gpu; using fp32")
+        precision = "fp32"
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+    _settings['device'] = device
+    _settings['precision'] = precision
+    _settings['backend'] = backend
+    _settings['num_threads'] = num_threads
+    logger.info(f"Using {backend} on {device} with {precision} ({torch.get_num_threads()} threads)")
+    return device
+
+
+def get_device():
+    if _settings['device'] is None:
+        _settings['device'] = select_device()
+    return _settings['device']
+
+
+def get_precision():
+    return _settings['precision']
+
+
+def get_backend():
+    return _settings['backend']
+
+
+def get_num_threads():
+    return _settings['num_threads']
+
+
+def apply_precision(model, precision=None):
+    """
+    Converts an inference-only model to the configured precision
+    """
+    precision = precision or get_precision()
+    if precision == "bf16":
+        model = model.to(torch.bfloat16)
+    elif precision == "int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def inference_mode():
+    # faster than torch.no_grad; outputs can not be used for backpropagation
+    return torch.inference_mode()
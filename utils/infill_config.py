@@ -1,5 +1,20 @@
-from transformers import AutoTokenizer, AutoModelForMaskedLM
+from transformers import AutoModelForMaskedLM
 
-INFILL_TOKENIZER = AutoTokenizer.from_pretrained('bert-base-cased')
-INFILL_MODEL = AutoModelForMaskedLM.from_pretrained("bert-base-cased")
+from utils.model_registry import get_tokenizer
 
+
+_infill_model = None
+
+
+def __getattr__(name):
+    # loaded on first access instead of at import time;
+    # the model is trained by the importing scripts, so it is not shared through the registry
+    global _infill_model
+    if name == "INFILL_TOKENIZER":
+        return get_tokenizer('bert-base-cased')
+    if name == "INFILL_MODEL":
+        # one instance per process, as when it was created at import time
+        if _infill_model is None:
+            _infill_model = AutoModelForMaskedLM.from_pretrained("bert-base-cased")
+        return _infill_model
+    raise AttributeError(f"module {__name__} has no attribute {name}")
@@ -8,10 +8,11 @@ import spacy
 import torch
 from transformers import DataCollatorForTokenClassification
 
-from utils.infill_config import INFILL_TOKENIZER
+from utils.lazy import Lazy
+from utils.model_registry import get_tokenizer
 
 
-tokenizer = INFILL_TOKENIZER
+tokenizer = Lazy(lambda: get_tokenizer('bert-base-cased'), "bert-base-cased tokenizer")
 
 def collator_for_masking_random(feature, masking_p):
     datacollator = DataCollatorForTokenClassification(tokenizer, padding=True,
@@ -68,7 +69,7 @@ def collator_for_masking_random(feature, masking_p):
     return datacollator(feature), datacollator(corr_feature)
 
 
-spacy_tokenizer = spacy.load('en_core_web_sm')
+spacy_tokenizer = Lazy(lambda: spacy.load('en_core_web_sm'), "en_core_web_sm")
 
 def collator_for_masking_ours(feature, mask_selector, keyword_module):
     datacollator = DataCollatorForTokenClassification(tokenizer, padding=True,
@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+import time
+
+# (component, seconds) of every profiled import or load in the order they finished
+_startup_profile = []
+
+
+@contextmanager
+def profile(component):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _startup_profile.append((component, time.perf_counter() - start))
+
+
+def log_startup_profile(log):
+    # profiled blocks can be nested (e.g. a model loaded inside InfillModel), so the times are not summed
+    for component, elapsed in _startup_profile:
+        log.info(f"{component}: {elapsed:.2f}s")
+
+
+class Lazy:
+    """
+    Proxy of an object (model, pipeline, word set, ...) that is created by factory on first use.
+    Attribute access, calls, membership tests and iteration are forwarded to the object.
+    """
+    def __init__(self, factory, name):
+        self._factory = factory
+        self._name = name
+        self._obj = None
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            with profile(f"load {self._name}"):
+                self._obj = self._factory()
+            self._loaded = True
+        return self._obj
+
+    def __getattr__(self, attr):
+        # only reached for attributes that the proxy itself does not have
+        if attr in ('_factory', '_name', '_obj', '_loaded'):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __contains__(self, item):
+        return item in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __repr__(self):
+        return repr(self._load()) if self._loaded else f"<lazy {self._name}>"
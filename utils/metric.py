@@ -2,22 +2,29 @@ import os.path
 
 from datasets import load_dataset
 import numpy as np
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import util
 import torch
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
-from utils.dataset_utils import preprocess2sentence, preprocess_txt, get_result_txt
+from utils.dataset_utils import preprocess2sentence, preprocess_txt
+from utils.device import inference_mode
+from utils.lazy import Lazy
+from utils.model_registry import get_model, get_sentence_transformer, get_tokenizer
+from utils.result_store import load_result
 
 
 class Metric:
     def __init__(self, device, **kwargs):
-        self.sts_model = {"all-MiniLM-L6-v2": SentenceTransformer('all-MiniLM-L6-v2'),
-                          "roberta": SentenceTransformer('sentence-transformers/stsb-roberta-base-v2')}
-        self.awt_model = SentenceTransformer('bert-base-nli-mean-tokens')
+        # models are loaded on first use
+        self.sts_model = {"all-MiniLM-L6-v2": Lazy(lambda: get_sentence_transformer('all-MiniLM-L6-v2'),
+                                                   "all-MiniLM-L6-v2"),
+                          "roberta": Lazy(lambda: get_sentence_transformer('sentence-transformers/stsb-roberta-base-v2'),
+                                          "stsb-roberta-base-v2")}
+        self.awt_model = Lazy(lambda: get_sentence_transformer('bert-base-nli-mean-tokens'), "bert-base-nli-mean-tokens")
         # self.nli_model = AutoModelForSequenceClassification.from_pretrained('cross-encoder/nli-deberta-v3-large').to(device)
         # self.nli_tokenizer = AutoTokenizer.from_pretrained('cross-encoder/nli-deberta-v3-large')
-        self.nli_model = AutoModelForSequenceClassification.from_pretrained("roberta-large-mnli").to(device)
-        self.nli_tokenizer = AutoTokenizer.from_pretrained('roberta-large')
+        self.nli_model = Lazy(lambda: get_model("roberta-large-mnli", device=device), "roberta-large-mnli")
+        self.nli_tokenizer = get_tokenizer('roberta-large')
 
         self.device = device
 
@@ -39,17 +46,19 @@ class Metric:
         if cover_texts is None:
             cover_texts = self.test_cv if self.test_cv else self.load_test_cv()
 
-        watermarked = get_result_txt(path2wm)
+        watermarked = load_result(path2wm)
+        c_idxs, sen_idxs, wm_texts = [watermarked.column(k) for k in ['corpus_idx', 'sentence_idx', 'text']]
+        msg_lengths = watermarked.column('message').lengths()
         batch = []
         wm_batch = []
         sr_score = []
         sr_dist = []
-        for idx, (c_idx, sen_idx, sub_idset, sub_idx, wm_text, key, msg) in enumerate(watermarked):
+        for idx in range(len(watermarked)):
             # only include watermarks that are altered from the original
-            if len(msg) > 0:
-                text = cover_texts[int(c_idx)][int(sen_idx)].text
+            if msg_lengths[idx] > 0:
+                text = cover_texts[int(c_idxs[idx])][int(sen_idxs[idx])].text
                 batch.append(text)
-                wm_batch.append(wm_text.strip())
+                wm_batch.append(wm_texts[idx].strip())
             if (len(batch) == 64 or idx == len(watermarked) - 1) and len(wm_batch) != 0:
                 wm_emb = self.sts_model[model_name].encode(wm_batch, convert_to_tensor=True)
                 emb = self.sts_model[model_name].encode(batch, convert_to_tensor=True)
@@ -69,25 +78,27 @@ class Metric:
         if cover_texts is None:
             cover_texts = self.test_cv if self.test_cv else self.load_test_cv()
 
-        watermarked = get_result_txt(path2wm)
+        watermarked = load_result(path2wm)
+        c_idxs, sen_idxs, wm_texts = [watermarked.column(k) for k in ['corpus_idx', 'sentence_idx', 'text']]
+        msg_lengths = watermarked.column('message').lengths()
         batch = []
         wm_batch = []
         nli_score = []
         all_texts = []
         all_wm_texts = []
 
-        for idx, (c_idx, sen_idx, sub_idset, sub_idx, wm_text, key, msg) in enumerate(watermarked):
+        for idx in range(len(watermarked)):
             # only include watermarks that are altered from the original
-            if len(msg) > 0:
-                text = cover_texts[int(c_idx)][int(sen_idx)].text
+            if msg_lengths[idx] > 0:
+                text = cover_texts[int(c_idxs[idx])][int(sen_idxs[idx])].text
                 batch.append(text)
-                wm_batch.append(wm_text.strip())
+                wm_batch.append(wm_texts[idx].strip())
 
             if (len(batch) == 64 or idx == len(watermarked) - 1) and len(wm_batch) != 0:
                 nli_encodings = self._concatenate_for_nli(batch, wm_batch)
                 nli_encodings = {k: v.to(self.device) for k, v in nli_encodings.items()}
-                with torch.no_grad():
-                    scores = self.nli_model(**nli_encodings).logits
+                with inference_mode():
+                    scores = self.nli_model(**nli_encodings).logits.float()
                     entail_score = torch.nn.functional.softmax(scores, dim=-1)[:, 2]
 
                 # scores = self.nli_model.predict(batch)
@@ -8,7 +8,6 @@ import re
 
 from nltk.stem import WordNetLemmatizer
 from nltk.stem.porter import PorterStemmer
-from nltk.corpus import stopwords
 # from models.misc_models import tokenizer, pipe_classification, pipe_fill_mask
 
 try:
@@ -16,10 +15,12 @@ try:
 except:
     print("Error importing yake")
 
+from config import stop
+from utils.lazy import Lazy
+
 sr_threshold = 0.95
-stop = set(stopwords.words('english'))
 punctuation = set(string.punctuation)
-riskset = stop.union(punctuation)
+riskset = Lazy(lambda: stop.union(punctuation), "riskset")
 
 
 def get_tfidf_keywords(vectorizer, feature_names, doc, topk=10):
@@ -0,0 +1,98 @@
+import threading
+
+import torch
+from transformers import AutoModelForMaskedLM, AutoModelForSequenceClassification, AutoTokenizer
+
+from utils.device import apply_precision, get_backend, get_device, get_num_threads, get_precision
+from utils.lazy import profile
+from utils.logging import getLogger
+from utils.onnx_backend import OnnxModel, onnx_path
+
+logger = getLogger("MODEL_REGISTRY", debug_mode=True)
+
+_models = {}
+_tokenizers = {}
+_lock = threading.RLock()
+
+MODEL_CLASSES = {'masked_lm': AutoModelForMaskedLM,
+                 'sequence_classification': AutoModelForSequenceClassification}
+
+
+def _normalize_device(device):
+    device = torch.device(device) if device is not None else get_device()
+    # "cuda", 0 and "cuda:0" refer to the same model
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return device
+
+
+def _key(kind, name, device=None, precision=None, backend="torch"):
+    device = str(_normalize_device(device))
+    return kind, name, device, precision or "fp32", backend
+
+
+def _register(key, load):
+    with _lock:
+        if key not in _models:
+            logger.info(f"Loading {key[1]} ({key[0]}) on {key[2]}")
+            with profile(f"load {key[1]}"):
+                _models[key] = load()
+        return _models[key]
+
+
+def get_model(name, kind='sequence_classification', device=None, precision=None):
+    """
+    Shared instance of a huggingface model in eval mode; the model is loaded on the first request.
+    Models that are trained or whose weights are modified must be loaded separately.
+    kind: key of MODEL_CLASSES
+    device: defaults to the device of utils.device
+    precision: "fp32", "bf16" or "int8"; defaults to the precision of utils.device
+    With the onnx backend, the graph exported by export_onnx.py is loaded instead (int8: the quantized graph).
+    """
+    precision = precision or get_precision()
+    backend = get_backend()
+
+    def load():
+        if backend == "onnx":
+            return OnnxModel(onnx_path(name, kind, quantized=precision == "int8"), num_threads=get_num_threads())
+        model = MODEL_CLASSES[kind].from_pretrained(name).to(_normalize_device(device))
+        return apply_precision(model.eval(), precision)
+
+    return _register(_key(kind, name, device, precision, backend), load)
+
+
+def get_tokenizer(name):
+    with _lock:
+        if name not in _tokenizers:
+            _tokenizers[name] = AutoTokenizer.from_pretrained(name)
+        return _tokenizers[name]
+
+
+def get_sentence_transformer(name, device=None):
+    def load():
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(name, device=str(_normalize_device(device)))
+
+    return _register(_key('sentence_transformer', name, device), load)
+
+
+def model_memory(model):
+    # resident size of the parameters and buffers in bytes
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def memory_report():
+    """
+    Output: Dict[(kind, name, device, precision, backend), bytes] of every loaded model
+    """
+    with _lock:
+        return {key: model_memory(model) for key, model in _models.items()}
+
+
+def log_memory_report(log=logger):
+    total = 0
+    for (kind, name, device, precision, backend), size in memory_report().items():
+        total += size
+        log.info(f"{name} ({kind}, {backend}, {device}, {precision}): {size / 2 ** 20:.1f} MiB")
+    log.info(f"Total size of the shared models: {total / 2 ** 20:.1f} MiB")
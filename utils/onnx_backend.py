@@ -0,0 +1,118 @@
+from types import SimpleNamespace
+import os
+
+import numpy as np
+import torch
+
+ONNX_DIR = "./models/onnx"
+
+
+def onnx_path(name, kind, quantized=False, onnx_dir=ONNX_DIR):
+    """
+    Path of the exported graph of a model name (or checkpoint path)
+    """
+    safe_name = name.strip("./").replace("/", "_")
+    suffix = "-int8" if quantized else ""
+    return os.path.join(onnx_dir, f"{safe_name}-{kind}{suffix}.onnx")
+
+
+class OnnxModel:
+    """
+    ONNX Runtime session on cpu that can be called like a huggingface model;
+    torch tensors go in and an object with .logits (torch.Tensor) comes out.
+    """
+    def __init__(self, path, num_threads=0):
+        import onnxruntime as ort
+
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"{path} does not exist; export the model with export_onnx.py first")
+        options = ort.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.device = torch.device("cpu")
+
+    def __call__(self, **inputs):
+        feed = {k: v.detach().cpu().numpy().astype(np.int64) for k, v in inputs.items() if k in self.input_names}
+        logits = self.session.run(["logits"], feed)[0]
+        return SimpleNamespace(logits=torch.from_numpy(logits))
+
+    def eval(self):
+        return self
+
+    def parameters(self):
+        return iter([])
+
+    def buffers(self):
+        return iter([])
+
+
+class _LogitsOnly(torch.nn.Module):
+    # huggingface models return a ModelOutput; onnx export needs plain tensors
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids=None):
+        if token_type_ids is None:
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids).logits
+
+
+def export(model, tokenizer, path, kind, opset_version=14):
+    """
+    Exports a huggingface model with dynamic batch and sequence axes
+    kind: "masked_lm" or "sequence_classification" (see utils.model_registry.MODEL_CLASSES)
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    dummy = tokenizer(["a sample sentence", "another sample"], return_tensors="pt", padding="longest")
+    input_names = [k for k in ['input_ids', 'attention_mask', 'token_type_ids'] if k in dummy]
+    dynamic_axes = {k: {0: "batch", 1: "sequence"} for k in input_names}
+    dynamic_axes['logits'] = {0: "batch", 1: "sequence"} if kind == "masked_lm" else {0: "batch"}
+    model = _LogitsOnly(model.cpu().eval())
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(dummy[k] for k in input_names), path, input_names=input_names,
+                          output_names=["logits"], dynamic_axes=dynamic_axes, opset_version=opset_version)
+    return path
+
+
+def quantize(path, quantized_path):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+def check_parity(torch_model, onnx_model, tokenizer, texts, topk=32, batch_size=16):
+    """
+    Compares the top-k token ids at every [MASK] (or the predicted label for classification models)
+    of the torch and onnx models. Candidates and masks of the watermark are derived from these rankings,
+    so any mismatch can change the embedded message.
+    texts: List[str] or List[(premise, hypothesis)] for nli models
+    Output: dict of the number of compared positions, mismatched positions and the maximum absolute logit difference
+    """
+    torch_model = torch_model.cpu().eval()
+    num_compared, num_mismatch, max_diff = 0, 0, 0.0
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        if isinstance(batch[0], tuple):
+            inputs = tokenizer([b[0] for b in batch], [b[1] for b in batch], return_tensors="pt", padding="longest")
+        else:
+            inputs = tokenizer(batch, return_tensors="pt", padding="longest")
+        with torch.no_grad():
+            torch_logits = torch_model(**inputs).logits.float()
+        onnx_logits = onnx_model(**inputs).logits.float()
+        max_diff = max(max_diff, (torch_logits - onnx_logits).abs().max().item())
+
+        if torch_logits.dim() == 3:
+            positions = inputs['input_ids'] == tokenizer.mask_token_id
+            torch_rank = torch_logits[positions].topk(topk, dim=-1).indices
+            onnx_rank = onnx_logits[positions].topk(topk, dim=-1).indices
+        else:
+            torch_rank = torch_logits.argmax(dim=-1, keepdim=True)
+            onnx_rank = onnx_logits.argmax(dim=-1, keepdim=True)
+        num_compared += len(torch_rank)
+        num_mismatch += (torch_rank != onnx_rank).any(dim=-1).sum().item()
+    return {'num_compared': num_compared, 'num_mismatch': num_mismatch, 'max_logit_diff': max_diff}
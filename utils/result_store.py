@@ -0,0 +1,222 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+from utils.dataset_utils import parse_result_line
+from utils.logging import getLogger
+
+FORMAT_VERSION = 1
+# columns of a result line in the order of get_result_txt
+COLUMNS = ['corpus_idx', 'sentence_idx', 'sub_idset', 'sub_idx', 'text', 'keys', 'message']
+INT_COLUMNS = ['corpus_idx', 'sentence_idx']
+STRING_COLUMNS = ['text']
+JSON_COLUMNS = ['sub_idset', 'keys']
+RAGGED_COLUMNS = ['sub_idx', 'message']
+logger = getLogger("RESULT_STORE", debug_mode=True)
+
+
+def store_path(result_txt):
+    return os.path.splitext(result_txt)[0] + ".cols"
+
+
+def _load_array(path):
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # empty arrays cannot be memory-mapped
+        return np.load(path)
+
+
+def _source_stat(result_txt):
+    stat = os.stat(result_txt)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+class StringColumn:
+    """
+    Variable-length utf-8 strings stored as one byte blob and the offsets of every row
+    """
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return bytes(self.blob[self.offsets[idx]:self.offsets[idx + 1]]).decode("utf-8")
+
+
+class JsonColumn(StringColumn):
+    def __getitem__(self, idx):
+        return json.loads(super().__getitem__(idx))
+
+
+class RaggedColumn:
+    """
+    Variable-length lists of integers stored as one value array and the offsets of every row
+    """
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.values[self.offsets[idx]:self.offsets[idx + 1]].tolist()
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+class ResultStore:
+    """
+    Columnar copy of a result file (e.g. watermarked.txt) stored as numpy arrays in {result}.cols/.
+    Arrays are memory-mapped, so opening the store is independent of the number of lines and
+    only the rows and columns that are accessed are read from disk.
+    store[i] returns the same list as the i-th element of get_result_txt.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.eos = _load_array(os.path.join(path, "eos.npy"))
+        self._columns = {}
+        self._sorted_keys = None
+
+    def __len__(self):
+        return self.meta['num_rows']
+
+    def __getitem__(self, idx):
+        return self.row(idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.row(idx)
+
+    def column(self, name):
+        if name not in self._columns:
+            self._columns[name] = self._load_column(name)
+        return self._columns[name]
+
+    def _load_column(self, name):
+        def load(suffix):
+            return _load_array(os.path.join(self.path, f"{name}{suffix}.npy"))
+
+        if name in INT_COLUMNS:
+            return load("")
+        elif name in STRING_COLUMNS:
+            return StringColumn(load(".data"), load(".offsets"))
+        elif name in JSON_COLUMNS:
+            return JsonColumn(load(".data"), load(".offsets"))
+        elif name in RAGGED_COLUMNS:
+            return RaggedColumn(load(".data"), load(".offsets"))
+        raise KeyError(f"Unknown column {name}")
+
+    def row(self, idx, columns=None):
+        """
+        columns: names of the columns to read (all columns if None)
+        """
+        if self.eos[idx]:
+            return ["eos"] * len(columns or COLUMNS)
+        row = []
+        for name in columns or COLUMNS:
+            value = self.column(name)[idx]
+            row.append(int(value) if name in INT_COLUMNS else value)
+        return row
+
+    def find(self, corpus_idx, sentence_idx):
+        """
+        Row index of (corpus idx, sentence idx); raises KeyError if it does not exist
+        """
+        if self._sorted_keys is None:
+            keys = self._row_keys(self.column('corpus_idx'), self.column('sentence_idx'))
+            order = np.argsort(keys, kind="stable")
+            self._sorted_keys = (keys[order], order)
+        sorted_keys, order = self._sorted_keys
+        key = self._row_keys(np.array([corpus_idx]), np.array([sentence_idx]))[0]
+        pos = np.searchsorted(sorted_keys, key)
+        if pos == len(sorted_keys) or sorted_keys[pos] != key:
+            raise KeyError((corpus_idx, sentence_idx))
+        return int(order[pos])
+
+    def get(self, corpus_idx, sentence_idx, columns=None):
+        return self.row(self.find(corpus_idx, sentence_idx), columns)
+
+    @staticmethod
+    def _row_keys(corpus_idx, sentence_idx):
+        return (np.asarray(corpus_idx, dtype=np.int64) << 32) + np.asarray(sentence_idx, dtype=np.int64)
+
+    def is_fresh(self, result_txt):
+        return self.meta['version'] == FORMAT_VERSION and \
+               all(self.meta[k] == v for k, v in _source_stat(result_txt).items())
+
+
+def build_result_store(result_txt, sep='\t'):
+    """
+    Parses result_txt once and writes its columnar copy next to it
+    """
+    columns = {name: [] for name in COLUMNS}
+    eos = []
+    with open(result_txt, "r") as reader:
+        for line in reader:
+            line = parse_result_line(line, sep)
+            is_eos = line[0] == "eos"
+            eos.append(is_eos)
+            if is_eos:
+                line = [-1, -1, [], [], "", [], []]
+            for name, value in zip(COLUMNS, line):
+                columns[name].append(value)
+
+    path = store_path(result_txt)
+    tmp_path = path + ".tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    def save(name, array):
+        np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+
+    def save_strings(name, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        save(f"{name}.data", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        save(f"{name}.offsets", np.cumsum([0] + [len(s) for s in encoded], dtype=np.int64))
+
+    save("eos", np.array(eos, dtype=bool))
+    for name in INT_COLUMNS:
+        save(name, np.array(columns[name], dtype=np.int64))
+    for name in STRING_COLUMNS:
+        save_strings(name, columns[name])
+    for name in JSON_COLUMNS:
+        save_strings(name, [json.dumps(value) for value in columns[name]])
+    for name in RAGGED_COLUMNS:
+        values = [v or [] for v in columns[name]]
+        save(f"{name}.data", np.array([x for v in values for x in v], dtype=np.int64))
+        save(f"{name}.offsets", np.cumsum([0] + [len(v) for v in values], dtype=np.int64))
+
+    meta = {'version': FORMAT_VERSION, 'num_rows': len(eos), 'sep': sep}
+    meta.update(_source_stat(result_txt))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return ResultStore(path)
+
+
+def load_result(result_txt, sep='\t'):
+    """
+    Opens the columnar copy of result_txt. The copy is (re)built from result_txt
+    if it does not exist or result_txt was modified after it was built.
+    """
+    path = store_path(result_txt)
+    if os.path.isfile(os.path.join(path, "meta.json")):
+        store = ResultStore(path)
+        if store.is_fresh(result_txt) and store.meta['sep'] == sep:
+            return store
+        logger.info(f"{path} is stale; rebuilding from {result_txt}")
+    return build_result_store(result_txt, sep)
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+
+from utils.logging import getLogger
+
+logger = getLogger("SENTENCE_CACHE", debug_mode=True)
+
+
+class SentenceCache:
+    """
+    Content-addressed on-disk cache of per-sentence states (keywords, masks, infill candidates) backed by SQLite.
+    Keys are the hash of the sentence text together with the configuration that produced the state,
+    so caches of different models or mask/keyword arguments never collide.
+    Entries are evicted in least-recently-used order once max_entries is exceeded.
+    """
+    def __init__(self, path, config, max_entries=1000000, commit_interval=100):
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.config = json.dumps(config, sort_keys=True, default=str)
+        self.max_entries = max_entries
+        self.commit_interval = commit_interval
+        self.hits = 0
+        self.misses = 0
+        self._num_writes = 0
+
+        self.path = path
+        self.conn = self._connect()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache "
+                          "(key TEXT PRIMARY KEY, value BLOB, last_access INTEGER)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        self.conn.commit()
+        # set in forked workers (see reconnect)
+        self.shared = False
+        self.num_entries = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        logger.info(f"Using sentence cache {path} with {self.num_entries} entries")
+
+    def _connect(self):
+        # embedding workers share the cache file: WAL lets them read while another one writes,
+        # and writers wait for the lock instead of failing
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def reconnect(self):
+        """
+        Opens a new connection in a forked process; the connection of the parent is left untouched.
+        The workers commit every write, so none of them holds the write lock while the others wait,
+        and leave the eviction to the main process (see evict), since their entry counts are not shared.
+        """
+        self.conn = self._connect()
+        self._num_writes = 0
+        self.commit_interval = 1
+        self.shared = True
+
+    def _key(self, text, tag=""):
+        return hashlib.sha256(f"{self.config}\0{tag}\0{text}".encode("utf-8")).hexdigest()
+
+    # the access clock is read from the table (indexed), so the order is kept across processes
+    _TICK = "(SELECT COALESCE(MAX(last_access), 0) + 1 FROM cache)"
+
+    def get(self, text, tag=""):
+        key = self._key(text, tag)
+        row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute(f"UPDATE cache SET last_access = {self._TICK} WHERE key = ?", (key,))
+        self._maybe_commit()
+        return pickle.loads(row[0])
+
+    def put(self, text, value, tag=""):
+        key = self._key(text, tag)
+        exists = self.conn.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is not None
+        self.conn.execute(f"INSERT OR REPLACE INTO cache (key, value, last_access) VALUES (?, ?, {self._TICK})",
+                          (key, sqlite3.Binary(pickle.dumps(value))))
+        if not exists:
+            self.num_entries += 1
+        if not self.shared and self.num_entries > self.max_entries:
+            self._evict(self.num_entries - self.max_entries)
+        self._maybe_commit()
+
+    def _evict(self, num_evict):
+        self.conn.execute("DELETE FROM cache WHERE key IN "
+                          "(SELECT key FROM cache ORDER BY last_access ASC LIMIT ?)", (num_evict,))
+        self.num_entries -= num_evict
+
+    def evict(self):
+        """
+        Recounts the entries written by all processes and evicts the least recently used ones beyond max_entries
+        """
+        self.num_entries = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if self.num_entries > self.max_entries:
+            self._evict(self.num_entries - self.max_entries)
+        self.conn.commit()
+
+    def _maybe_commit(self):
+        self._num_writes += 1
+        if self._num_writes % self.commit_interval == 0:
+            self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        if not self.shared:
+            # includes the entries of forked workers
+            self.evict()
+        self.conn.commit()
+        self.conn.close()
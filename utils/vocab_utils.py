@@ -0,0 +1,133 @@
+import os
+import pickle
+import string
+
+from nltk.stem import WordNetLemmatizer
+from nltk.stem.porter import PorterStemmer
+import numpy as np
+import torch
+
+from utils.logging import getLogger
+
+CACHE_DIR = "./data/cache"
+LEMMA_POS = ["v", "n", "a", "r", "s"]
+# case of the first letter of a word
+CASE_EMPTY, CASE_UPPER, CASE_LOWER = 0, 1, 2
+logger = getLogger("VOCAB_UTILS", debug_mode=True)
+
+
+def return_case(word):
+    word = word.strip()
+    if len(word) == 0:
+        return CASE_EMPTY
+    return CASE_UPPER if word[0].isupper() else CASE_LOWER
+
+
+class VocabTable:
+    """
+    Properties of every token id of a tokenizer that are used for filtering infill candidates.
+    String properties (surface form, lowercase, stem, lemma per pos) are interned to integer ids
+    so that candidates can be filtered by comparing tensors instead of strings.
+    The table is built once per (tokenizer, spacy model) and cached to disk.
+    """
+    ARRAYS = ['is_subword', 'is_single', 'has_punct', 'case', 'surface', 'lower', 'stem', 'lemma']
+
+    def __init__(self, tokenizer, nlp=None, device=torch.device("cpu"), use_cache=True):
+        self.porter_stemmer = PorterStemmer()
+        self.lemmatizer = WordNetLemmatizer()
+        self.device = device
+
+        spacy_model = f"{nlp.meta['lang']}_{nlp.meta['name']}" if nlp is not None else "nospacy"
+        id = f"vocab-{tokenizer.name_or_path.replace('/', '_')}-{spacy_model}"
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR, exist_ok=True)
+        file_dir = os.path.join(CACHE_DIR, id + ".pkl")
+
+        if use_cache and os.path.isfile(file_dir):
+            logger.info(f"Using cache {file_dir}")
+            with open(file_dir, "rb") as f:
+                table = pickle.load(f)
+        else:
+            logger.info(f"Building vocabulary table for {tokenizer.name_or_path}...")
+            table = self._build(tokenizer, nlp)
+            with open(file_dir, "wb") as f:
+                pickle.dump(table, f)
+
+        self.str2id = table['str2id']
+        for k in self.ARRAYS:
+            setattr(self, k, torch.from_numpy(table[k]).to(device))
+
+    def _build(self, tokenizer, nlp):
+        str2id = {}
+
+        def intern(s):
+            return str2id.setdefault(s, len(str2id))
+
+        punctuation = set(string.punctuation)
+        vocab_size = len(tokenizer)
+        token_strs = tokenizer.batch_decode([[x] for x in range(vocab_size)])
+
+        table = {'is_subword': np.zeros(vocab_size, dtype=bool),
+                 'is_single': np.ones(vocab_size, dtype=bool),
+                 'has_punct': np.zeros(vocab_size, dtype=bool),
+                 'case': np.zeros(vocab_size, dtype=np.int8),
+                 'surface': np.zeros(vocab_size, dtype=np.int64),
+                 'lower': np.zeros(vocab_size, dtype=np.int64),
+                 'stem': np.zeros(vocab_size, dtype=np.int64),
+                 'lemma': np.zeros((vocab_size, len(LEMMA_POS)), dtype=np.int64)}
+
+        for idx, token_str in enumerate(token_strs):
+            table['is_subword'][idx] = token_str.startswith("##")
+            if nlp is not None:
+                # only the tokenizer of the pipeline determines the number of tokens
+                table['is_single'][idx] = len(nlp.make_doc(token_str)) == 1
+            table['has_punct'][idx] = any(s in punctuation for s in token_str)
+            table['case'][idx] = return_case(token_str)
+            table['surface'][idx] = intern(token_str)
+            table['lower'][idx] = intern(token_str.lower())
+            table['stem'][idx] = intern(self.porter_stemmer.stem(token_str))
+            for p_idx, pos in enumerate(LEMMA_POS):
+                table['lemma'][idx, p_idx] = intern(self.lemmatizer.lemmatize(token_str, pos))
+
+        table['str2id'] = str2id
+        return table
+
+    def lookup(self, s):
+        """
+        Interned id of a string. Strings that do not appear in the table get -1, which never matches a token.
+        """
+        return self.str2id.get(s, -1)
+
+    def in_set(self, words):
+        """
+        Boolean mask over the vocabulary that is True for tokens whose surface form is in words (e.g. riskset)
+        """
+        word_ids = torch.tensor([self.lookup(w) for w in words], dtype=torch.long, device=self.device)
+        return torch.isin(self.surface, word_ids)
+
+    def derivation_mask(self, candidate_ids, original_word):
+        """
+        Boolean mask over candidate_ids that is False for morphological derivations of original_word
+        (differences only in case, same stem, or same lemma), except for original_word itself
+        """
+        surface = self.surface[candidate_ids]
+        is_original = surface == self.lookup(original_word)
+
+        keep = ~((self.lower[candidate_ids] == self.lookup(original_word.lower())) & ~is_original)
+        text_lm = self.porter_stemmer.stem(original_word)
+        keep &= (self.stem[candidate_ids] != self.lookup(text_lm)) | is_original
+        for p_idx, pos in enumerate(LEMMA_POS):
+            text_lm = self.lemmatizer.lemmatize(original_word, pos)
+            keep &= (self.lemma[candidate_ids, p_idx] != self.lookup(text_lm)) | is_original
+        return keep
+
+    def derivation_mask_of_id(self, candidate_ids, original_id):
+        """
+        derivation_mask for an original word that is itself a token of the vocabulary;
+        its case, stem and lemmas are looked up in the table instead of being recomputed
+        """
+        is_original = self.surface[candidate_ids] == self.surface[original_id]
+        keep = ~((self.lower[candidate_ids] == self.lower[original_id]) & ~is_original)
+        keep &= (self.stem[candidate_ids] != self.stem[original_id]) | is_original
+        keep &= ((self.lemma[candidate_ids] != self.lemma[original_id]).all(dim=-1)) | is_original
+        return keep